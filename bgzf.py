@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+'''
+bgzf.py: minimal reader/writer for BGZF (blocked gzip) files with virtual offsets
+see the SAM/BAM spec, section 4.1: a virtual offset is (block offset << 16) | offset within block
+Distributed under MIT license, see LICENSE.txt
+'''
+
+import mmap
+import os
+import struct
+import zlib
+
+BGZF_MAGIC  = '\x1f\x8b\x08\x04'
+HEADER      = struct.Struct('<4sIBBH') # magic, MTIME, XFL, OS, XLEN
+SUBFIELD    = struct.Struct('<BBH')    # SI1, SI2, SLEN
+MAX_BLOCK   = 65536
+BLOCK_DATA  = 0xff00 # uncompressed bytes per block, as in htslib
+EOF_BLOCK   = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+class BgzfError(Exception):
+    pass
+
+def is_bgzf(filename):
+    ''' return True if filename starts with a BGZF block header '''
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or not header.startswith(BGZF_MAGIC):
+            return False
+        xlen = HEADER.unpack(header)[4]
+        return block_size(f.read(xlen)) is not None
+
+def block_size(extra):
+    ''' total block size from the BC subfield of a gzip extra field, None if not present '''
+    i = 0
+    while i + SUBFIELD.size <= len(extra):
+        si1, si2, slen = SUBFIELD.unpack(extra[i:i+SUBFIELD.size])
+        if si1 == 66 and si2 == 67 and slen == 2:
+            return struct.unpack('<H', extra[i+SUBFIELD.size:i+SUBFIELD.size+2])[0] + 1
+        i += SUBFIELD.size + slen
+    return None
+
+def read_block(fh, offset):
+    ''' read the block at file offset, returns (decompressed data, offset of next block)
+        returns ('', None) at end of file '''
+    fh.seek(offset)
+    header = fh.read(HEADER.size)
+    if len(header) == 0:
+        return '', None
+
+    if len(header) < HEADER.size or not header.startswith(BGZF_MAGIC):
+        raise BgzfError('no BGZF block at offset ' + str(offset))
+
+    xlen  = HEADER.unpack(header)[4]
+    extra = fh.read(xlen)
+    bsize = block_size(extra)
+    if bsize is None:
+        raise BgzfError('BGZF block at offset ' + str(offset) + ' has no BC subfield')
+
+    cdata = fh.read(bsize - HEADER.size - xlen)
+    return inflate(cdata), offset + bsize
+
+def inflate(cdata):
+    ''' decompress the raw deflate payload of a block (cdata ends with CRC32 and ISIZE)
+        zlib (zlib.decompress and decompress objects alike) releases the GIL around each inflate()
+        call, which is what lets MmapBgzfReader's threads inflate blocks at the same time '''
+    crc, isize = struct.unpack('<iI', cdata[-8:])
+    data = zlib.decompress(cdata[:-8], -15)
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise BgzfError('BGZF block failed CRC/size check')
+    return data
+
+def deflate_block(data, level=6):
+    ''' compress data (at most BLOCK_DATA bytes) into a complete BGZF block '''
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    bsize = HEADER.size + SUBFIELD.size + 2 + len(cdata) + 8
+    assert bsize <= MAX_BLOCK
+    return (HEADER.pack(BGZF_MAGIC, 0, 0, 255, SUBFIELD.size + 2) + SUBFIELD.pack(66, 67, 2)
+            + struct.pack('<H', bsize - 1) + cdata + struct.pack('<iI', zlib.crc32(data), len(data)))
+
+class BgzfReader:
+    ''' line reader for BGZF files supporting tell() and seek() with virtual offsets '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = open(filename, 'rb')
+
+        self.block_start = 0    # file offset of the current block
+        self.next_block  = 0    # file offset of the next block, None at EOF
+        self.data        = ''   # decompressed current block
+        self.within      = 0    # position in self.data
+
+        self._load(0)
+
+    def _load(self, offset):
+        self.block_start = offset
+        self.data, self.next_block = read_block(self.fh, offset)
+        self.within = 0
+
+    def tell(self):
+        ''' virtual offset of the next byte to be read '''
+        if self.within == len(self.data) and self.next_block is not None:
+            return self.next_block << 16
+        return (self.block_start << 16) | self.within
+
+    def seek(self, voffset):
+        block_start = voffset >> 16
+        if block_start != self.block_start or self.next_block is None:
+            self._load(block_start)
+        self.within = voffset & 0xFFFF
+        assert self.within <= len(self.data)
+
+    def readline(self):
+        ''' return next line including newline, '' at EOF '''
+        chunks = []
+        while True:
+            i = self.data.find('\n', self.within)
+            if i >= 0:
+                chunks.append(self.data[self.within:i+1])
+                self.within = i+1
+                break
+
+            chunks.append(self.data[self.within:])
+            self.within = len(self.data)
+
+            if self.next_block is None:
+                break
+            self._load(self.next_block)
+            if not self.data and self.next_block is None:
+                break
+
+        return ''.join(chunks)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.fh.close()
+
+def scan_block(buf, offset):
+    ''' header length and total size of the block at offset in buf (a string or mmap), from the header alone '''
+    header = buf[offset:offset+HEADER.size]
+    if len(header) < HEADER.size or not header.startswith(BGZF_MAGIC):
+        raise BgzfError('no BGZF block at offset ' + str(offset))
+    xlen  = HEADER.unpack(header)[4]
+    bsize = block_size(buf[offset+HEADER.size:offset+HEADER.size+xlen])
+    if bsize is None:
+        raise BgzfError('BGZF block at offset ' + str(offset) + ' has no BC subfield')
+    return HEADER.size + xlen, bsize
+
+class MmapBgzfReader(BgzfReader):
+    ''' BgzfReader over an mmap of the file: block boundaries come from the block headers and
+        the next threads*blocks_per_thread blocks are inflated in parallel by a thread pool.
+        Threads (not processes) are enough because inflate() runs without the GIL, blocks and
+        their data need no pickling, and the speedup is bounded by the CPU cores available.
+        Lines, tell() and seek() behave exactly as in BgzfReader. '''
+    def __init__(self, filename, threads=4, blocks_per_thread=16):
+        from multiprocessing.pool import ThreadPool # slow to import, most users of this module don't need it
+
+        self.filename = filename
+        self.name = filename
+        self.fh   = open(filename, 'rb')
+        self.size = os.fstat(self.fh.fileno()).st_size
+        self.buf  = ''
+        if self.size > 0:
+            self.buf = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.pool    = ThreadPool(threads)
+        self.nblocks = threads * blocks_per_thread
+        self.ahead   = {} # block offset --> (data, next block offset)
+
+        self.block_start = 0
+        self.next_block  = 0
+        self.data        = ''
+        self.within      = 0
+
+        self._load(0)
+
+    def _inflate(self, block):
+        offset, hlen, bsize = block
+        return inflate(self.buf[offset+hlen:offset+bsize])
+
+    def _read_ahead(self, offset):
+        blocks = []
+        while offset < self.size and len(blocks) < self.nblocks:
+            hlen, bsize = scan_block(self.buf, offset)
+            blocks.append((offset, hlen, bsize))
+            offset += bsize
+
+        self.ahead = {}
+        for block, data in zip(blocks, self.pool.map(self._inflate, blocks)):
+            self.ahead[block[0]] = (data, block[0] + block[2])
+
+        if not blocks: # end of file, same as read_block()
+            self.ahead[offset] = ('', None)
+
+    def _load(self, offset):
+        if offset not in self.ahead:
+            self._read_ahead(offset)
+        self.block_start = offset
+        self.data, self.next_block = self.ahead.pop(offset)
+        self.within = 0
+
+    def close(self):
+        self.pool.close()
+        if self.size > 0:
+            self.buf.close()
+        self.fh.close()
+
+class PlainReader:
+    ''' same interface as BgzfReader for uncompressed files, offsets are byte offsets '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = open(filename, 'r')
+
+    def tell(self):
+        return self.fh.tell()
+
+    def seek(self, offset):
+        self.fh.seek(offset)
+
+    def readline(self):
+        return self.fh.readline()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.fh.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.fh.close()
+
+def open_reader(filename, threads=0):
+    ''' return a BgzfReader (MmapBgzfReader if threads > 0) or PlainReader, None for non-blocked gzip (no random access) '''
+    if filename.endswith('.gz'):
+        if is_bgzf(filename):
+            if threads > 0:
+                return MmapBgzfReader(filename, threads=threads)
+            return BgzfReader(filename)
+        return None
+    return PlainReader(filename)
+
+def header_lines(reader):
+    ''' read header (lines starting with #) from the start of reader, leaves reader at first record '''
+    reader.seek(0)
+    header = []
+    while True:
+        pos  = reader.tell()
+        line = reader.readline()
+        if not line.startswith('#'):
+            reader.seek(pos)
+            return header
+        header.append(line)
+
+class BgzfWriter:
+    ''' writes BGZF, tabix can index the output directly '''
+    def __init__(self, filename, level=6):
+        self.filename = filename
+        self.fh = open(filename, 'wb')
+        self.level = level
+        self.buf  = []
+        self.nbuf = 0
+
+    def tell(self):
+        ''' virtual offset of the next byte to be written (write() keeps nbuf below BLOCK_DATA) '''
+        return (self.fh.tell() << 16) | self.nbuf
+
+    def write(self, data):
+        self.buf.append(data)
+        self.nbuf += len(data)
+        if self.nbuf >= BLOCK_DATA:
+            self._write_blocks()
+
+    def _write_blocks(self, final=False):
+        ''' write all full blocks (and the partial one if final) '''
+        data = ''.join(self.buf)
+        i = 0
+        while len(data) - i >= BLOCK_DATA or (final and i < len(data)):
+            self.fh.write(deflate_block(data[i:i+BLOCK_DATA], self.level))
+            i += BLOCK_DATA
+        data = data[i:]
+        self.buf  = [data]
+        self.nbuf = len(data)
+
+    def flush(self):
+        self._write_blocks(final=True)
+        self.fh.flush()
+
+    def close(self):
+        self.flush()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+'''
+cohort_cmp.py: compare per-sample callsets against a multi-sample (e.g. joint-called) cohort VCF
+
+The cohort VCF is streamed once. For each record only the GT subfield of the requested
+sample columns is decoded, into numpy arrays, and every sample is scored against its own
+calls at the same time. Output is one Summary per sample and variant type (A = per-sample
+calls, B = cohort genotypes), in any format vcfcomparator/mergesummaries.py understand.
+
+SNVs and indels match on CHROM, POS, REF and ALT allele, multi-allelic cohort records are
+split into alleles.
+
+The per-sample VCFs are streamed alongside the cohort, merged by (contig, POS), so only the
+calls at the current cohort position are held in memory. All inputs must be sorted in the
+same contig order: the cohort's ##contig header lines, or the .fai given with -f.
+'''
+
+import argparse
+import array
+import gzip
+import heapq
+import sys
+import numpy as np
+import vcf
+import vcfcomparator as vc
+
+def vtype_of(ref, alt):
+    ''' SNV, INDEL or None (symbolic/breakend/missing alleles are not compared) '''
+    if not alt or alt == '.' or alt == '*' or alt.strip('ACGTNacgtn'):
+        return None
+    if len(ref) == 1 and len(alt) == 1:
+        return 'SNV'
+    return 'INDEL'
+
+def fai_contigs(fai):
+    ''' dict contig --> rank in the .fai '''
+    rank = {}
+    with open(fai, 'r') as f:
+        for line in f:
+            if line.strip():
+                rank.setdefault(line.split()[0], len(rank))
+    return rank
+
+def header_contig(line):
+    ''' contig ID from a ##contig=<ID=...> header line, None for other lines '''
+    if not line.startswith('##contig=<'):
+        return None
+    for field in line.rstrip('\n')[len('##contig=<'):].rstrip('>').split(','):
+        if field.startswith('ID='):
+            return field[3:]
+    return None
+
+def sample_calls(i, vcf_file, rank):
+    ''' one sample's calls in file order as ((contig rank, pos), chrom, pos, ref, alt, i, (pass, somatic)).
+        Contigs the cohort doesn't have get rank -1: they sort before any cohort record and are
+        counted as unmatched straight away '''
+    last = None
+    for rec in vcf.Reader(filename=vcf_file):
+        key = (rank.get(rec.CHROM, -1), rec.POS)
+        if key[0] >= 0:
+            if last is not None and key < last:
+                sys.exit("error: " + vcf_file + " is not sorted in cohort contig order at " + rec.CHROM + ":" + str(rec.POS))
+            last = key
+
+        flags = (vc.rec_pass(rec), vc.recA_is_somatic(rec))
+        for alt in rec.ALT:
+            if alt is None or vtype_of(rec.REF, str(alt)) is None:
+                continue
+            yield key, rec.CHROM, rec.POS, rec.REF, str(alt), i, flags
+
+def info_somatic(info):
+    ''' same rules as vcfcomparator.recA_is_somatic for the INFO column (cohort FORMAT/SS is not used) '''
+    ss = None
+    somatic = False
+    for field in info.split(';'):
+        if field.startswith('SS='):
+            ss = field[3:].upper()
+        elif field == 'SOMATIC':
+            somatic = True
+
+    if ss in ('SOMATIC', '2'):
+        return True
+    if somatic and ss != 'LOH':
+        return True
+    return False
+
+def decode_gt(fields, gt_index, columns):
+    ''' GT strings for the selected sample columns only, as a numpy array '''
+    values = np.array(fields, dtype=object)[columns]
+    if gt_index == 0:
+        return np.array([v.split(':', 1)[0] for v in values])
+    return np.array([(v.split(':') + [''] * (gt_index+1))[gt_index] for v in values])
+
+def carriers(gt, allele, n_alt):
+    ''' boolean array, True where the genotype contains allele (1-based ALT index) '''
+    if n_alt == 1: # biallelic: alleles are 0, 1 or .
+        return np.char.find(gt.astype(str), '1') >= 0
+
+    a = str(allele)
+    return np.array([a in g.replace('|', '/').split('/') for g in gt])
+
+class CohortCounts:
+    ''' per-sample Summary counts held as one (samples x categories) matrix per vtype '''
+    def __init__(self, samples):
+        self.samples = samples
+        self.counts  = {}
+        for vtype in ('SNV', 'INDEL'):
+            self.counts[vtype] = np.zeros((len(samples), len(vc.CAT_INDEX)), dtype=np.int64)
+
+    def add(self, vtype, catname, mask):
+        self.counts[vtype][:, vc.CAT_INDEX[catname]] += mask
+
+    def add_sample(self, vtype, catname, i):
+        self.counts[vtype][i, vc.CAT_INDEX[catname]] += 1
+
+    def summaries(self):
+        out = []
+        for i, sample in enumerate(self.samples):
+            for vtype in ('SNV', 'INDEL'):
+                s = vc.Summary()
+                s.info['vartype'] = vtype
+                s.info['sample']  = sample
+                s.counts = array.array('l', self.counts[vtype][i].tolist())
+                out.append(s)
+        return out
+
+def pass_name(p):
+    return 'pass' if p else 'fail'
+
+def som_name(s):
+    return 'somatic' if s else 'germline'
+
+def count_unmatched(counts, ref, alt, i, flags):
+    ''' a sample call with no cohort record at its position '''
+    passA, somA = flags
+    counts.add_sample(vtype_of(ref, alt), 'A_unmatched_' + pass_name(passA) + '_' + som_name(somA) + '_overall', i)
+
+def compare_cohort(cohort_vcf, samples, sample_vcfs, fai=None, verbose=False):
+    counts = CohortCounts(samples)
+    n = len(samples)
+
+    rank = fai_contigs(fai) if fai is not None else {}
+    opener = gzip.open if cohort_vcf.endswith('.gz') else open
+    columns = None
+    recnum = 0
+
+    stream = None # merged sample calls, next call is in nxt
+    nxt    = None
+    window = {}   # (chrom, pos, ref, alt) --> {sample index: (pass, somatic)} at window_key
+    window_key = None
+
+    for line in opener(cohort_vcf, 'rb'):
+        if line.startswith('##'):
+            if fai is None and header_contig(line) is not None:
+                rank.setdefault(header_contig(line), len(rank))
+            continue
+
+        fields = line.rstrip('\n').split('\t')
+
+        if line.startswith('#'):
+            header = fields[9:]
+            missing = [s for s in samples if s not in header]
+            if missing:
+                sys.exit("error: samples not in cohort VCF: " + ','.join(missing))
+            columns = np.array([header.index(s) for s in samples]) + 9
+            stream = heapq.merge(*[sample_calls(i, vcf_file, rank) for i, vcf_file in enumerate(sample_vcfs)])
+            nxt = next(stream, None)
+            continue
+
+        if not line.strip():
+            continue
+
+        recnum += 1
+        if verbose and recnum % 100000 == 0:
+            sys.stderr.write(str(recnum) + " cohort records, pos: " + fields[0] + ":" + fields[1] + "\n")
+
+        chrom, pos, ref, alts = fields[0], int(fields[1]), fields[3], fields[4].split(',')
+        passB = fields[6] in ('PASS', '.')
+        somB  = info_somatic(fields[7])
+
+        if chrom not in rank:
+            sys.exit("error: cohort contig " + chrom + " is not in " + (fai or "the cohort ##contig header lines") + (", give the reference .fai with -f" if fai is None else ""))
+        key = (rank[chrom], pos)
+        if key != window_key:
+            if window_key is not None and key < window_key:
+                sys.exit("error: " + cohort_vcf + " is not sorted in contig order at " + chrom + ":" + str(pos))
+
+            # calls left at the previous position matched no cohort allele
+            for (wchrom, wpos, wref, walt), wcalls in window.iteritems():
+                for i, flags in wcalls.iteritems():
+                    count_unmatched(counts, wref, walt, i, flags)
+            window = {}
+            window_key = key
+
+            # sample calls before this position are unmatched, calls at it form the new window
+            while nxt is not None and nxt[0] <= key:
+                ckey, cchrom, cpos, cref, calt, i, flags = nxt
+                if ckey == key:
+                    window.setdefault((cchrom, cpos, cref, calt), {})[i] = flags
+                else:
+                    count_unmatched(counts, cref, calt, i, flags)
+                nxt = next(stream, None)
+
+        fmt = fields[8].split(':') if len(fields) > 8 else []
+        if 'GT' not in fmt:
+            continue
+
+        gt = None # decoded on first use
+        for allele, alt in enumerate(alts, 1):
+            vtype = vtype_of(ref, alt)
+            if vtype is None:
+                continue
+
+            if gt is None:
+                gt = decode_gt(fields, fmt.index('GT'), columns)
+
+            carrier = carriers(gt, allele, len(alts))
+            called  = np.zeros(n, dtype=bool)
+            flags   = {}
+
+            for i, flag in window.pop((chrom, pos, ref, alt), {}).iteritems():
+                called[i] = True
+                flags.setdefault(flag, np.zeros(n, dtype=bool))[i] = True
+
+            # cohort genotypes not called by the sample
+            counts.add(vtype, 'B_unmatched_' + pass_name(passB) + '_' + som_name(somB) + '_overall', carrier & ~called)
+
+            for (passA, somA), mask in flags.iteritems():
+                matched = mask & carrier
+                counts.add(vtype, 'matched_' + pass_name(passA) + '_' + pass_name(passB) + '_' + som_name(somA) + '_' + som_name(somB) + '_overall', matched)
+                counts.add(vtype, 'A_unmatched_' + pass_name(passA) + '_' + som_name(somA) + '_overall', mask & ~carrier)
+
+    # sample calls at the last cohort position or after it
+    for (chrom, pos, ref, alt), wcalls in window.iteritems():
+        for i, flags in wcalls.iteritems():
+            count_unmatched(counts, ref, alt, i, flags)
+    while nxt is not None:
+        ckey, chrom, pos, ref, alt, i, flags = nxt
+        count_unmatched(counts, ref, alt, i, flags)
+        nxt = next(stream, None)
+
+    return counts
+
+def main(args):
+    samples = []
+    sample_vcfs = []
+
+    pairs = list(args.sample_vcf or [])
+    if args.sample_list is not None:
+        with open(args.sample_list, 'r') as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    pairs.append('='.join(line.strip().split()[:2]))
+
+    for pair in pairs:
+        sample, vcf_file = pair.split('=', 1)
+        samples.append(sample)
+        sample_vcfs.append(vcf_file)
+
+    if not samples:
+        sys.exit("error: no samples given, use -s <sample>=<vcf> and/or -l <sample list>")
+
+    counts = compare_cohort(args.cohort, samples, sample_vcfs, fai=args.fai, verbose=args.verbose)
+
+    if args.summary_outfile is None:
+        sys.stdout.write(vc.dumps_summaries(counts.summaries(), fmt=args.summary_format))
+    else:
+        vc.write_summaries(counts.summaries(), args.summary_outfile, fmt=args.summary_format)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare per-sample callsets to a multi-sample cohort VCF in one pass over the cohort')
+    parser.add_argument(metavar='<cohort_vcf>', dest='cohort', help='multi-sample VCF (.vcf or .vcf.gz)')
+    parser.add_argument('-s', '--sample', dest='sample_vcf', action='append', default=None, help='<sample name>=<VCF of calls for that sample>, may be repeated')
+    parser.add_argument('-l', '--samples', dest='sample_list', default=None, help='file with lines "<sample name> <VCF of calls>"')
+    parser.add_argument('-f', '--fai', dest='fai', default=None, help='.fai giving the contig order all inputs are sorted in (default: the cohort ##contig header lines)')
+    parser.add_argument('-u', '--summary', dest='summary_outfile', default=None, help='outfile for per-sample summaries (default stdout)')
+    parser.add_argument('--summary_format', dest='summary_format', default='tsv', choices=vc.SUMMARY_FORMATS, help='summary format (default tsv, one row per sample and vtype)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose mode for debugging')
+    args = parser.parse_args()
+    main(args)
@@ -1,16 +1,31 @@
 #!/usr/bin/env python
 
 import argparse
+import os
 import vcf
+import sys
+import random
+import itertools
 import pprint
 import numpy as np
 import scipy.stats as ss
 from os.path import basename
 from textwrap import wrap
+from multiprocessing import Pool
 
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import bgzf
+
+def open_vcf(vcf_file, threads=0):
+    ''' vcf.Reader, bgzipped input is inflated by a thread pool when threads > 0 '''
+    if threads > 0 and vcf_file.endswith('.gz') and bgzf.is_bgzf(vcf_file):
+        return vcf.Reader(fsock=bgzf.MmapBgzfReader(vcf_file, threads=threads), compressed=False)
+    return vcf.Reader(filename=vcf_file)
 
 def get_val(a):
     # is it iterable?
@@ -50,7 +65,59 @@ def somatic_in_format(rec):
         return True
     return False
 
+class ValueCollector:
+    ''' accumulates numeric values into typed numpy chunks instead of python lists
+        chunks start small and double up to maxchunk so rarely-seen tags stay cheap
+        if maxvalues is not None, at most maxvalues values are kept (uniform reservoir sample) '''
+    def __init__(self, maxvalues=None, minchunk=256, maxchunk=65536):
+        self.maxvalues = maxvalues
+        self.maxchunk  = maxchunk
+        self.chunks = []
+        self.buf    = np.empty(minchunk, dtype=np.float64)
+        self.nbuf   = 0
+        self.n      = 0 # number of values seen, including those not kept
+
+    def __len__(self):
+        return self.n
+
+    def flatten(self):
+        ''' concatenate chunks into a single buffer '''
+        if self.chunks:
+            self.chunks.append(self.buf[:self.nbuf])
+            self.buf  = np.concatenate(self.chunks)
+            self.nbuf = len(self.buf)
+            self.chunks = []
+
+    def append(self, value):
+        self.n += 1
+
+        if self.maxvalues is not None and self.n > self.maxvalues:
+            if self.chunks or self.nbuf < len(self.buf):
+                self.flatten()
+                self.buf = self.buf[:self.nbuf]
+            j = random.randint(0, self.n-1)
+            if j < self.maxvalues:
+                self.buf[j] = value
+            return
+
+        if self.nbuf == len(self.buf):
+            self.chunks.append(self.buf)
+            self.buf  = np.empty(min(2*len(self.buf), self.maxchunk), dtype=np.float64)
+            self.nbuf = 0
+
+        self.buf[self.nbuf] = value
+        self.nbuf += 1
+
+    def sorted_values(self):
+        ''' return kept values as a sorted numpy array, releases the chunks '''
+        self.flatten()
+        values = self.buf[:self.nbuf]
+        values.sort()
+        self.buf = values
+        return values
+
 def get_stats(args, h_vcf, shared_info_keys, shared_fmt_keys):
+    ''' single pass over h_vcf, returns ValueCollectors for INFO tags and FORMAT tags per sample '''
     info_vcf = {}
     fmt_vcf  = {}
 
@@ -60,19 +127,19 @@ def get_stats(args, h_vcf, shared_info_keys, shared_fmt_keys):
         vtype = args.vtype
 
     for k_info in shared_info_keys:
-        info_vcf[k_info] = []
+        info_vcf[k_info] = ValueCollector(maxvalues=args.maxvalues)
 
     for rec in h_vcf:
         selected = True
 
         if vtype == 'SNV' and (not rec.is_snp or (rec.is_snp and rec.INFO.get('VT') == 'LOH')):
-            output = False
+            selected = False
 
         if vtype == 'INDEL' and not rec.is_indel:
-            output = False
+            selected = False
 
         if vtype == 'SV' and not rec.is_sv:
-            output = False
+            selected = False
 
         if args.passonly and rec.FILTER:
             selected = False
@@ -80,18 +147,23 @@ def get_stats(args, h_vcf, shared_info_keys, shared_fmt_keys):
         if args.failonly and not rec.FILTER:
             selected = False
 
-        if args.somaticonly and not is_somatic(rec):
-            selected = False
+        if selected and (args.somaticonly or args.germlineonly):
+            somatic = is_somatic(rec)
+            if args.somaticonly and not somatic:
+                selected = False
 
-        if args.germlineonly and is_somatic(rec):
-            selected = False
+            if args.germlineonly and somatic:
+                selected = False
+
+        if not selected:
+            continue
 
         for k_info in shared_info_keys:
             if k_info in rec.INFO:
                 value = get_val(rec.INFO.get(k_info))
-                if selected and value is not None:
+                if value is not None:
                     info_vcf[k_info].append(value)
-        
+
         for sample in rec.samples:
             name = sample.sample
             fmt  = sample.data._asdict() # fmt is a collections.namedtuple
@@ -100,50 +172,130 @@ def get_stats(args, h_vcf, shared_info_keys, shared_fmt_keys):
 
             for k_fmt in shared_fmt_keys:
                 if k_fmt in fmt:
-                    if k_fmt not in fmt_vcf[name]:
-                        fmt_vcf[name][k_fmt] = []
                     value = get_val(fmt[k_fmt])
-                    if selected and value is not None:
+                    if value is not None:
+                        if k_fmt not in fmt_vcf[name]:
+                            fmt_vcf[name][k_fmt] = ValueCollector(maxvalues=args.maxvalues)
                         fmt_vcf[name][k_fmt].append(value)
 
     return info_vcf, fmt_vcf
 
-def cutoffs(tp, fp):
-    tp.sort()
-    fp.sort()
+def comparable(a, b):
+    ''' a and b are sorted arrays, only compare things worth comparing '''
+    return len(a) > 0 and len(b) > 0 and a[0] != a[-1] and b[0] != b[-1]
+
+def mannwhitneyu(x, y):
+    ''' Mann-Whitney U for sorted arrays x and y in O(n log n), returns (smaller U, one-sided p)
+        same normal approximation (tie and continuity corrected) as scipy.stats.mannwhitneyu '''
+    n1 = len(x)
+    n2 = len(y)
+
+    # U counts pairs where x < y, ties count half
+    lo = np.searchsorted(x, y, side='left')
+    hi = np.searchsorted(x, y, side='right')
+    u1 = float(lo.sum()) + 0.5*float((hi-lo).sum())
+    u2 = n1*n2 - u1
+
+    # tie correction from run lengths of the merged values
+    merged = np.concatenate((x, y))
+    merged.sort(kind='mergesort')
+    bounds = np.concatenate(([0], np.nonzero(np.diff(merged))[0] + 1, [len(merged)]))
+    t = np.diff(bounds).astype(np.float64)
+    N = float(n1 + n2)
+    T = 1.0 - (t**3 - t).sum() / (N**3 - N)
+    if T == 0:
+        raise ValueError('All numbers are identical in mannwhitneyu')
+
+    sd = np.sqrt(T*n1*n2*(N+1)/12.0)
+    z  = abs((max(u1,u2) - 0.5 - n1*n2/2.0) / sd)
+    return min(u1,u2), ss.norm.sf(z)
+
+def first_gte(a, v):
+    ''' first value in sorted a >= v, last value in a if none '''
+    i = np.searchsorted(a, v, side='left')
+    if i < len(a):
+        return a[i]
+    return a[-1]
+
+def last_lte(a, v):
+    ''' last value in sorted a <= v, first value in a if none '''
+    i = np.searchsorted(a, v, side='right') - 1
+    if i >= 0:
+        return a[i]
+    return a[0]
 
+def cutoffs(tp, fp):
+    ''' tp and fp are sorted numpy arrays '''
     min_range = None
     max_range = None
 
-    if min(tp) < min(fp):
-        for i in tp:
-            if i >= min(fp):
-                break
-        max_range = i
-
-    if min(fp) < min(tp):
-        for i in fp:
-            if i >= min(tp):
-                break
-        min_range = i
-
-    if max(tp) > max(fp):
-        for i in tp[::-1]:
-            if i <= max(fp):
-                break
-        min_range = i
-
-    if max(fp) > max(tp):
-        for i in fp[::-1]:
-            if i <= max(tp):
-                break
-        max_range = i
+    if tp[0] < fp[0]:
+        max_range = first_gte(tp, fp[0])
+
+    if fp[0] < tp[0]:
+        min_range = first_gte(fp, tp[0])
+
+    if tp[-1] > fp[-1]:
+        min_range = last_lte(tp, fp[-1])
+
+    if fp[-1] > tp[-1]:
+        max_range = last_lte(fp, tp[-1])
 
     return min_range, max_range
 
+def analyze_tag(job):
+    ''' Mann-Whitney U, cutoffs and histograms for one tag, runs in a worker process
+        job is (field, tag, sample_name or None, description, sorted vcf1 values, sorted vcf2 values, opts) '''
+    field, tag, sample_name, desc, vcf1_values, vcf2_values, opts = job
+    vcf_TP, png, plotname, label1, label2 = opts
+
+    mwu = mannwhitneyu(vcf1_values, vcf2_values)
+    mwstring = field + " (" + tag + ") Mann-Whitney U: " + "%0.1f" % mwu[0] + " P=" + "%0.3f" % mwu[1]
+
+    cuts = None
+    if vcf_TP is not None and mwu[1] < 0.05:
+        if vcf_TP == 1:
+            cuts = cutoffs(vcf1_values, vcf2_values)
+        elif vcf_TP == 2:
+            cuts = cutoffs(vcf2_values, vcf1_values)
+
+    # histograms are small, so only these (not the values) go back to the parent
+    range = (min(vcf1_values[0], vcf2_values[0]), max(vcf1_values[-1], vcf2_values[-1]))
+    hist1, edges = np.histogram(vcf1_values, bins=20, range=range, density=True)
+    hist2, edges = np.histogram(vcf2_values, bins=20, range=range, density=True)
+
+    result = {'field': field, 'tag': tag, 'sample': sample_name, 'desc': desc,
+              'mwstring': mwstring, 'mwu': mwu, 'cutoffs': cuts,
+              'edges': edges, 'hist1': hist1, 'hist2': hist2}
+
+    if png:
+        fig = plot_result(result, label1, label2)
+        if sample_name is None:
+            plt.savefig(plotname + "_INFO_" + tag + "_" + ".png", bbox_inches='tight')
+        else:
+            plt.savefig(plotname + "_FORMAT_" + tag + "_" + sample_name + ".png", bbox_inches='tight')
+        plt.close(fig)
+
+    return result
+
+def plot_result(result, label1, label2):
+    ''' draw overlaid histograms for a result from analyze_tag, returns the figure '''
+    title = result['field'] + ": " + result['tag']
+    if result['sample'] is not None:
+        title += " " + result['sample']
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    ax.set_title(title + "\n(" + "\n".join(wrap(result['desc'])) + ")" + "\n" + result['mwstring'])
+    edges = result['edges']
+    ax.bar(edges[:-1], result['hist1'], width=np.diff(edges), align='edge', alpha=0.3, label=label1)
+    ax.bar(edges[:-1], result['hist2'], width=np.diff(edges), align='edge', alpha=0.3, label=label2)
+    ax.legend()
+    return fig
+
 def main(args):
-    h_vcf1 = vcf.Reader(filename=args.vcf[0])
-    h_vcf2 = vcf.Reader(filename=args.vcf[1])
+    h_vcf1 = open_vcf(args.vcf[0], threads=args.threads)
+    h_vcf2 = open_vcf(args.vcf[1], threads=args.threads)
 
     if args.failonly == args.passonly == True:
         sys.exit("Error: specifying both -f/--failonly and -p/--passonly yields no results.")
@@ -169,91 +321,81 @@ def main(args):
             vcf_TP = 2 
             vcf_FP = 1
 
+    # build one job per tag, sorted so output does not depend on dict order
+    cut_TP = None
+    if args.filteroutfile is not None:
+        cut_TP = vcf_TP
+
+    opts = (cut_TP, args.plots == 'png', args.plotname, args.label1, args.label2)
+    jobs = []
+
+    for tag in sorted(info_vcf1.keys()):
+        vcf1_values = info_vcf1[tag].sorted_values()
+        vcf2_values = info_vcf2[tag].sorted_values()
+
+        # only compare things worth comparing
+        if comparable(vcf1_values, vcf2_values):
+            jobs.append(('INFO', tag, None, h_vcf1.infos[tag].desc, vcf1_values, vcf2_values, opts))
+
+    for sample_name in sorted(fmt_vcf1.keys()):
+        for tag in sorted(fmt_vcf1[sample_name].keys()):
+            if tag not in fmt_vcf2.get(sample_name, {}):
+                continue
+
+            vcf1_values = fmt_vcf1[sample_name][tag].sorted_values()
+            vcf2_values = fmt_vcf2[sample_name][tag].sorted_values()
+
+            if comparable(vcf1_values, vcf2_values):
+                jobs.append(('FORMAT', tag, sample_name, h_vcf1.formats[tag].desc, vcf1_values, vcf2_values, opts))
+
+    pool = None
+    results = None
+    if args.procs > 1 and len(jobs) > 1:
+        pool = Pool(processes=args.procs)
+        results = pool.imap(analyze_tag, jobs)
+    else:
+        results = itertools.imap(analyze_tag, jobs)
+
     filtout = None
     if args.filteroutfile is not None and 'TP' in labels and 'FP' in labels:
         filtout = open(args.filteroutfile, 'w')
         print "filterout:", args.filteroutfile
 
-    for tag, values in info_vcf1.iteritems():
-        # only compare things worth comparing
-        if values and info_vcf2[tag] and len(set(values)) > 1 and len(set(info_vcf2[tag])) > 1:
-            vcf1_values = np.asarray(values)
-            vcf2_values = np.asarray(info_vcf2[tag])
-
-            #print '-'*60
-            #print 'INFO', tag, ':', h_vcf1.infos[tag].desc
-            #print basename(args.vcf[0]), 'INFO', tag, ','.join(map(str, vcf1_values))
-            #print basename(args.vcf[1]), 'INFO', tag, ','.join(map(str, vcf2_values))
-            mwu = ss.mannwhitneyu(vcf1_values, vcf2_values)
-            mwstring = "INFO (" + tag + ") Mann-Whitney U: " + "%0.1f" % mwu[0] + " P=" + "%0.3f" % mwu[1]
-            print mwstring 
-
-            if filtout is not None and mwu[1] < 0.05:
-                assert vcf_TP != vcf_FP
-                mincut = None
-                maxcut = None
-                if vcf_TP == 1:
-                    (mincut, maxcut) = cutoffs(vcf1_values, vcf2_values)
-                elif vcf_TP == 2:
-                    (mincut, maxcut) = cutoffs(vcf2_values, vcf1_values)
-
-                print "vcf_TP, vcf_FP:", vcf_TP, vcf_FP
-                print "mincut, maxcut:", mincut, maxcut
+    pdf = None
+    if args.plots == 'pdf':
+        pdf = PdfPages(args.plotname + ".pdf")
+        print "plots:", args.plotname + ".pdf"
+
+    # results come back in job order
+    for result in results:
+        print result['mwstring']
+
+        if result['cutoffs'] is not None:
+            mincut, maxcut = result['cutoffs']
+            print "vcf_TP, vcf_FP:", vcf_TP, vcf_FP
+            print "mincut, maxcut:", mincut, maxcut
+
+            if filtout is not None:
+                sample = ()
+                if result['sample'] is not None:
+                    sample = (result['sample'],)
 
                 if mincut is not None:
-                    filtout.write(' '.join(('INFO', tag, 'LTE', str(float(mincut)))) + "\n")
+                    filtout.write(' '.join((result['field'], result['tag'], 'LTE', str(float(mincut))) + sample) + "\n")
                 if maxcut is not None:
-                    filtout.write(' '.join(('INFO', tag, 'GT', str(float(maxcut)))) + "\n")
-
-            fig = plt.figure()
-            ax = fig.add_subplot(111)
-            ax.set_title("INFO: " + tag + "\n(" + "\n".join(wrap(h_vcf1.infos[tag].desc)) + ")" + "\n" + mwstring)
-            range = (min(vcf1_values.min(), vcf2_values.min()), max(vcf1_values.max(), vcf2_values.max()))
-            ax.hist(vcf1_values, range=range, bins=20, alpha=0.3, label=args.label1, normed=True)
-            ax.hist(vcf2_values, range=range, bins=20, alpha=0.3, label=args.label2, normed=True)
-            ax.legend()
-            plt.savefig(args.plotname + "_INFO_" + tag + "_" + ".png", bbox_inches='tight')
-
-    for sample_name, fmt in fmt_vcf1.iteritems():
-        for tag, values in fmt.iteritems():
-            if values and fmt_vcf2[sample_name][tag] and len(set(values)) > 1 and len(set(fmt_vcf2[sample_name][tag])) > 1:
-                vcf1_values = np.asarray(values)
-                vcf2_values = np.asarray(fmt_vcf2[sample_name][tag])
-
-                #print '-'*60
-                #print 'FORMAT', tag, sample_name, ':', h_vcf1.formats[tag].desc
-                #print basename(args.vcf[0]), 'FORMAT', sample_name, tag, ','.join(map(str, vcf1_values))
-                #print basename(args.vcf[1]), 'FORMAT', sample_name, tag, ','.join(map(str, vcf2_values))
-                mwu = ss.mannwhitneyu(vcf1_values, vcf2_values)
-                mwstring = "FORMAT (" + tag + ") Mann-Whitney U: " + "%0.1f" % mwu[0] + " P=" + "%0.3f" % mwu[1]
-                print mwstring 
-
-
-                if filtout is not None and mwu[1] < 0.05:
-                    assert vcf_TP != vcf_FP
-                    mincut = None
-                    maxcut = None
-                    if vcf_TP == 1:
-                        (mincut, maxcut) = cutoffs(vcf1_values, vcf2_values)
-                    elif vcf_TP == 2:
-                        (mincut, maxcut) = cutoffs(vcf2_values, vcf1_values)
-
-                    print "vcf_TP, vcf_FP:", vcf_TP, vcf_FP
-                    print "mincut, maxcut:", mincut, maxcut
-
-                    if mincut is not None:
-                        filtout.write(' '.join(('FORMAT', tag, 'LTE', str(float(mincut)), sample_name)) + "\n")
-                    if maxcut is not None:
-                        filtout.write(' '.join(('FORMAT', tag, 'GT', str(float(maxcut)), sample_name)) + "\n")
-
-                fig = plt.figure()
-                ax = fig.add_subplot(111)
-                ax.set_title("FORMAT: " + tag + " " + sample_name + "\n(" + "\n".join(wrap(h_vcf1.formats[tag].desc)) + ")" + "\n" + mwstring) 
-                range = (min(vcf1_values.min(), vcf2_values.min()), max(vcf1_values.max(), vcf2_values.max()))
-                ax.hist(vcf1_values, range=range, bins=20, alpha=0.3, label=args.label1, normed=True)
-                ax.hist(vcf2_values, range=range, bins=20, alpha=0.3, label=args.label2, normed=True)
-                ax.legend()
-                plt.savefig(args.plotname + "_FORMAT_" + tag + "_" + sample_name + ".png", bbox_inches='tight')
+                    filtout.write(' '.join((result['field'], result['tag'], 'GT', str(float(maxcut))) + sample) + "\n")
+
+        if pdf is not None:
+            fig = plot_result(result, args.label1, args.label2)
+            pdf.savefig(fig, bbox_inches='tight')
+            plt.close(fig)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if pdf is not None:
+        pdf.close()
 
     if filtout is not None:
         filtout.close()
@@ -265,6 +407,10 @@ if __name__ == '__main__':
     parser.add_argument('--label2', dest='label2', default='vcf2', help='label for vcf2')
     parser.add_argument('--name', dest='plotname', default='plot', help='basename for plots')
     parser.add_argument('--filterout', dest='filteroutfile', default=None, help='output filters for filtervcf.py, labels must be TP and FP') 
+    parser.add_argument('--plots', dest='plots', default='png', choices=('png', 'pdf', 'none'), help='png: one plot per tag (default), pdf: all plots in <name>.pdf, none: skip plotting')
+    parser.add_argument('-j', '--procs', dest='procs', type=int, default=1, help='number of processes for per-tag statistics and plotting')
+    parser.add_argument('--threads', dest='threads', type=int, default=0, help='threads decompressing each bgzipped VCF (default 0, single-threaded)')
+    parser.add_argument('--maxvalues', dest='maxvalues', type=int, default=None, help='keep at most this many values per tag (uniform sample), bounds memory on large inputs')
     parser.add_argument('-t', '--vtype', dest='vtype', default=None, help='only include variants of vtype where vtype is SNV, INDEL, or SV')
     parser.add_argument('-p', '--passonly', action='store_true', default=False, help='only return PASS records')
     parser.add_argument('-f', '--failonly', action='store_true', default=False, help='only return non-PASS records')
@@ -2,90 +2,305 @@
 
 import vcf
 import sys
+import os
 import traceback
 import gzip
+import argparse
+from multiprocessing import Pool
 
-def context(vcf, recnum):
-    vcf_h = None
-    ctbuf = 5
-    if vcf.endswith('.gz'):
-        vcf_h = gzip.open(vcf, 'rb')
-    else:
-        vcf_h = open(vcf, 'r')
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import bgzf
+
+ctbuf = 5 # records of context on either side of a problem
+
+def index_name(vcf):
+    return vcf + '.ridx'
+
+def write_index(vcf, index, stride):
+    ''' sidecar index: header line then one "recnum offset" line per stride records
+        offsets are BGZF virtual offsets (or byte offsets for uncompressed files)
+        returns False if the sidecar could not be written (e.g. read-only directory) '''
+    st = os.stat(vcf)
+    try:
+        with open(index_name(vcf), 'w') as out:
+            out.write(' '.join(('#ridx', str(stride), str(st.st_size), str(int(st.st_mtime)))) + '\n')
+            for recnum, offset in index:
+                out.write(str(recnum) + ' ' + str(offset) + '\n')
+    except (IOError, OSError) as e:
+        sys.stderr.write("could not write index " + index_name(vcf) + ": " + str(e) + ", continuing without it\n")
+        try:
+            os.remove(index_name(vcf)) # don't leave a truncated sidecar behind
+        except OSError:
+            pass
+        return False
+    return True
 
+def read_index(vcf):
+    ''' return (stride, [(recnum, offset), ...]) or None if index is missing or stale '''
+    if not os.path.exists(index_name(vcf)):
+        return None
+
+    st = os.stat(vcf)
+    with open(index_name(vcf), 'r') as idx:
+        c = idx.readline().strip().split()
+        if len(c) != 4 or c[0] != '#ridx' or int(c[2]) != st.st_size or int(c[3]) != int(st.st_mtime):
+            return None
+
+        index = []
+        for line in idx:
+            recnum, offset = line.strip().split()
+            index.append((int(recnum), int(offset)))
+
+        return int(c[1]), index
+
+def build_index(vcf, stride=1000, threads=0, save=False):
+    ''' scan records (without parsing them) and record the offset of every stride'th one
+        save: also write the .ridx sidecar next to vcf '''
+    reader = bgzf.open_reader(vcf, threads=threads)
+    assert reader is not None, "random access needs bgzip (not gzip) compression"
+    bgzf.header_lines(reader)
+
+    index = []
     n = 0
-    for line in vcf_h:
-        if not line.startswith('#'):
+    while True:
+        offset = reader.tell()
+        line = reader.readline()
+        if not line:
+            break
+        if line.strip() and not line.startswith('#'):
             n += 1
-            if n >= recnum-ctbuf and n <= recnum+ctbuf:
-                print n,':',line.strip()
-                found = True
-            if n > recnum + ctbuf:
-                vcf_h.close()
-                return 
- 
+            if n % stride == 1 or stride == 1:
+                index.append((n, offset))
 
-if len(sys.argv) == 2:
-    assert sys.argv[1].endswith('.vcf') or sys.argv[1].endswith('.vcf.gz')
+    reader.close()
+    if save:
+        write_index(vcf, index, stride)
+    return stride, index
 
-    vcfin = vcf.Reader(filename=sys.argv[1])
+def get_index(vcf, stride=1000, threads=0, save=False):
+    ''' the .ridx sidecar if there is a current one, otherwise build the index (and save it if asked) '''
+    idx = read_index(vcf)
+    if idx is None:
+        idx = build_index(vcf, stride=stride, threads=threads, save=save)
+    return idx
 
-    recnum = 0
-    try:
-        use_info_somatic = False
-        use_info_ss = False
-        use_info_loh = False
-        use_fmt_ss = False
-        use_filter_somatic = False
-        indel_count = 0
-        snv_count = 0
-        sv_count = 0
-
-        for rec in vcfin:
-            recnum += 1
-            if rec.FILTER == 'GERMLINE' or rec.FILTER == 'SOMATIC':
-                use_filter_somatic = True
-            if rec.INFO.get('SOMATIC'):
-                use_info_somatic=True
-            if str(rec.INFO.get('SS')).upper() == 'SOMATIC':
-                use_info_ss=True
-            if str(rec.INFO.get('SS')).upper() == 'LOH':
-                use_info_loh=True
-
-            assert not (rec.is_snp and rec.is_indel and rec.is_sv)
-            if rec.is_snp:
-                snv_count += 1
-            if rec.is_indel:
-                indel_count += 1
-            if rec.is_sv:
-                sv_count += 1
-
-            for call in rec.samples:
-                data = call.data
-                if 'SS' in data._fields:
-                    use_fmt_ss = True
-
-        print "Total records:",recnum
-        print "-"*60
-        print "uses INFO/SOMATIC:", use_info_somatic
-        print "uses INFO/SS=Somatic/Germline:", use_info_ss
-        print "uses INFO/SS=LOH:",use_info_loh
-        print "uses FORMAT/SS=0,1,2,...:", use_fmt_ss
-        print "uses FILTER/SOMATIC (please correct if true, filter should be PASS or filter name):", use_filter_somatic
-        print "-"*60
-        print "SNV count:",snv_count
-        print "INDEL count:",indel_count
-        print "SV count:",sv_count
-        print "-"*60
-
-    except:
+def indexed_records(reader, offset):
+    ''' yield data lines from offset, skipping blank lines like vcf.Reader does '''
+    reader.seek(offset)
+    for line in reader:
+        if line.strip() and not line.startswith('#'):
+            yield line
+
+def context(vcf, recnum, idx=None):
+    ''' print the records around recnum; idx is (stride, index) if the caller already has one '''
+    reader = None
+    if not vcf.endswith('.gz') or bgzf.is_bgzf(vcf):
+        reader = bgzf.open_reader(vcf)
+
+    if reader is None: # plain gzip, have to scan from the start
+        vcf_h = gzip.open(vcf, 'rb')
+        n = 0
+        for line in vcf_h:
+            if not line.startswith('#'):
+                n += 1
+                if n >= recnum-ctbuf and n <= recnum+ctbuf:
+                    print n,':',line.strip()
+                if n > recnum + ctbuf:
+                    break
+        vcf_h.close()
+        return
+
+    stride, index = idx if idx is not None else get_index(vcf)
+
+    # last indexed record at or before the start of the context
+    n, offset = 1, None
+    for idx_recnum, idx_offset in index:
+        if idx_recnum > max(1, recnum-ctbuf):
+            break
+        n, offset = idx_recnum, idx_offset
+
+    if offset is None:
+        return
+
+    for line in indexed_records(reader, offset):
+        if n >= recnum-ctbuf:
+            print n,':',line.strip()
+        if n >= recnum + ctbuf:
+            break
+        n += 1
+
+    reader.close()
+
+class Stats:
+    ''' what a VCF uses to encode somatic status, and variant counts '''
+    def __init__(self):
+        self.recnum = 0
+        self.use_info_somatic = False
+        self.use_info_ss = False
+        self.use_info_loh = False
+        self.use_fmt_ss = False
+        self.use_filter_somatic = False
+        self.indel_count = 0
+        self.snv_count = 0
+        self.sv_count = 0
+        self.problems = [] # (recnum, traceback)
+
+    def count(self, rec):
+        if rec.FILTER == 'GERMLINE' or rec.FILTER == 'SOMATIC':
+            self.use_filter_somatic = True
+        if rec.INFO.get('SOMATIC'):
+            self.use_info_somatic=True
+        if str(rec.INFO.get('SS')).upper() == 'SOMATIC':
+            self.use_info_ss=True
+        if str(rec.INFO.get('SS')).upper() == 'LOH':
+            self.use_info_loh=True
+
+        assert not (rec.is_snp and rec.is_indel and rec.is_sv)
+        if rec.is_snp:
+            self.snv_count += 1
+        if rec.is_indel:
+            self.indel_count += 1
+        if rec.is_sv:
+            self.sv_count += 1
+
+        for call in rec.samples:
+            data = call.data
+            if 'SS' in data._fields:
+                self.use_fmt_ss = True
+
+    def add(self, other):
+        self.recnum += other.recnum
+        for flag in ('use_info_somatic', 'use_info_ss', 'use_info_loh', 'use_fmt_ss', 'use_filter_somatic'):
+            setattr(self, flag, getattr(self, flag) or getattr(other, flag))
+        self.indel_count += other.indel_count
+        self.snv_count += other.snv_count
+        self.sv_count += other.sv_count
+        self.problems.extend(other.problems)
+
+def validate(vcfin, stats, first_recnum=1):
+    ''' parse every record from vcfin, record problems and keep going '''
+    recnum = first_recnum - 1
+    while True:
         recnum += 1
-        print "parse error in VCF on line",recnum
+        try:
+            rec = vcfin.next()
+        except StopIteration:
+            break
+        except:
+            stats.problems.append((recnum, traceback.format_exc()))
+            continue
+
+        stats.recnum += 1
+        try:
+            stats.count(rec)
+        except:
+            stats.problems.append((recnum, traceback.format_exc()))
+
+def validate_chunk(job):
+    ''' validate nrecs records starting at offset, runs in a worker process '''
+    vcf_file, first_recnum, offset, nrecs = job
+    reader = bgzf.open_reader(vcf_file)
+    header = bgzf.header_lines(reader)
+
+    lines = []
+    for line in indexed_records(reader, offset):
+        lines.append(line)
+        if nrecs is not None and len(lines) == nrecs:
+            break
+    reader.close()
+
+    stats = Stats()
+    validate(vcf.Reader(fsock=iter(header + lines), compressed=False), stats, first_recnum=first_recnum)
+    return stats
+
+def tap_index(reader, index, stride):
+    ''' yield lines from reader, recording the offset of every stride'th record in index '''
+    n = 0
+    while True:
+        offset = reader.tell()
+        line = reader.readline()
+        if not line:
+            break
+        if line.strip() and not line.startswith('#'):
+            n += 1
+            if n % stride == 1 or stride == 1:
+                index.append((n, offset))
+        yield line
+
+def main(args):
+    assert args.vcf.endswith('.vcf') or args.vcf.endswith('.vcf.gz')
+
+    stats = Stats()
+    reader = None
+    idx = None
+    if not args.noindex:
+        reader = bgzf.open_reader(args.vcf, threads=args.threads)
+
+    if reader is not None and args.procs > 1:
+        # make sure the header parses before splitting up the records
+        vcf.Reader(fsock=iter(bgzf.header_lines(reader)), compressed=False)
+        reader.close()
+
+        idx = get_index(args.vcf, stride=args.stride, threads=args.threads, save=args.index)
+        stride, index = idx
+        jobs = []
+        for recnum, offset in index:
+            jobs.append((args.vcf, recnum, offset, stride))
+        if jobs: # last chunk runs to the end of the file
+            jobs[-1] = jobs[-1][:3] + (None,)
+
+        pool = Pool(processes=args.procs)
+        for chunk_stats in pool.imap(validate_chunk, jobs):
+            stats.add(chunk_stats)
+        pool.close()
+        pool.join()
+
+    elif reader is not None:
+        # serial: build the index on the way through, context() uses it for problem records
+        index = []
+        vcfin = vcf.Reader(fsock=tap_index(reader, index, args.stride), compressed=False)
+        validate(vcfin, stats)
+        reader.close()
+        idx = (args.stride, index)
+        if args.index:
+            write_index(args.vcf, index, args.stride)
+
+    else:
+        validate(vcf.Reader(filename=args.vcf), stats)
+
+    print "Total records:",stats.recnum
+    print "-"*60
+    print "uses INFO/SOMATIC:", stats.use_info_somatic
+    print "uses INFO/SS=Somatic/Germline:", stats.use_info_ss
+    print "uses INFO/SS=LOH:",stats.use_info_loh
+    print "uses FORMAT/SS=0,1,2,...:", stats.use_fmt_ss
+    print "uses FILTER/SOMATIC (please correct if true, filter should be PASS or filter name):", stats.use_filter_somatic
+    print "-"*60
+    print "SNV count:",stats.snv_count
+    print "INDEL count:",stats.indel_count
+    print "SV count:",stats.sv_count
+    print "-"*60
+
+    stats.problems.sort()
+    if stats.problems:
+        print len(stats.problems),"problem record(s)"
+
+    for recnum, tb in stats.problems:
+        print "parse error in VCF on record",recnum
         print '-'*60
-        traceback.print_exc(file=sys.stdout)
+        sys.stdout.write(tb)
         print '-'*60
         print "context:"
-        context(sys.argv[1], recnum)
+        context(args.vcf, recnum, idx)
+        print '-'*60
 
-else:
-    print "usage:",sys.argv[0],"<vcf or vcf.gz>"
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that a VCF parses and report how it encodes somatic status')
+    parser.add_argument(metavar='<vcf or vcf.gz>', dest='vcf', help='VCF file')
+    parser.add_argument('-p', '--procs', dest='procs', type=int, default=1, help='validate chunks of records in parallel (needs bgzip compression or plain text)')
+    parser.add_argument('--stride', dest='stride', type=int, default=1000, help='records between entries in the .ridx sidecar index (default 1000)')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=0, help='threads decompressing bgzip blocks when reading serially or building the index (default 0)')
+    parser.add_argument('--index', action='store_true', default=False, help='save the record index as a .ridx sidecar next to the VCF, for faster reruns (an existing current sidecar is always used)')
+    parser.add_argument('--noindex', action='store_true', default=False, help='do not build or use the record index')
+    args = parser.parse_args()
+    main(args)
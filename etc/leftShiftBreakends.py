@@ -16,11 +16,14 @@ import vcf
 import sys
 import string
 import argparse
+from multiprocessing import Pool
 
 
+RC_TABLE = string.maketrans("atgcATGC","tacgTACG")
+
 def rc(seq):
     ''' reverse complement '''
-    seq = seq.translate(string.maketrans("atgcATGC","tacgTACG"))
+    seq = seq.translate(RC_TABLE)
     return seq[::-1] # reverse
 
 
@@ -75,79 +78,129 @@ def fetch_bnd_seq(rec, bnd, ref, leftwindow, rightwindow, verbose=False):
             sys.stderr.write(bnd_seq + "|" + mate_seq + "\n")
         return bnd_seq + mate_seq 
 
-def step_left(rec,bnd):
-    ''' shift the breakend left on both sides '''
-    bnd_seq_right  = bnd.orientation # get breakend seq to right?
-    mate_seq_right = bnd.remoteOrientation # get mate seq to right?
-
-    mate_flip = bnd_seq_right == mate_seq_right
-
-    if mate_flip: # shift mate right if reverse complementing
-        rec.POS -= 1
-        bnd.pos += 1
-    else:
-        rec.POS -= 1
-        bnd.pos -= 1
+def homology_len(ref, chrom, pos, mate_chrom, mate_pos, mate_flip, window=64):
+    '''
+    number of positions a breakend can be shifted left without changing the junction sequence
+
+    Stepping left by k moves POS back by k and the mate back by k (or forward by k if the
+    mate is reverse complemented). In every orientation the junction stays the same iff
+    ref[pos-k:pos] on the breakend side equals ref[mate_pos-k:mate_pos] on the mate side
+    (rc(ref[mate_pos:mate_pos+k]) if flipped), so the shift is the length of the common
+    suffix of those two sequences. Each side is fetched once per window, and the window
+    doubles until a mismatch (or the start of a chromosome) is found.
+    '''
+    shift = 0
+    while True:
+        w = min(window, pos - shift)
+        if not mate_flip:
+            w = min(w, mate_pos - shift)
+        if w <= 0:
+            return shift
+
+        bnd_seq = ref.fetch(chrom, pos-shift-w, pos-shift)
 
-    return rec,bnd
+        if mate_flip:
+            mate_seq = rc(ref.fetch(mate_chrom, mate_pos+shift, mate_pos+shift+w))
+        else:
+            mate_seq = ref.fetch(mate_chrom, mate_pos-shift-w, mate_pos-shift)
 
-def step_right(rec,bnd):
-    ''' shift the breakend right on both sides '''
-    bnd_seq_right  = bnd.orientation # get breakend seq to right?
-    mate_seq_right = bnd.remoteOrientation # get mate seq to right?
+        n = min(len(bnd_seq), len(mate_seq))
+        if n == 0:
+            return shift
 
-    mate_flip = bnd_seq_right == mate_seq_right
+        # scan outward from the junction
+        i = 1
+        while i <= n and bnd_seq[-i] == mate_seq[-i]:
+            i += 1
+        shift += i-1
 
-    if mate_flip: # shift mate right if reverse complementing
-        rec.POS += 1
-        bnd.pos -= 1
-    else:
-        rec.POS += 1
-        bnd.pos += 1
+        if i <= n or n < w:
+            return shift
 
-    return rec,bnd
+        window *= 2
 
 def shift_bnd(rec, ref, verbose=False):
     ''' shifts precise breakend record (rec) to left if possible 
         ref is a pysam.Fastafile handle to a ref genome '''
     bnd = rec.ALT[0]
-    # these could pose a problem... (initial window sizes)
-    l_win = 50
-    r_win = 50
+
+    mate_flip = bnd.orientation == bnd.remoteOrientation
 
     if verbose:
         sys.stderr.write(" ".join(("Original:",str(rec),str(bnd),"\n")))
-    orig = fetch_bnd_seq(rec, bnd, ref, l_win, r_win, verbose)
+        fetch_bnd_seq(rec, bnd, ref, 50, 50, verbose)
 
-    # keep shifting left until the junctions are no longer equivalent
-    while True: 
-        l_win -= 1
-        r_win += 1
+    shift = homology_len(ref, rec.CHROM, rec.POS, bnd.chr, bnd.pos, mate_flip)
 
-        rec, bnd = step_left(rec, bnd)
-        if orig != fetch_bnd_seq(rec, bnd, ref, l_win, r_win, verbose):
-            break
-
-    l_win += 1
-    r_win -= 1
-    rec, bnd = step_right(rec, bnd)
-    assert orig == fetch_bnd_seq(rec, bnd, ref, l_win, r_win, verbose)
+    rec.POS -= shift
+    if mate_flip: # shift mate right if reverse complementing
+        bnd.pos += shift
+    else:
+        bnd.pos -= shift
 
     if verbose:
-        sys.stderr.write(" ".join(("Shifted:",str(rec),str(bnd),"\n\n"))) 
+        sys.stderr.write(" ".join(("Shifted:",str(rec),str(bnd),"\n")))
+        fetch_bnd_seq(rec, bnd, ref, 50, 50, verbose)
+        sys.stderr.write("\n")
 
     return rec
 
+def shift_chrom(job):
+    ''' compute shifts for the precise breakends on one chromosome, runs in a worker process
+        job is (ref_fasta, [(recnum, chrom, pos, mate_chrom, mate_pos, mate_flip), ...])
+        returns list of (recnum, shift) '''
+    ref_fasta, bnds = job
+    ref = pysam.Fastafile(ref_fasta)
+
+    shifts = []
+    for recnum, chrom, pos, mate_chrom, mate_pos, mate_flip in bnds:
+        shifts.append((recnum, homology_len(ref, chrom, pos, mate_chrom, mate_pos, mate_flip)))
+
+    return shifts
+
+def is_precise_bnd(rec):
+    return rec.is_sv and 'IMPRECISE' not in rec.INFO
+
+def open_vcf(filename):
+    if filename.endswith('.gz'):
+        return vcf.Reader(filename=filename, compressed=True)
+    return vcf.Reader(filename=filename)
+
+def parallel_shifts(args):
+    ''' first pass over the input: collect precise breakends by chromosome and compute
+        their shifts in a process pool, returns dict of recnum --> shift '''
+    by_chrom = {}
+    recnum = 0
+    for rec in open_vcf(args.vcf_infile[0]):
+        if is_precise_bnd(rec):
+            bnd = rec.ALT[0]
+            mate_flip = bnd.orientation == bnd.remoteOrientation
+            by_chrom.setdefault(rec.CHROM, []).append((recnum, rec.CHROM, rec.POS, bnd.chr, bnd.pos, mate_flip))
+        recnum += 1
+
+    # largest chromosomes first so stragglers are short
+    jobs = [(args.ref_fasta, bnds) for bnds in sorted(by_chrom.values(), key=len, reverse=True)]
+
+    shifts = {}
+    pool = Pool(processes=int(args.procs))
+    for chrom_shifts in pool.imap_unordered(shift_chrom, jobs):
+        shifts.update(chrom_shifts)
+    pool.close()
+    pool.join()
+
+    return shifts
+
 def main(args): 
     ''' handle parameters, catch errors '''
 
     vcf_in  = None
     vcf_out = None
 
-    if args.vcf_infile[0].endswith('.gz'):
-        vcf_in = vcf.Reader(filename=args.vcf_infile[0], compressed=True)
-    else:
-        vcf_in = vcf.Reader(filename=args.vcf_infile[0])
+    shifts = None
+    if int(args.procs) > 1 and not args.v:
+        shifts = parallel_shifts(args)
+
+    vcf_in = open_vcf(args.vcf_infile[0])
 
     if args.vcf_outfile:
         vcf_out = vcf.Writer(file(args.vcf_outfile, 'w'), template=vcf_in)
@@ -156,22 +209,37 @@ def main(args):
 
     assert vcf_in and vcf_out
 
-    ref = pysam.Fastafile(args.ref_fasta)
+    ref = None
+    if shifts is None:
+        ref = pysam.Fastafile(args.ref_fasta)
+
     n_shifted = 0
     n_precise = 0
+    recnum = 0
 
     for rec in vcf_in:
-        if rec.is_sv:
-            if 'IMPRECISE' not in rec.INFO:
-                n_precise += 1
-                prev_pos = rec.POS
+        if is_precise_bnd(rec):
+            n_precise += 1
+            prev_pos = rec.POS
+
+            if shifts is None:
                 rec = shift_bnd(rec, ref, args.v)
-                shift_pos = rec.POS
+            else:
+                shift = shifts[recnum]
+                bnd = rec.ALT[0]
+                rec.POS -= shift
+                if bnd.orientation == bnd.remoteOrientation:
+                    bnd.pos += shift
+                else:
+                    bnd.pos -= shift
+
+            shift_pos = rec.POS
 
-                if prev_pos != shift_pos:
-                    n_shifted += 1
+            if prev_pos != shift_pos:
+                n_shifted += 1
 
         vcf_out.write_record(rec)
+        recnum += 1
 
     if args.v:
         sys.stderr.write("shifted " + str(n_shifted) + " of " + str(n_precise) + " variants.\n")
@@ -182,6 +250,7 @@ if __name__ == '__main__':
     parser.add_argument(metavar='<vcf_file>', dest='vcf_infile', nargs=1, help='VCF file')
     parser.add_argument('-r', dest='ref_fasta', required=True, help='reference genome, .fasta indexed with samtools faidx')
     parser.add_argument('-o', dest='vcf_outfile', default=None, help='output VCF (default STDOUT)')
+    parser.add_argument('-p', dest='procs', default=1, help='number of processes, breakends are shifted per chromosome in parallel (reads input twice)')
     parser.add_argument('-v', action='store_true', default=False, help='verbose (for debugging)')
     args = parser.parse_args()
     main(args)
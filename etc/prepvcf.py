@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+'''
+prepvcf.py: prepare VCFs for vcfcomparator in one pass per file
+
+Each VCF is streamed through:
+    indel left-alignment/trimming -> breakend left-shifting -> sort by reference (.fai) order
+    -> bgzip -> tabix index
+
+Records are held in memory up to --maxrecords per file, larger inputs are sorted in runs
+that are merged on output. Several files are prepared concurrently with -p.
+
+Inputs are never overwritten: <name>.vcf becomes <name>.vcf.gz and <name>.vcf.gz becomes
+<name>.prep.vcf.gz (next to the input, or in --outdir).
+'''
+
+import argparse
+import heapq
+import os
+import sys
+import tempfile
+import pysam
+import vcf
+from multiprocessing import Pool
+
+import leftShiftBreakends
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import bgzf
+
+
+class LineCapture:
+    ''' file-like object for vcf.Writer, collects what is written so it can be taken one record at a time '''
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s):
+        self.chunks.append(s)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def take(self):
+        s = ''.join(self.chunks)
+        self.chunks = []
+        return s
+
+
+class RefCache:
+    ''' caches a window of reference sequence, left-alignment walks backwards one base at a time '''
+    def __init__(self, ref, chrom, window=100):
+        self.ref    = ref
+        self.chrom  = chrom
+        self.window = window
+        self.start  = None
+        self.seq    = ''
+
+    def base(self, pos):
+        ''' base at 0-based pos, '' if outside the reference '''
+        if pos < 0:
+            return ''
+        if self.start is None or pos < self.start or pos >= self.start + len(self.seq):
+            self.start = max(0, pos - self.window + 1)
+            self.seq   = self.ref.fetch(self.chrom, self.start, pos+1).upper()
+        return self.seq[pos-self.start:pos-self.start+1]
+
+
+def is_simple_allele(a):
+    return len(a) > 0 and not a.strip('ACGTNacgtn')
+
+def left_align(rec, ref):
+    ''' left-align and trim an indel against the reference, same result as GATK LeftAlignVariants
+        or vt normalize: drop common trailing bases (extending left when an allele would become
+        empty) until the alleles differ at the end, then trim common leading bases '''
+    if not rec.is_indel or rec.is_sv:
+        return rec
+
+    alleles = [rec.REF] + [str(alt) for alt in rec.ALT]
+    if not all(map(is_simple_allele, alleles)):
+        return rec
+
+    cache = RefCache(ref, rec.CHROM)
+    pos = rec.POS
+
+    while len(set(a[-1].upper() for a in alleles)) == 1:
+        if min(map(len, alleles)) == 1:
+            base = cache.base(pos-2) # base before POS (1-based)
+            if not base:
+                break
+            alleles = [base + a for a in alleles]
+            pos -= 1
+        alleles = [a[:-1] for a in alleles]
+
+    while min(map(len, alleles)) > 1 and len(set(a[0].upper() for a in alleles)) == 1:
+        alleles = [a[1:] for a in alleles]
+        pos += 1
+
+    if pos != rec.POS or alleles[0] != rec.REF:
+        rec.POS = pos
+        rec.REF = alleles[0]
+        rec.ALT = [vcf.model._Substitution(a) for a in alleles[1:]]
+        rec.start = pos - 1
+        rec.end   = rec.start + len(rec.REF)
+
+    return rec
+
+def chrom_order(fai):
+    ''' dict of chromosome name --> rank in .fai '''
+    order = {}
+    with open(fai, 'r') as f:
+        for line in f:
+            c = line.split('\t')
+            if c[0] not in order:
+                order[c[0]] = len(order)
+    return order
+
+def write_run(run, tmpdir):
+    ''' sort a run of (chrom rank, pos, seqno, line) and spill it to a temp file '''
+    run.sort()
+    fd, fn = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+    with os.fdopen(fd, 'w') as out:
+        for rank, pos, seqno, line in run:
+            out.write('\t'.join((str(rank), str(pos), str(seqno), line)))
+    return fn
+
+def read_run(fn):
+    with open(fn, 'r') as f:
+        for l in f:
+            rank, pos, seqno, line = l.split('\t', 3)
+            yield int(rank), int(pos), int(seqno), line
+
+def prep_vcf(job):
+    ''' normalize, shift, sort, bgzip and index one VCF, runs in a worker process '''
+    infile, outfile, ref_fasta, maxrecords, verbose = job
+
+    ref   = pysam.Fastafile(ref_fasta)
+    order = chrom_order(ref_fasta + '.fai')
+
+    vcf_in  = vcf.Reader(filename=infile, compressed=infile.endswith('.gz'))
+    capture = LineCapture()
+    vcf_out = vcf.Writer(capture, template=vcf_in)
+    header  = capture.take()
+
+    tmpdir = os.path.dirname(os.path.abspath(outfile))
+    run  = []
+    runs = []
+    n_aligned = n_shifted = 0
+
+    for seqno, rec in enumerate(vcf_in):
+        prev = (rec.POS, rec.REF)
+        rec = left_align(rec, ref)
+        if (rec.POS, rec.REF) != prev:
+            n_aligned += 1
+
+        if rec.is_sv and 'IMPRECISE' not in rec.INFO and isinstance(rec.ALT[0], vcf.model._Breakend):
+            prev_pos = rec.POS
+            rec = leftShiftBreakends.shift_bnd(rec, ref)
+            if rec.POS != prev_pos:
+                n_shifted += 1
+
+        # contigs missing from the .fai go last, in order of appearance
+        if rec.CHROM not in order:
+            order[rec.CHROM] = len(order)
+
+        vcf_out.write_record(rec)
+        run.append((order[rec.CHROM], rec.POS, seqno, capture.take()))
+
+        if len(run) >= maxrecords:
+            runs.append(write_run(run, tmpdir))
+            run = []
+
+    run.sort()
+
+    tmpout = outfile + '.tmp'
+    out = bgzf.BgzfWriter(tmpout)
+    out.write(header)
+
+    if runs:
+        streams = [read_run(fn) for fn in runs] + [iter(run)]
+        for rank, pos, seqno, line in heapq.merge(*streams):
+            out.write(line)
+    else:
+        for rank, pos, seqno, line in run:
+            out.write(line)
+
+    out.close()
+
+    for fn in runs:
+        os.remove(fn)
+
+    os.rename(tmpout, outfile)
+    pysam.tabix_index(outfile, preset='vcf', force=True)
+
+    if verbose:
+        sys.stderr.write(' '.join((infile, '-->', outfile + ':', str(n_aligned), 'indels realigned,', str(n_shifted), 'breakends shifted,', str(len(runs)), 'sort runs\n')))
+
+    return outfile
+
+def output_name(infile, outdir=None):
+    ''' <name>.vcf --> <name>.vcf.gz, <name>.vcf.gz --> <name>.prep.vcf.gz, never the input itself '''
+    if infile.endswith('.vcf'):
+        outfile = infile + '.gz'
+    else:
+        outfile = infile[:-len('.vcf.gz')] + '.prep.vcf.gz'
+    if outdir is not None:
+        outfile = os.path.join(outdir, os.path.basename(outfile))
+    return outfile
+
+def main(args):
+    if not os.path.exists(args.ref_fasta + '.fai'):
+        sys.exit(args.ref_fasta + ".fai not found: reference should be indexed with samtools faidx")
+
+    infiles = []
+    for path in args.vcf:
+        if os.path.isdir(path):
+            for fn in sorted(os.listdir(path)):
+                if fn.endswith('.vcf') or fn.endswith('.vcf.gz'):
+                    infiles.append(os.path.join(path, fn))
+        else:
+            infiles.append(path)
+
+    jobs = []
+    inputs = set(os.path.abspath(infile) for infile in infiles)
+    outfiles = set()
+    for infile in infiles:
+        if not (infile.endswith('.vcf') or infile.endswith('.vcf.gz')):
+            sys.exit(infile + ": expected a .vcf or .vcf.gz file")
+        outfile = output_name(infile, args.outdir)
+        if os.path.abspath(outfile) in inputs:
+            sys.exit(outfile + ": output would overwrite an input, use -o to write elsewhere")
+        if os.path.abspath(outfile) in outfiles:
+            sys.exit(outfile + ": more than one input would be written here")
+        outfiles.add(os.path.abspath(outfile))
+        jobs.append((infile, outfile, args.ref_fasta, int(args.maxrecords), args.verbose))
+
+    if int(args.procs) > 1:
+        pool = Pool(processes=int(args.procs))
+        for outfile in pool.imap_unordered(prep_vcf, jobs):
+            print outfile
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            print prep_vcf(job)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Left-align, left-shift breakends, sort, bgzip and index VCFs for vcfcomparator')
+    parser.add_argument(metavar='<vcf or directory>', dest='vcf', nargs='+', help='VCF files (.vcf or .vcf.gz) or directories containing them')
+    parser.add_argument('-r', '--ref', dest='ref_fasta', required=True, help='reference genome, .fasta indexed with samtools faidx')
+    parser.add_argument('-o', '--outdir', dest='outdir', default=None, help='output directory (default: next to input; <name>.vcf --> <name>.vcf.gz, <name>.vcf.gz --> <name>.prep.vcf.gz)')
+    parser.add_argument('-p', '--procs', dest='procs', default=1, help='number of files to prepare concurrently')
+    parser.add_argument('-m', '--maxrecords', dest='maxrecords', default=500000, help='records per file held in memory before sorting spills a run to disk (default 500000)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='report per-file counts')
+    args = parser.parse_args()
+    main(args)
@@ -1,8 +1,19 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import vcf
+import json
+import argparse
 from os.path import basename
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import bgzf
+
+VTYPES   = ('SNP', 'INDEL')
+COUNTERS = ('Total', 'Total_Germline', 'Total_Somatic', 'Total_Passed', 'Total_Failed',
+            'Somatic_Passed', 'Somatic_Failed', 'Germline_Passed', 'Germline_Failed')
 
 def is_somatic(rec):
     if str(rec.INFO.get('SS')).upper() in ['SOMATIC', '2']:
@@ -30,101 +41,129 @@ def somatic_in_format(rec):
     return False
 
 def is_snp(rec):
-    snp = True
     if not rec.is_snp:
-        snp = False
+        return False
     if rec.INFO.get('VT') == 'LOH':
-        snp = False
-
-    SS = []
-    has_format_ss = False
-    for sample in rec.samples:
-        calldata = sample.data
-        if 'SS' in calldata._fields:
-            has_format_ss = True
-            SS.append(calldata.SS)
-
-    return snp 
-
-if len(sys.argv) == 3:
-    assert sys.argv[2] in ('SNP', 'INDEL')
-    vcfin = vcf.Reader(filename=sys.argv[1])
-    n_total = 0
-    n_pass  = 0
-    n_fail  = 0
-    n_germ  = 0
-    n_som   = 0
-
-    n_som_pass  = 0
-    n_som_fail  = 0
-    n_germ_pass = 0
-    n_germ_fail = 0
-
-    som_fail_reasons  = {}
-    germ_fail_reasons = {}
-
-    for rec in vcfin:
-        if (is_snp(rec) and sys.argv[2] == 'SNP') or (rec.is_indel and sys.argv[2] == 'INDEL'): 
-            n_total += 1
-            passed   = False
-            failed   = False
-            somatic  = False
-            germline = False
-
-            if is_somatic(rec):
-                n_som += 1
-                somatic = True
+        return False
+    return True
+
+def open_vcf(vcf_file, threads=0):
+    ''' vcf.Reader, bgzipped input is inflated by a thread pool when threads > 0 '''
+    if threads > 0 and vcf_file.endswith('.gz') and bgzf.is_bgzf(vcf_file):
+        return vcf.Reader(fsock=bgzf.MmapBgzfReader(vcf_file, threads=threads), compressed=False)
+    return vcf.Reader(filename=vcf_file)
+
+def vcf_stats(vcf_file, threads=0):
+    ''' one pass over vcf_file, counts every vtype x somatic/germline x pass/fail category
+        returns (vcf_file, {vtype: {'counts': {...}, 'som_fail_reasons': {...}, 'germ_fail_reasons': {...}}}) '''
+    stats = {}
+    for vtype in VTYPES:
+        stats[vtype] = {'counts': dict([(c, 0) for c in COUNTERS]), 'som_fail_reasons': {}, 'germ_fail_reasons': {}}
+
+    for rec in open_vcf(vcf_file, threads=threads):
+        vtypes = []
+        if is_snp(rec):
+            vtypes.append('SNP')
+        if rec.is_indel:
+            vtypes.append('INDEL')
+
+        if not vtypes:
+            continue
+
+        somatic = is_somatic(rec)
+        failed  = bool(rec.FILTER)
+
+        for vtype in vtypes:
+            counts = stats[vtype]['counts']
+            counts['Total'] += 1
+
+            if somatic:
+                counts['Total_Somatic'] += 1
+                reasons = stats[vtype]['som_fail_reasons']
             else:
-                n_germ += 1
-                germline = True
+                counts['Total_Germline'] += 1
+                reasons = stats[vtype]['germ_fail_reasons']
 
-            if rec.FILTER:
-                n_fail += 1
-                failed = True
+            if failed:
+                counts['Total_Failed'] += 1
                 for flag in rec.FILTER:
-                    if is_somatic(rec):
-                        if flag in som_fail_reasons:
-                            som_fail_reasons[flag] += 1
-                        else:
-                            som_fail_reasons[flag] = 1
-                    else:
-                        if flag in germ_fail_reasons:
-                            germ_fail_reasons[flag] += 1
-                        else:
-                            germ_fail_reasons[flag] = 1
+                    reasons[flag] = reasons.get(flag, 0) + 1
             else:
-                n_pass += 1
-                passed = True
-
-            assert germline != somatic
-            assert passed != failed
-
-            if somatic and passed:
-                n_som_pass += 1
-            if somatic and failed:
-                n_som_fail += 1
-            if germline and passed:
-                n_germ_pass += 1
-            if germline and failed:
-                n_germ_fail += 1
-
-    print "VCF", basename(sys.argv[1])
-    print "VTYPE", sys.argv[2]
-    print "Total", n_total
-    print "Total_Germline",  n_germ
-    print "Total_Somatic",   n_som
-    print "Total_Passed",    n_pass
-    print "Total_Failed",    n_fail
-    print "Somatic_Passed",  n_som_pass
-    print "Somatic_Failed",  n_som_fail
-    print "Germline_Passed", n_germ_pass
-    print "Germline_Failed", n_germ_fail
+                counts['Total_Passed'] += 1
+
+            counts[('Somatic' if somatic else 'Germline') + ('_Failed' if failed else '_Passed')] += 1
+
+    return vcf_file, stats
+
+def vcf_stats_job(job):
+    ''' Pool worker, job is (vcf_file, threads) '''
+    return vcf_stats(*job)
+
+def legacy_main(vcf_file, vtype):
+    ''' original interface: one VCF, one VTYPE '''
+    vcf_file, stats = vcf_stats(vcf_file)
+    counts = stats[vtype]['counts']
+
+    print "VCF", basename(vcf_file)
+    print "VTYPE", vtype
+    for c in COUNTERS:
+        print c, counts[c]
 #    print "Somatic fail filter counts:"
-#    for flag, count in som_fail_reasons.iteritems():
+#    for flag, count in stats[vtype]['som_fail_reasons'].iteritems():
 #        print flag, count
 #    print "Germline fail filter counts:"
-#    for flag, count in germ_fail_reasons.iteritems():
+#    for flag, count in stats[vtype]['germ_fail_reasons'].iteritems():
 #        print flag, count
 
-else:
-    print "usage:", sys.argv[0], "<VCF> <VTYPE (SNP/INDEL)>"
+def main(args):
+    results = None
+    if int(args.procs) > 1 and len(args.vcf) > 1:
+        pool = Pool(processes=int(args.procs))
+        results = dict(pool.imap_unordered(vcf_stats_job, [(vcf_file, int(args.threads)) for vcf_file in args.vcf]))
+        pool.close()
+        pool.join()
+    else:
+        results = dict([vcf_stats(vcf_file, threads=int(args.threads)) for vcf_file in args.vcf])
+
+    # counts table, one row per VCF and VTYPE, in command line order
+    out = sys.stdout
+    if args.tsv is not None:
+        out = open(args.tsv, 'w')
+
+    out.write('\t'.join(('VCF', 'VTYPE') + COUNTERS) + '\n')
+    for vcf_file in args.vcf:
+        for vtype in VTYPES:
+            counts = results[vcf_file][vtype]['counts']
+            out.write('\t'.join([basename(vcf_file), vtype] + [str(counts[c]) for c in COUNTERS]) + '\n')
+
+    if args.tsv is not None:
+        out.close()
+
+    if args.filters is not None:
+        with open(args.filters, 'w') as out:
+            out.write('\t'.join(('VCF', 'VTYPE', 'STATUS', 'FILTER', 'COUNT')) + '\n')
+            for vcf_file in args.vcf:
+                for vtype in VTYPES:
+                    for status, reasons in (('Somatic', 'som_fail_reasons'), ('Germline', 'germ_fail_reasons')):
+                        for flag, count in sorted(results[vcf_file][vtype][reasons].iteritems()):
+                            out.write('\t'.join((basename(vcf_file), vtype, status, flag, str(count))) + '\n')
+
+    if args.json is not None:
+        with open(args.json, 'w') as out:
+            json.dump([{'VCF': vcf_file, 'stats': results[vcf_file]} for vcf_file in args.vcf], out, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[2] in VTYPES:
+        legacy_main(sys.argv[1], sys.argv[2])
+
+    else:
+        parser = argparse.ArgumentParser(description='SNP and INDEL somatic/germline and pass/fail counts for any number of VCFs, one pass per file. '
+                                                     + 'The original "' + sys.argv[0] + ' <VCF> <VTYPE (SNP/INDEL)>" form still works.')
+        parser.add_argument(metavar='<vcf_file>', dest='vcf', nargs='+', help='files in VCF format')
+        parser.add_argument('-p', '--procs', dest='procs', default=1, help='number of VCFs to read in parallel')
+        parser.add_argument('-t', '--threads', dest='threads', default=0, help='threads decompressing each bgzipped VCF (default 0, single-threaded)')
+        parser.add_argument('-o', '--tsv', dest='tsv', default=None, help='counts table (default stdout)')
+        parser.add_argument('--filters', dest='filters', default=None, help='also write filter reason counts (TSV) to this file')
+        parser.add_argument('--json', dest='json', default=None, help='also write counts and filter reasons as JSON to this file')
+        args = parser.parse_args()
+        main(args)
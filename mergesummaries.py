@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+'''
+merge vcfcomparator summaries (text, tsv, json or binary, see vcfcomparator.py -u/--summary_format)
+merging is associative, so per-region summaries can be reduced in any grouping, e.g. as a tree on a cluster
+'''
+
+import argparse
+import sys
+import vcfcomparator as vc
+
+def main(args):
+    merged = vc.OrderedDict()
+    for infile in args.summaries:
+        vc.merge_summaries(vc.read_summaries(infile), merged=merged)
+
+    if args.outfile is None:
+        sys.stdout.write(vc.dumps_summaries(merged.values(), fmt=args.format))
+    else:
+        vc.write_summaries(merged.values(), args.outfile, fmt=args.format)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add up any number of vcfcomparator summary files')
+    parser.add_argument(metavar='<summary_file>', dest='summaries', nargs='+', help='summary files in any format')
+    parser.add_argument('-o', '--outfile', dest='outfile', default=None, help='output file (default stdout)')
+    parser.add_argument('-f', '--format', dest='format', default='text', choices=vc.SUMMARY_FORMATS, help='output format (default text)')
+    args = parser.parse_args()
+    main(args)
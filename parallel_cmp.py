@@ -1,17 +1,19 @@
 #!/usr/bin/env python
 
 import argparse
-import vcf
 import sys
 import vcfcomparator as vc
-from multiprocessing import Process, Queue
+from vcfcomparator import read_json, write_json_atomic, to_segment
+from multiprocessing import Process
 from re import sub
-from os import remove
-from os.path import basename
-from time import sleep
-from itertools import izip
+from os import remove, makedirs
+from os.path import basename, join, exists, abspath, relpath
+from shutil import rmtree, copyfile
+from time import time
+
+def merge_vcfs(files, outname, outdir=None, verbose=False, remove_inputs=True):
+    import vcf
 
-def merge_vcfs(files, outname, outdir=None, verbose=False):
     assert len(files) > 0
     assert outname.endswith('vcf')
 
@@ -32,95 +34,164 @@ def merge_vcfs(files, outname, outdir=None, verbose=False):
             vcfout.write_record(rec)
     vcfout.close()
 
-    for infile in files:
-        remove(infile)
+    if remove_inputs:
+        for infile in files:
+            remove(infile)
+
+def checkpoint_dir(args):
+    ''' per-segment results and checkpoints go here, --resume picks them up '''
+    if args.checkpoint is not None:
+        return args.checkpoint
+    ckdir = basename(args.vcf[0]) + '.checkpoint'
+    if args.outdir is not None:
+        ckdir = join(args.outdir, ckdir)
+    return ckdir
+
+def run_config(args):
+    ''' inputs and every option that affects a segment's result, a checkpoint is only valid for these
+        (same keys as shard_cmp.py's config.json; -p, --prefetch and output options don't count) '''
+    return {'vcf': map(abspath, args.vcf), 'fai': abspath(args.fai),
+            'maskfile': args.maskfile and abspath(args.maskfile), 'truth': args.truth and abspath(args.truth),
+            'strat': args.strat, 'prefilter': args.prefilter and float(args.prefilter),
+            'w_indel': int(args.w_indel), 'indel_match': args.indel_match, 'assign': args.assign,
+            'table': args.table, 'table_info': args.table_info, 'score': args.score}
+
+def genome_segments(fai, n, verbose=False):
+    ''' split_genome() segments, in genome order so merged VCFs come out sorted '''
+    segs = []
+    for seglist in vc.split_genome(fai, n, verbose=verbose):
+        segs.extend(seglist)
+
+    chrom_rank = {}
+    with open(fai, 'r') as f:
+        for line in f:
+            chrom_rank.setdefault(line.split()[0], len(chrom_rank))
+    segs.sort(key=lambda seg: (chrom_rank[seg.chrom], seg.start))
+
+    return [{'chrom': seg.chrom, 'start': seg.start, 'end': seg.end} for seg in segs]
+
+def is_done(ckdir, segid):
+    return exists(join(ckdir, segid + '.json'))
+
+def run_segments(args, ckdir, jobs, attempt):
+    ''' worker: compare each (segid, segment) and checkpoint it. A failed segment is reported and
+        left without a checkpoint, the parent retries it '''
+    strata  = vc.get_strata(args)
+    handles = vc.HandlePool()
+
+    for segid, d in jobs:
+        seg = to_segment(d)
+        outdir = join(ckdir, segid)
+        if not exists(outdir):
+            makedirs(outdir)
+
+        try:
+            summaries, vcfA_names, vcfB_names, table = vc.runSegment(args, seg, outdir, 'A', 'B', strata=strata, handles=handles)
+            vc.write_summaries(summaries.values(), join(outdir, 'summary.bin'), fmt='binary')
+        except (Exception, SystemExit) as e: # parseVCFs exits on unreadable input
+            sys.stderr.write("segment " + segid + " " + str(seg) + " failed (attempt " + str(attempt) + "): " + repr(e) + "\n")
+            continue
+
+        # paths are relative to the checkpoint directory so it can be moved before --resume
+        rel = lambda path: relpath(path, ckdir)
+        checkpoint = {'segment': d, 'summary': rel(join(outdir, 'summary.bin')),
+                      'vcfA': map(rel, vcfA_names), 'vcfB': map(rel, vcfB_names),
+                      'attempt': attempt, 'time': time()}
+        if table is not None:
+            checkpoint['table'] = [rel(table[0]), table[1]]
+        write_json_atomic(checkpoint, join(ckdir, segid + '.json'))
+        if args.verbose:
+            sys.stderr.write("segment " + segid + " " + str(seg) + " done\n")
 
 def main(args):
     np = int(args.procs)
     assert np > 0
 
-    rAB_list = []
-    rBA_list = []
-
-    processes = []
-    seglists = vc.split_genome(args.fai, np, verbose=args.verbose)
-
-    result_queue = Queue()
-    vcfA_queue = Queue()
-    vcfB_queue = Queue()
-
-    segnum = 0
-    mp=True
-    for seglist in seglists:
-        processes.append(Process(target=vc.runList, args=(result_queue, vcfA_queue, vcfB_queue, args, seglist, segnum, mp)))
-        segnum += 1
-
-    for p in processes:
-        p.start()
-
-    ''' dequeue jobs as they finish to avoid filling up the queue (see http://http://bugs.python.org/issue8426) '''
-
-    dequeued_summaries = []
-    dequeued_vcfA      = []
-    dequeued_vcfB      = []
-
-    dequeued_jobs = 0
-    while dequeued_jobs < np * 3:
-        while not result_queue.empty():
-            dequeued_summaries.append(result_queue.get())
-            dequeued_jobs += 1
-            if args.verbose:
-                sys.stderr.write("debug info: dequeued #" + str(dequeued_jobs) + " from result_queue.\n")
-        while not vcfA_queue.empty():
-            dequeued_vcfA.append(vcfA_queue.get())
-            dequeued_jobs += 1
-            if args.verbose:
-                sys.stderr.write("debug info: dequeued #" + str(dequeued_jobs) + " from vcfA_queue.\n")
-        while not vcfB_queue.empty():
-            dequeued_vcfB.append(vcfB_queue.get())
-            dequeued_jobs += 1
-            if args.verbose:
-                sys.stderr.write("debug info: dequeued #" + str(dequeued_jobs) + " from vcfB_queue.\n")
-        sleep(5)
-
-    summaries = {}
-    for s in dequeued_summaries:
-        for vtype in s.keys():
-            if vtype not in summaries:
-                summaries[vtype] = s[vtype]
-            else:
-                summaries[vtype].add(s[vtype])
+    ckdir = checkpoint_dir(args)
+    config = run_config(args)
+
+    if args.resume and exists(join(ckdir, 'run.json')):
+        run = read_json(join(ckdir, 'run.json'))
+        if run['config'] != config:
+            sys.exit("error: inputs or options differ from the run checkpointed in " + ckdir + ", cannot --resume")
+        segments = run['segments'] # the original split, whatever -p is now
+        sys.stderr.write("resuming from " + ckdir + "\n")
+    else:
+        if exists(ckdir):
+            if not exists(join(ckdir, 'run.json')):
+                sys.exit("error: " + ckdir + " exists and is not a checkpoint directory")
+            if not args.overwrite:
+                sys.exit("error: " + ckdir + " holds checkpoints of an earlier run, pass --resume to continue it or --overwrite to start over")
+            rmtree(ckdir)
+        makedirs(ckdir)
+        segments = genome_segments(args.fai, np, verbose=args.verbose)
+        write_json_atomic({'config': config, 'segments': segments}, join(ckdir, 'run.json'))
+
+    segids = ['%05d' % i for i in range(len(segments))]
+
+    # workers write a checkpoint per finished segment, a worker that dies only loses its current
+    # segment: the parent waits for the processes (not for queue messages) and reruns what is missing
+    for attempt in range(1, int(args.retries) + 2):
+        pending = [(segid, segments[i]) for i, segid in enumerate(segids) if not is_done(ckdir, segid)]
+        if not pending:
+            break
+        if attempt > 1:
+            sys.stderr.write("retrying " + str(len(pending)) + " failed segment(s), attempt " + str(attempt) + "\n")
+        elif len(pending) < len(segids):
+            sys.stderr.write(str(len(segids) - len(pending)) + " of " + str(len(segids)) + " segments already done\n")
+
+        processes = [Process(target=run_segments, args=(args, ckdir, pending[i::np], attempt)) for i in range(min(np, len(pending)))]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+            if p.exitcode != 0 and args.verbose:
+                sys.stderr.write("debug info: worker " + str(p.pid) + " exited with " + str(p.exitcode) + "\n")
+
+    missing = [segid for segid in segids if not is_done(ckdir, segid)]
+    if missing:
+        sys.exit("error: " + str(len(missing)) + " segment(s) failed after " + str(int(args.retries) + 1) + " attempts (first: " + missing[0] + "), rerun with --resume")
+
+    checkpoints = [read_json(join(ckdir, segid + '.json')) for segid in segids]
+
+    summaries = vc.OrderedDict()
+    for ck in checkpoints:
+        vc.merge_summaries(vc.read_summaries(join(ckdir, ck['summary'])), merged=summaries)
 
     print "-"*60
-    for vtype in summaries.keys():
-        print summaries[vtype].output()
+    for s in summaries.values():
+        print s.output()
     print "-"*60
 
-    sys.stdout.flush()
+    if args.summary_outfile is not None:
+        vc.write_summaries(summaries.values(), args.summary_outfile, fmt=args.summary_format)
 
-    if not args.skip_merge:
-        vcfA_matched_files   = []
-        vcfA_unmatched_files = []
-        vcfB_matched_files   = []
-        vcfB_unmatched_files = []
+    sys.stdout.flush()
 
-        vcfA_matched_outname   = sub('vcf.gz$', 'matched.vcf', args.vcf[0])
-        vcfA_unmatched_outname = sub('vcf.gz$', 'unmatched.vcf', args.vcf[0])
-        vcfB_matched_outname   = sub('vcf.gz$', 'matched.vcf', args.vcf[1])
-        vcfB_unmatched_outname = sub('vcf.gz$', 'unmatched.vcf', args.vcf[1])
+    if args.table is not None:
+        # parts are moved next to the manifest, the checkpoint directory may be removed below
+        table_manifest = sub('vcf.gz$', 'table.json', basename(args.vcf[0]))
+        if args.outdir is not None:
+            table_manifest = join(args.outdir, table_manifest)
+        parts = []
+        for segid, ck in zip(segids, checkpoints):
+            part = sub('json$', segid + '.' + args.table, table_manifest)
+            copyfile(join(ckdir, ck['table'][0]), part)
+            parts.append((part, ck['table'][1]))
+        vc.write_table_manifest(parts, table_manifest, fmt=args.table)
+        sys.stderr.write("wrote table manifest " + table_manifest + "\n")
 
+    if not args.skip_merge:
         sys.stderr.write("merging VCFs...\n")
+        for i, vcf_file in enumerate(args.vcf):
+            key = ('vcfA', 'vcfB')[i]
+            matched   = [join(ckdir, ck[key][0]) for ck in checkpoints]
+            unmatched = [join(ckdir, ck[key][1]) for ck in checkpoints]
+            merge_vcfs(matched, sub('vcf.gz$', 'matched.vcf', vcf_file), outdir=args.outdir, verbose=args.verbose, remove_inputs=False)
+            merge_vcfs(unmatched, sub('vcf.gz$', 'unmatched.vcf', vcf_file), outdir=args.outdir, verbose=args.verbose, remove_inputs=False)
 
-        for (vcfA_matched, vcfA_unmatched), (vcfB_matched, vcfB_unmatched) in izip(dequeued_vcfA, dequeued_vcfB):
-            vcfA_matched_files.append(vcfA_matched)
-            vcfA_unmatched_files.append(vcfA_unmatched)
-            vcfB_matched_files.append(vcfB_matched)
-            vcfB_unmatched_files.append(vcfB_unmatched)
-
-        merge_vcfs(vcfA_matched_files, vcfA_matched_outname, outdir=args.outdir, verbose=args.verbose)
-        merge_vcfs(vcfA_unmatched_files, vcfA_unmatched_outname, outdir=args.outdir, verbose=args.verbose)
-        merge_vcfs(vcfB_matched_files, vcfB_matched_outname, outdir=args.outdir, verbose=args.verbose)
-        merge_vcfs(vcfB_unmatched_files, vcfB_unmatched_outname, outdir=args.outdir, verbose=args.verbose)
+    if not args.keep_checkpoints:
+        rmtree(ckdir)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compares two sorted VCF files and (optionally) masks regions.')
@@ -130,9 +201,24 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--truth', dest='truth', default=None, help='also compare results to a "truth" VCF (should be sorted and tabix-indexed)')
     parser.add_argument('-f', '--fai', dest='fai', required=True, help='.fai file generated by samtools faidx')
     parser.add_argument('-p', '--procs', dest='procs', default=1, help='number of jobs')
-    parser.add_argument('-u', '--summary', dest='summary_outfile', default=None, help='outfile for summary (default stdout)')
+    parser.add_argument('-u', '--summary', dest='summary_outfile', default=None, help='also write summary to this file')
+    parser.add_argument('--summary_format', dest='summary_format', default='text', choices=vc.SUMMARY_FORMATS, help='format for -u/--summary, all formats can be merged with mergesummaries.py (default text)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose mode for debugging')
     parser.add_argument('--skip_merge', action='store_true', default=False, help='skip VCF merge step')
+    parser.add_argument('--strat', dest='strat', action='append', default=None, help='<name>:<BED file>, also summarize variants overlapping these regions (may be repeated)')
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None, help='directory for per-segment results and checkpoints (default <vcfA>.checkpoint in -o/--outdir)')
+    parser.add_argument('--resume', action='store_true', default=False, help='keep the segments finished by an interrupted run and only run the rest')
+    parser.add_argument('--overwrite', action='store_true', default=False, help='discard the checkpoints of an earlier run and start over')
+    parser.add_argument('--retries', dest='retries', default=2, help='rerun failed segments up to this many times (default 2)')
+    parser.add_argument('--keep_checkpoints', action='store_true', default=False, help='keep the checkpoint directory after a successful run')
+    parser.add_argument('--indel_match', dest='indel_match', default='exact', choices=vc.INDEL_MATCH_MODES, help='exact: same REF/ALT (default). position: POS within --w_indel bp. length: also same type and length. similar: also similar inserted/deleted sequence. Tolerant modes match one-to-one, best first')
+    parser.add_argument('--assign', dest='assign', default='first', choices=vc.ASSIGN_MODES, help='first: indel/SV matches go to the first candidate in fetch order (default). optimal: one-to-one assignment with maximum total score within each cluster of candidates')
+    parser.add_argument('--w_indel', dest='w_indel', default=0, help='indel match window in bp (default 0)')
+    parser.add_argument('--prefilter', dest='prefilter', nargs='?', const=0.01, default=None, help='skip fetches for SNVs/indels whose site is not in a Bloom filter of the other VCF (and truth), optional value: false positive rate (default 0.01)')
+    parser.add_argument('--score', dest='score', action='append', default=None, help='QUAL, INFO/<key> or FORMAT/<key> to add as a --table column (may be repeated)')
+    parser.add_argument('--table', dest='table', default=None, choices=vc.TABLE_FORMATS, help='also write one row per compared record of both VCFs, a part per segment listed in <vcfA>.table.json (read_table() loads it)')
+    parser.add_argument('--table_info', dest='table_info', action='append', default=None, help='INFO field to add as a --table column (may be repeated)')
+    parser.add_argument('--prefetch', dest='prefetch', default=0, help='read ahead this many batches of records in a background thread per job (default 0, off)')
     args = parser.parse_args()
     main(args)
 
@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+
+'''
+shard_cmp.py: run vcfcomparator over genome segments on many machines sharing a filesystem
+
+    shard_cmp.py init   <jobdir> <vcfA> <vcfB> -f <fai> -n <segments> [-m mask] [-t truth] [--previous <old jobdir>] [--force]
+    shard_cmp.py work   <jobdir>         (start any number of these, on any node)
+    shard_cmp.py local  <jobdir> -p <n>  (n workers on this machine)
+    shard_cmp.py reduce <jobdir> [-o outdir] [-u summary]
+    shard_cmp.py requeue <jobdir> [--older_than <seconds>] [--all]   (release locks left by dead workers)
+
+job directory layout:
+    config.json           inputs and options
+    segments/NNNNN.json   one per segment (chrom, start, end)
+    locks/NNNNN.lock      created with O_EXCL by the worker that claims the segment, holds "host pid time"
+    results/NNNNN/        summary and partial matched/unmatched VCFs (and --table part) for the segment
+    done/NNNNN.json       manifest of results, renamed into place when the segment is finished
+    failed/NNNNN.json     one entry per failed attempt, the lock is released so another worker can retry
+
+stale locks: a worker that is killed leaves its lock behind. Workers take over a lock whose
+holder is a dead process on the same host, or (with --stale_after) any lock older than that.
+requeue does the same from the command line and also clears the failure records, so segments
+that used up their --retries are run again.
+
+incremental runs: init records a digest of the raw input lines (A, B, truth, mask) fetched
+for each segment, widened by --margin so that interval matches reaching over a segment edge
+are covered. The margin has to be at least --w_indel plus the breakend window (vcfcomparator.W_SV),
+that is the default. With --previous, segments whose boundaries and digest are unchanged in the
+old job directory are marked done at init time, results are hard-linked (or copied) from the old
+run, and only the changed segments are left for the workers. The --strat BEDs are not indexed,
+so they are checked as whole files: an md5 of each is kept in config.json and --previous is
+refused if any of them changed.
+
+The digest is positional. A breakend is compared on its own record line, which carries its mate's
+position in ALT, so a change to that line is seen; the mate's record on another chromosome (or
+beyond the margin) belongs to other segments, and a change there alone does not make this
+segment run again. Records longer than the margin (e.g. a deletion reaching back over the
+segment start) are covered only as far as the margin reaches.
+'''
+
+import argparse
+import errno
+import hashlib
+import os
+import shutil
+import socket
+import sys
+import time
+import vcfcomparator as vc
+from vcfcomparator import read_json, write_json_atomic, to_segment
+from parallel_cmp import merge_vcfs
+from multiprocessing import Pool, Process
+from re import sub
+
+def jobpath(jobdir, *parts):
+    return os.path.join(jobdir, *parts)
+
+def segment_ids(jobdir):
+    return sorted([fn[:-len('.json')] for fn in os.listdir(jobpath(jobdir, 'segments')) if fn.endswith('.json')])
+
+def config_args(config, verbose=False):
+    ''' argparse-like object for vcfcomparator.runSegment '''
+    return argparse.Namespace(vcf=config['vcf'], maskfile=config['maskfile'], truth=config['truth'], prefetch=config.get('prefetch', 0), strat=config.get('strat'), prefilter=config.get('prefilter'),
+                              w_indel=config.get('w_indel', 0), indel_match=config.get('indel_match', 'exact'),
+                              assign=config.get('assign', 'first'), table=config.get('table'), table_info=config.get('table_info'), score=config.get('score'), verbose=verbose)
+
+def is_done(jobdir, segid):
+    return os.path.exists(jobpath(jobdir, 'done', segid + '.json'))
+
+def lock_holder(lockfile):
+    ''' (host, pid, time) from a lock file, None if it is gone. A lock that is still being
+        written has no content yet, its mtime stands in for the time '''
+    try:
+        with open(lockfile, 'r') as f:
+            c = f.read().split()
+        if len(c) == 3:
+            return c[0], int(c[1]), float(c[2])
+        return None, None, os.path.getmtime(lockfile)
+    except (IOError, OSError, ValueError):
+        return None
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def is_stale(holder, stale_after=None):
+    ''' True if the lock holder is known to be dead: a missing process on this host, or a lock
+        older than stale_after seconds '''
+    host, pid, t = holder
+    if host == socket.gethostname() and pid is not None and not pid_alive(pid):
+        return True
+    return stale_after is not None and time.time() - t > stale_after
+
+def break_lock(lockfile, holder):
+    ''' remove a stale lock, unless another worker has replaced it in the meantime '''
+    moved = lockfile + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.stale'
+    try:
+        os.rename(lockfile, moved) # atomic, only one worker gets the old lock
+    except OSError:
+        return False
+    if lock_holder(moved) != holder:
+        # lost a race: this is a fresh lock, put it back (link fails if there is a newer one still)
+        try:
+            os.link(moved, lockfile)
+        except OSError:
+            pass
+        os.remove(moved)
+        return False
+    os.remove(moved)
+    return True
+
+def claim(jobdir, segid, stale_after=None):
+    ''' atomically create the lock file for segid, return True if this process got it.
+        A stale lock (see is_stale) is broken and the claim tried once more '''
+    lockfile = jobpath(jobdir, 'locks', segid + '.lock')
+    for attempt in range(2):
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            holder = lock_holder(lockfile)
+            if attempt > 0 or holder is None or not is_stale(holder, stale_after) or not break_lock(lockfile, holder):
+                return False
+            sys.stderr.write("segment " + segid + ": breaking stale lock of " + str(holder[0]) + ":" + str(holder[1]) + "\n")
+            continue
+        os.write(fd, socket.gethostname() + ' ' + str(os.getpid()) + ' ' + str(time.time()) + '\n')
+        os.close(fd)
+        return True
+    return False
+
+def release(jobdir, segid):
+    try:
+        os.remove(jobpath(jobdir, 'locks', segid + '.lock'))
+    except OSError:
+        pass
+
+def failures(jobdir, segid):
+    ''' failed attempts recorded for segid '''
+    fn = jobpath(jobdir, 'failed', segid + '.json')
+    if not os.path.exists(fn):
+        return []
+    return read_json(fn)
+
+def record_failure(jobdir, segid, error):
+    ''' add a failed attempt for segid (only the lock holder writes this) '''
+    if not os.path.exists(jobpath(jobdir, 'failed')):
+        try:
+            os.makedirs(jobpath(jobdir, 'failed')) # job directories from before failure records
+        except OSError:
+            pass
+    attempts = failures(jobdir, segid)
+    attempts.append({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(), 'error': error})
+    write_json_atomic(attempts, jobpath(jobdir, 'failed', segid + '.json'))
+    return len(attempts)
+
+def run_segment(jobdir, config, segid, verbose=False, strata=None, handles=None):
+    ''' compare one segment, write its results and then its done manifest '''
+    seg = to_segment(read_json(jobpath(jobdir, 'segments', segid + '.json')))
+    outdir = jobpath(jobdir, 'results', segid)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    summaries, vcfA_names, vcfB_names, table = vc.runSegment(config_args(config, verbose=verbose), seg, outdir, 'A', 'B', strata=strata, handles=handles)
+
+    summary_file = jobpath(outdir, 'summary.bin')
+    vc.write_summaries(summaries.values(), summary_file + '.tmp', fmt='binary')
+    os.rename(summary_file + '.tmp', summary_file)
+
+    # paths in the manifest are relative to the job directory, nodes may mount it in different places
+    rel = lambda path: os.path.relpath(path, jobdir)
+    manifest = {'segment': str(seg), 'summary': rel(summary_file),
+                'vcfA': map(rel, vcfA_names), 'vcfB': map(rel, vcfB_names),
+                'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+    if table is not None:
+        manifest['table'] = [rel(table[0]), table[1]]
+    write_json_atomic(manifest, jobpath(jobdir, 'done', segid + '.json'))
+    return manifest
+
+def input_files(config):
+    ''' files whose content determines a segment's result, in a fixed order '''
+    return config['vcf'] + [config['truth'], config['maskfile']]
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def min_margin(w_indel):
+    ''' widest reach of a match over a segment edge: indel window plus breakend window '''
+    return int(w_indel) + vc.W_SV
+
+def segment_digest(job):
+    ''' md5 of the raw tabix lines of every input in the (widened) segment, runs in a worker process '''
+    import pysam
+
+    files, seg, margin = job
+    md5 = hashlib.md5()
+    for fn in files:
+        md5.update('>') # file separator, an absent truth/mask still counts
+        if fn is None:
+            continue
+        tbx = pysam.Tabixfile(fn)
+        if seg['chrom'] in tbx.contigs:
+            for line in tbx.fetch(seg['chrom'], max(0, seg['start'] - margin), seg['end'] + margin):
+                md5.update(line)
+                md5.update('\n')
+        tbx.close()
+    return md5.hexdigest()
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def reuse_segment(jobdir, segid, old_jobdir, old_segid):
+    ''' bring a finished segment over from old_jobdir, returns the new manifest '''
+    old = read_json(jobpath(old_jobdir, 'done', old_segid + '.json'))
+    outdir = jobpath(jobdir, 'results', segid)
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.makedirs(outdir)
+
+    def bring(relpath):
+        dst = jobpath(outdir, os.path.basename(relpath))
+        link_or_copy(jobpath(old_jobdir, relpath), dst)
+        return os.path.relpath(dst, jobdir)
+
+    manifest = dict(old)
+    manifest['summary'] = bring(old['summary'])
+    manifest['vcfA'] = map(bring, old['vcfA'])
+    manifest['vcfB'] = map(bring, old['vcfB'])
+    if 'table' in old:
+        manifest['table'] = [bring(old['table'][0]), old['table'][1]]
+    manifest['reused'] = os.path.abspath(old_jobdir) + ':' + old_segid
+
+    write_json_atomic(manifest, jobpath(jobdir, 'done', segid + '.json'))
+    return manifest
+
+def previous_segments(old_jobdir):
+    ''' (chrom, start, end) --> (segid, digest) for the finished segments of an old job directory '''
+    prev = {}
+    for segid in segment_ids(old_jobdir):
+        if not is_done(old_jobdir, segid):
+            continue
+        d = read_json(jobpath(old_jobdir, 'segments', segid + '.json'))
+        prev[(d['chrom'], d['start'], d['end'])] = (segid, d.get('digest'))
+    return prev
+
+JOB_SUBDIRS = ('segments', 'locks', 'results', 'done', 'failed')
+
+def prepare_jobdir(jobdir, force=False):
+    ''' create an empty job directory. An existing non-empty one is refused, its old manifests would
+        mark segments done with results from other inputs; with force its contents are cleared '''
+    if os.path.exists(jobdir) and os.listdir(jobdir):
+        if not force:
+            sys.exit("error: " + jobdir + " is not empty, use --force to clear it and start a new job")
+        for d in JOB_SUBDIRS:
+            if os.path.exists(jobpath(jobdir, d)):
+                shutil.rmtree(jobpath(jobdir, d))
+        if os.path.exists(jobpath(jobdir, 'config.json')):
+            os.remove(jobpath(jobdir, 'config.json'))
+
+    for d in JOB_SUBDIRS:
+        os.makedirs(jobpath(jobdir, d))
+
+def init(args):
+    if args.previous is not None and os.path.realpath(args.previous) == os.path.realpath(args.jobdir):
+        sys.exit("error: --previous has to be another job directory than " + args.jobdir)
+
+    config = {'vcf': map(os.path.abspath, args.vcf), 'fai': os.path.abspath(args.fai),
+              'maskfile': None, 'truth': None}
+    if args.maskfile is not None:
+        config['maskfile'] = os.path.abspath(args.maskfile)
+    if args.truth is not None:
+        config['truth'] = os.path.abspath(args.truth)
+
+    config['margin'] = min_margin(args.w_indel)
+    if args.margin is not None:
+        if int(args.margin) < config['margin']:
+            sys.exit("error: --margin " + str(args.margin) + " is less than --w_indel plus the breakend window (" + str(config['margin']) + "), matches over a segment edge would not be covered")
+        config['margin'] = int(args.margin)
+    config['prefetch'] = int(args.prefetch)
+    config['prefilter'] = args.prefilter and float(args.prefilter)
+    config['w_indel'] = int(args.w_indel)
+    config['indel_match'] = args.indel_match
+    config['assign'] = args.assign
+    config['table'] = args.table
+    config['table_info'] = args.table_info
+    config['score'] = args.score
+    config['strat'] = None
+    if args.strat:
+        config['strat'] = [name + ':' + os.path.abspath(bed) for name, bed in [spec.split(':', 1) for spec in args.strat]]
+        config['strat_md5'] = [file_md5(spec.split(':', 1)[1]) for spec in config['strat']]
+
+    # check the previous run before touching the job directory
+    prev = {}
+    if args.previous is not None:
+        old_config = read_json(jobpath(args.previous, 'config.json'))
+        if old_config.get('margin') != config['margin']:
+            sys.exit("error: --margin differs from the previous run (" + str(old_config.get('margin')) + "), digests are not comparable")
+        if old_config.get('strat') != config['strat']:
+            sys.exit("error: --strat differs from the previous run, cached summaries would not match")
+        if config['strat'] is not None and old_config.get('strat_md5') != config['strat_md5']:
+            sys.exit("error: a --strat BED changed since the previous run, cached summaries would not match")
+        if (old_config.get('w_indel', 0), old_config.get('indel_match', 'exact'), old_config.get('assign', 'first')) != (config['w_indel'], config['indel_match'], config['assign']):
+            sys.exit("error: --w_indel/--indel_match/--assign differ from the previous run, cached results would not match")
+        if (old_config.get('table'), old_config.get('table_info'), old_config.get('score')) != (config['table'], config['table_info'], config['score']):
+            sys.exit("error: --table/--table_info/--score differ from the previous run, cached tables would not match")
+        prev = previous_segments(args.previous)
+
+    prepare_jobdir(args.jobdir, force=args.force)
+    write_json_atomic(config, jobpath(args.jobdir, 'config.json'))
+
+    segs = []
+    for seglist in vc.split_genome(args.fai, int(args.nsegs), verbose=args.verbose):
+        segs.extend(seglist)
+
+    # genome order so the reduce step can concatenate partial VCFs
+    segs.sort(key=lambda seg: seg.start)
+    chrom_rank = {}
+    with open(args.fai, 'r') as fai:
+        for line in fai:
+            chrom_rank.setdefault(line.split()[0], len(chrom_rank))
+    segs.sort(key=lambda seg: chrom_rank[seg.chrom])
+
+    segdicts = [{'chrom': seg.chrom, 'start': seg.start, 'end': seg.end} for seg in segs]
+
+    # digests only read compressed input, far cheaper than comparing
+    jobs = [(input_files(config), d, config['margin']) for d in segdicts]
+    if int(args.procs) > 1:
+        pool = Pool(processes=int(args.procs))
+        digests = pool.map(segment_digest, jobs)
+        pool.close()
+        pool.join()
+    else:
+        digests = map(segment_digest, jobs)
+
+    reused = 0
+    for i, d in enumerate(segdicts):
+        segid = '%05d' % i
+        d['digest'] = digests[i]
+        write_json_atomic(d, jobpath(args.jobdir, 'segments', segid + '.json'))
+
+        old_segid, old_digest = prev.get((d['chrom'], d['start'], d['end']), (None, None))
+        if old_digest is not None and old_digest == d['digest']:
+            reuse_segment(args.jobdir, segid, args.previous, old_segid)
+            reused += 1
+        elif args.verbose and args.previous is not None:
+            sys.stderr.write("segment " + segid + " " + str(to_segment(d)) + " changed or new\n")
+
+    sys.stderr.write("wrote " + str(len(segs)) + " segments to " + args.jobdir + "\n")
+    if args.previous is not None:
+        sys.stderr.write(str(reused) + " unchanged segments reused from " + args.previous + ", " + str(len(segs) - reused) + " to run\n")
+
+def work(jobdir, verbose=False, max_segments=None, retries=2, stale_after=None):
+    ''' claim and run segments until none are left, returns number of segments run. A segment that
+        raises is recorded in failed/, its lock released and the worker moves on; segments that
+        failed more than retries times are left alone until requeue '''
+    config = read_json(jobpath(jobdir, 'config.json'))
+    strata = vc.get_strata(config_args(config)) # loaded once per worker
+    handles = vc.HandlePool()
+    worker = socket.gethostname() + ":" + str(os.getpid())
+    n = 0
+    failed = True
+    while failed: # another pass picks up the segments that failed in this one
+        failed = False
+        for segid in segment_ids(jobdir):
+            if max_segments is not None and n >= max_segments:
+                break
+            if is_done(jobdir, segid) or len(failures(jobdir, segid)) > retries or not claim(jobdir, segid, stale_after=stale_after):
+                continue
+
+            if verbose:
+                sys.stderr.write(worker + " running segment " + segid + "\n")
+            try:
+                run_segment(jobdir, config, segid, verbose=verbose, strata=strata, handles=handles)
+            except (Exception, SystemExit) as e: # parseVCFs exits on unreadable input
+                nfail = record_failure(jobdir, segid, repr(e))
+                sys.stderr.write(worker + " segment " + segid + " failed (attempt " + str(nfail) + "): " + repr(e) + "\n")
+                release(jobdir, segid)
+                handles = vc.HandlePool() # don't reuse readers left mid-fetch
+                failed = True
+                continue
+            n += 1
+
+    if verbose:
+        sys.stderr.write(socket.gethostname() + ":" + str(os.getpid()) + " " + handles.stats() + "\n")
+    return n
+
+def local(args):
+    ''' start several workers on this machine against the same job directory '''
+    workers = [Process(target=work, args=(args.jobdir, args.verbose, None, int(args.retries), args.stale_after)) for i in range(int(args.procs))]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    failed = [p.exitcode for p in workers if p.exitcode != 0]
+    if failed:
+        sys.exit("error: " + str(len(failed)) + " worker(s) failed")
+
+    missing = [segid for segid in segment_ids(args.jobdir) if not is_done(args.jobdir, segid)]
+    if missing:
+        sys.exit("error: " + str(len(missing)) + " segment(s) not done (first: " + missing[0] + "), see " + jobpath(args.jobdir, 'failed'))
+
+def requeue(args):
+    ''' release the locks of unfinished segments whose workers are gone, and clear failure records '''
+    released = cleared = 0
+    for segid in segment_ids(args.jobdir):
+        if is_done(args.jobdir, segid):
+            continue
+        failed = jobpath(args.jobdir, 'failed', segid + '.json')
+        if os.path.exists(failed):
+            os.remove(failed)
+            cleared += 1
+
+        lockfile = jobpath(args.jobdir, 'locks', segid + '.lock')
+        holder = lock_holder(lockfile)
+        if holder is None:
+            continue
+        if args.all or is_stale(holder, args.older_than):
+            if break_lock(lockfile, holder):
+                released += 1
+                if args.verbose:
+                    sys.stderr.write("segment " + segid + ": released lock of " + str(holder[0]) + ":" + str(holder[1]) + "\n")
+        elif args.verbose:
+            sys.stderr.write("segment " + segid + ": lock of " + str(holder[0]) + ":" + str(holder[1]) + " kept, holder may still be running\n")
+
+    sys.stderr.write("released " + str(released) + " lock(s), cleared " + str(cleared) + " failure record(s)\n")
+
+def reduce_results(args):
+    config = read_json(jobpath(args.jobdir, 'config.json'))
+    segids = segment_ids(args.jobdir)
+
+    missing = [segid for segid in segids if not is_done(args.jobdir, segid)]
+    if missing:
+        nfailed = len([segid for segid in missing if failures(args.jobdir, segid)])
+        sys.exit("error: " + str(len(missing)) + " of " + str(len(segids)) + " segments are not done, " + str(nfailed) + " failed (first: " + missing[0] + "), see requeue")
+
+    manifests = [read_json(jobpath(args.jobdir, 'done', segid + '.json')) for segid in segids]
+
+    summaries = vc.OrderedDict()
+    for manifest in manifests:
+        vc.merge_summaries(vc.read_summaries(jobpath(args.jobdir, manifest['summary'])), merged=summaries)
+
+    print "-"*60
+    for s in summaries.values():
+        print s.output()
+    print "-"*60
+
+    if args.summary_outfile is not None:
+        vc.write_summaries(summaries.values(), args.summary_outfile, fmt=args.summary_format)
+
+    if config.get('table') is not None:
+        # parts stay where the workers wrote them, the manifest lists them in genome order
+        table_manifest = sub('vcf.gz$', 'table.json', os.path.basename(config['vcf'][0]))
+        if args.outdir is not None:
+            table_manifest = os.path.join(args.outdir, table_manifest)
+        vc.write_table_manifest([(jobpath(args.jobdir, m['table'][0]), m['table'][1]) for m in manifests], table_manifest, fmt=config['table'])
+        sys.stderr.write("wrote table manifest " + table_manifest + "\n")
+
+    if not args.skip_merge:
+        sys.stderr.write("merging VCFs...\n")
+        for i, vcf_file in enumerate(config['vcf']):
+            key = ('vcfA', 'vcfB')[i]
+            matched   = [jobpath(args.jobdir, m[key][0]) for m in manifests]
+            unmatched = [jobpath(args.jobdir, m[key][1]) for m in manifests]
+            merge_vcfs(matched, sub('vcf.gz$', 'matched.vcf', vcf_file), outdir=args.outdir, verbose=args.verbose, remove_inputs=False)
+            merge_vcfs(unmatched, sub('vcf.gz$', 'unmatched.vcf', vcf_file), outdir=args.outdir, verbose=args.verbose, remove_inputs=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sharded vcfcomparator runs using a job directory on a shared filesystem')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p_init = subparsers.add_parser('init', help='split the genome and write segments to the job directory')
+    p_init.add_argument(metavar='<jobdir>', dest='jobdir', help='job directory (shared between nodes)')
+    p_init.add_argument(metavar='<vcf_file>', dest='vcf', nargs=2, help='tabix-indexed files in VCF format')
+    p_init.add_argument('-f', '--fai', dest='fai', required=True, help='.fai file generated by samtools faidx')
+    p_init.add_argument('-n', '--nsegs', dest='nsegs', default=100, help='number of segments (default 100)')
+    p_init.add_argument('-m', '--mask', dest='maskfile', default=None, help='tabix-indexed BED file of masked intervals')
+    p_init.add_argument('-t', '--truth', dest='truth', default=None, help='also compare results to a "truth" VCF (should be sorted and tabix-indexed)')
+    p_init.add_argument('--force', action='store_true', default=False, help='clear an existing job directory (segments, locks, results, done, failed) instead of refusing it')
+    p_init.add_argument('--previous', dest='previous', default=None, help='job directory of an earlier run (same .fai and -n), unchanged segments are reused')
+    p_init.add_argument('--margin', dest='margin', default=None, help='bp added to each side of a segment when computing its digest (default and minimum: --w_indel plus the ' + str(vc.W_SV) + ' bp breakend window)')
+    p_init.add_argument('--strat', dest='strat', action='append', default=None, help='<name>:<BED file>, also summarize variants overlapping these regions (may be repeated)')
+    p_init.add_argument('--indel_match', dest='indel_match', default='exact', choices=vc.INDEL_MATCH_MODES, help='exact: same REF/ALT (default). position: POS within --w_indel bp. length: also same type and length. similar: also similar inserted/deleted sequence. Tolerant modes match one-to-one, best first')
+    p_init.add_argument('--assign', dest='assign', default='first', choices=vc.ASSIGN_MODES, help='first: indel/SV matches go to the first candidate in fetch order (default). optimal: one-to-one assignment with maximum total score within each cluster of candidates')
+    p_init.add_argument('--w_indel', dest='w_indel', default=0, help='indel match window in bp (default 0)')
+    p_init.add_argument('--prefilter', dest='prefilter', nargs='?', const=0.01, default=None, help='workers skip fetches for SNVs/indels whose site is not in a Bloom filter of the other VCF (and truth), optional value: false positive rate (default 0.01)')
+    p_init.add_argument('--prefetch', dest='prefetch', default=0, help='workers read ahead this many batches of records in a background thread (default 0, off)')
+    p_init.add_argument('--table', dest='table', default=None, choices=vc.TABLE_FORMATS, help='workers also write a table part per segment, reduce lists them in <vcfA>.table.json')
+    p_init.add_argument('--score', dest='score', action='append', default=None, help='QUAL, INFO/<key> or FORMAT/<key> to add as a --table column (may be repeated)')
+    p_init.add_argument('--table_info', dest='table_info', action='append', default=None, help='INFO field to add as a --table column (may be repeated)')
+    p_init.add_argument('-p', '--procs', dest='procs', default=1, help='number of processes computing segment digests')
+
+    p_work = subparsers.add_parser('work', help='claim and run segments until none are left')
+    p_work.add_argument(metavar='<jobdir>', dest='jobdir', help='job directory')
+    p_work.add_argument('--max_segments', dest='max_segments', type=int, default=None, help='stop after this many segments')
+
+    p_local = subparsers.add_parser('local', help='run several workers on this machine')
+    p_local.add_argument(metavar='<jobdir>', dest='jobdir', help='job directory')
+    p_local.add_argument('-p', '--procs', dest='procs', default=1, help='number of worker processes')
+
+    for p in (p_work, p_local):
+        p.add_argument('--retries', dest='retries', default=2, help='skip segments that have failed more than this many times (default 2), requeue resets them')
+        p.add_argument('--stale_after', dest='stale_after', type=float, default=None, help='also take over locks older than this many seconds (default: only locks of dead processes on this host)')
+
+    p_requeue = subparsers.add_parser('requeue', help='release locks left by dead workers and clear failure records')
+    p_requeue.add_argument(metavar='<jobdir>', dest='jobdir', help='job directory')
+    p_requeue.add_argument('--older_than', dest='older_than', type=float, default=None, help='also release locks older than this many seconds, whatever host holds them')
+    p_requeue.add_argument('--all', action='store_true', default=False, help='release every lock of an unfinished segment (no workers may be running)')
+
+    p_reduce = subparsers.add_parser('reduce', help='merge summaries and partial VCFs once all segments are done')
+    p_reduce.add_argument(metavar='<jobdir>', dest='jobdir', help='job directory')
+    p_reduce.add_argument('-o', '--outdir', dest='outdir', default=None, help='directory for merged VCFs')
+    p_reduce.add_argument('-u', '--summary', dest='summary_outfile', default=None, help='also write summary to this file')
+    p_reduce.add_argument('--summary_format', dest='summary_format', default='text', choices=vc.SUMMARY_FORMATS, help='format for -u/--summary (default text)')
+    p_reduce.add_argument('--skip_merge', action='store_true', default=False, help='skip VCF merge step')
+
+    for p in (p_init, p_work, p_local, p_requeue, p_reduce):
+        p.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose mode for debugging')
+
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        init(args)
+    elif args.command == 'work':
+        work(args.jobdir, verbose=args.verbose, max_segments=args.max_segments, retries=int(args.retries), stale_after=args.stale_after)
+    elif args.command == 'local':
+        local(args)
+    elif args.command == 'requeue':
+        requeue(args)
+    elif args.command == 'reduce':
+        reduce_results(args)
@@ -6,23 +6,37 @@ Distributed under MIT license, see LICENSE.txt
 Contact: Adam Ewing (ewingad@soe.ucsc.edu)
 '''
 
-import vcf
-import pysam
 import argparse
 import itertools
 import sys
 import time
 import re
 import os
-import pp
+import array
+import struct
+import json
+import threading
+import Queue
+import gzip
+import heapq
+import math
+import socket
+import bgzf
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher
 from collections import OrderedDict
 
+# vcf (pyvcf) and pysam are imported inside the functions that use them: summary handling
+# (mergesummaries.py, shard_cmp.py reduce, ...) and --batch startup don't pay for loading them
+
 ## classes ##
 
 class Comparison:
     ''' stores the result of a one-way comparison vcfA --> vcfB
         imprements functions to report things about the comparison '''
-    def __init__(self):
+    def __init__(self, region=None):
+        self.region = region # (chrom, start, end) fetched from vcfA, Variant.ordinal counts records in it
+        self.clusters = None # ClusterStats of assigned matches (tolerant indels, --assign optimal)
         self.vartype = {}
         self.vartype['SNV']   = []
         self.vartype['INDEL'] = []
@@ -50,97 +64,135 @@ class Comparison:
         return countfunc
 
 
-class Variant:
-    ''' base class for variant types 
-        vcf_recA and vcf_recB are vcf._Record objects or None '''
-    def __init__(self, vcf_recA, vcf_recB):
-        self.recA = vcf_recA
-        self.recB = vcf_recB
-        self.recT = None # will be a VCF record if not None
+# Variant flag bits
+A_PASS    = 1
+A_SOMATIC = 2
+MATCHED   = 4
+B_PASS    = 8
+B_SOMATIC = 16
+TRUE      = 32
 
-        # if there is more than one match, the rest are stored here
-        self.altmatch = []
+def somatic_in_format(rec):
+    # no SS in FORMAT: skip the per-sample walk, which is costly on many-sample records
+    if not rec.FORMAT or 'SS' not in rec.FORMAT.split(':'):
+        return False
 
-    def __str__(self):
-        return str(self.recA) + "\t" + str(self.recB)
+    SS = []
+    for sample in rec.samples:
+        calldata = sample.data
+        if 'SS' in calldata._fields:
+            SS.append(calldata.SS)
 
-    def set_left(self, vcf_recB):
-        ''' sets record B only if it is not already set '''
-        if not self.recB:
-            self.recB = vcf_recB
-            return True
+    if '2' in SS or 2 in SS:
+        return True
+    return False
+
+def rec_pass(rec):
+    if rec is None:
         return False
+    if not rec.FILTER:
+        return True
+    return False
 
-    def interval_score(self):
-        ''' scoring function for intervals, based on amount of overlap '''
-        # get pos,end +/- confidence intervals if present
-        iv_a = get_conf_interval(self.recA)
-        iv_b = get_conf_interval(self.recB)
+def recA_is_somatic(rec):
+    ''' return True if rec (from the query VCF) is somatic, SOMATIC with SS=LOH is not '''
+    if str(rec.INFO.get('SS')).upper() in ['SOMATIC', '2']:
+        return True
 
-        ol_coords = get_overlap_coords(iv_a, iv_b)
-        ol_width = ol_coords[1] - ol_coords[0]
-        assert ol_width > 0
+    if rec.INFO.get('SOMATIC'):
+        if str(rec.INFO.get('SS')).upper() == 'LOH':
+            return False
+        return True
 
-        len_a = iv_a[1] - iv_a[0]
-        len_b = iv_b[1] - iv_b[0]
-        assert len_a > 0
-        assert len_b > 0
+    if somatic_in_format(rec):
+        return True
 
-        s = float(2*ol_width)/float(len_a+len_b)
+    return False
 
-        return s
+def recB_is_somatic(rec):
+    ''' return True if rec (the match in the other VCF) is somatic '''
+    if str(rec.INFO.get('SS')).upper() in ['SOMATIC', '2']:
+        return True
 
-    def somatic_in_format(self, rec):
-        SS = []
-        for sample in rec.samples:
-            calldata = sample.data
-            if 'SS' in calldata._fields:
-                SS.append(calldata.SS)
+    if rec.INFO.get('SOMATIC'):
+        return True
 
-        if '2' in SS or 2 in SS:
-            return True
-        return False
+    if somatic_in_format(rec):
+        return True
 
-    def matched(self):
-        if self.recA and self.recB:
-            return True
-        return False
+    return False
 
-    def is_true(self):
-        if self.recT is not None:
-            return True
-        return False
+def partner_key(rec):
+    ''' (CHROM, POS, ALT) identifying a matched record, multiple ALTs are joined by / '''
+    return (rec.CHROM, rec.POS, '/'.join(map(str, rec.ALT)))
 
-    def recA_somatic(self):
-        ''' return True if recA is somatic '''
-        if str(self.recA.INFO.get('SS')).upper() in ['SOMATIC', '2']:
-            return True
+class Variant(object):
+    ''' base class for variant types 
+        vcf_recA and vcf_recB are vcf._Record objects or None, the records are not kept:
+        only pass/somatic/matched/truth flags and the ordinal of recA in the fetch that produced
+        it (outputVCF uses it to find the record again). '''
+    __slots__ = ('flags', 'ordinal', 'strata', 'scores', 'partner', '_altmatch')
+
+    def __init__(self, vcf_recA, vcf_recB, ordinal=None):
+        self.flags    = 0
+        self.ordinal  = ordinal
+        self.strata   = 0    # bitmask of Strata the variant overlaps
+        self.scores   = None # values of the --score fields for recA
+        self.partner  = None # (CHROM, POS, ALT) of the matched recB
+        self._altmatch = None # allocated on first use, most variants have no extra matches
+
+        if vcf_recA is not None:
+            if rec_pass(vcf_recA):
+                self.flags |= A_PASS
+            if recA_is_somatic(vcf_recA):
+                self.flags |= A_SOMATIC
+
+        if vcf_recB is not None:
+            self.set_left(vcf_recB)
 
-        if self.recA.INFO.get('SOMATIC'):
-            if str(self.recA.INFO.get('SS')).upper() == 'LOH':
-                return False
-            return True
+    def __str__(self):
+        return str(self.ordinal) + "\t" + str(self.flags)
 
-        if self.somatic_in_format(self.recA):
-            return True
+    @property
+    def altmatch(self):
+        ''' (CHROM, POS, ALT) of matches beyond the first '''
+        if self._altmatch is None:
+            return []
+        return self._altmatch
+
+    def add_altmatch(self, vcf_recB):
+        if self._altmatch is None:
+            self._altmatch = []
+        self._altmatch.append(partner_key(vcf_recB))
 
+    def set_left(self, vcf_recB):
+        ''' sets record B only if it is not already set '''
+        if not self.flags & MATCHED:
+            self.flags |= MATCHED
+            self.partner = partner_key(vcf_recB)
+            if rec_pass(vcf_recB):
+                self.flags |= B_PASS
+            if recB_is_somatic(vcf_recB):
+                self.flags |= B_SOMATIC
+            return True
         return False
 
-    def recB_somatic(self):
-        ''' return True if recB is somatic '''
-        if not self.matched():
-            return False
+    def set_truth(self, vcf_recT):
+        self.flags |= TRUE
 
-        if str(self.recB.INFO.get('SS')).upper() in ['SOMATIC', '2']:
-            return True
+    def matched(self):
+        return bool(self.flags & MATCHED)
 
-        if self.recB.INFO.get('SOMATIC'):
-            return True
+    def is_true(self):
+        return bool(self.flags & TRUE)
 
-        if self.somatic_in_format(self.recB):
-            return True
+    def recA_somatic(self):
+        ''' return True if recA is somatic '''
+        return bool(self.flags & A_SOMATIC)
 
-        return False
+    def recB_somatic(self):
+        ''' return True if recB is somatic '''
+        return bool(self.flags & B_SOMATIC)
 
     def has_somatic(self):
         ''' return True if either call is somatic '''
@@ -177,41 +229,22 @@ class Variant:
 
     def has_pass(self):
         ''' return True if either filter is PASS '''
-        if not self.matched():
-            if not self.recA.FILTER:
-                return True
-            return False
-
-        if not self.recA.FILTER or not self.recB.FILTER:
-            return True
-
-        return False
+        return self.recA_pass() or self.recB_pass()
 
     def both_pass(self):
         ''' return True if both filters are PASS '''
-        if not self.matched():
-            return False
-
-        if not self.recA.FILTER and not self.recB.FILTER:
-            return True
-        return False
+        return self.recA_pass() and self.recB_pass()
 
     def recA_pass(self):
-        if self.recA is None:
-            return False
-        if not self.recA.FILTER:
-            return True
-        return False
+        return bool(self.flags & A_PASS)
 
     def recB_pass(self):
-        if self.recB is None:
-            return False
-        if not self.recB.FILTER:
-            return True
-        return False
+        return bool(self.flags & B_PASS)
 
 class SNV (Variant):
     ''' single nucleotide variant subclass '''
+    __slots__ = ()
+
     def vtype(self):
         if self.is_transition:
             return 'transition'
@@ -225,6 +258,8 @@ class SNV (Variant):
 
 class INDEL (Variant):
     ''' short insertion/deletion subclass '''
+    __slots__ = ()
+
     def vtype(self):
         pass
     def score(self):
@@ -232,19 +267,51 @@ class INDEL (Variant):
             return 1.0
         return 0.0
 
-class SV (Variant):
-    ''' structural variant subclass '''
+class IntervalVariant (Variant):
+    ''' keeps the (conf. interval padded) intervals of recA and recB for interval_score '''
+    __slots__ = ('ivA', 'ivB')
+
+    def __init__(self, vcf_recA, vcf_recB, ordinal=None):
+        self.ivA = self.ivB = None
+        if vcf_recA is not None:
+            self.ivA = conf_interval(vcf_recA)
+        Variant.__init__(self, vcf_recA, vcf_recB, ordinal=ordinal)
+
+    def set_left(self, vcf_recB):
+        if Variant.set_left(self, vcf_recB):
+            self.ivB = conf_interval(vcf_recB)
+            return True
+        return False
+
+    def interval_score(self):
+        ''' scoring function for intervals, based on amount of overlap '''
+        return interval_overlap_score(self.ivA, self.ivB)
+
     def score(self):
         if self.matched():
             return self.interval_score()
         return 0.0
 
-class CNV (Variant):
+def interval_overlap_score(iv_a, iv_b):
+    ''' 2 * overlap / (length A + length B) of two overlapping intervals '''
+    ol_coords = get_overlap_coords(iv_a, iv_b)
+    ol_width = ol_coords[1] - ol_coords[0]
+    assert ol_width > 0
+
+    len_a = iv_a[1] - iv_a[0]
+    len_b = iv_b[1] - iv_b[0]
+    assert len_a > 0
+    assert len_b > 0
+
+    return float(2*ol_width)/float(len_a+len_b)
+
+class SV (IntervalVariant):
+    ''' structural variant subclass '''
+    __slots__ = ()
+
+class CNV (IntervalVariant):
     ''' copy number variant subclass '''
-    def score(self):
-        if self.matched():
-            return self.interval_score()
-        return 0.0
+    __slots__ = ()
 
 class Segment:
     ''' used for segmenting the genome into chunks for threading '''
@@ -286,33 +353,33 @@ class Segment:
         return rseg
 
 class Summary:
+    ''' counts for each unmatched/matched category of one variant type
+        counts live in a fixed-order integer array (order from get_sumheader) so summaries
+        can be added and serialized without going through category names '''
     def __init__(self):
         self.infonames, self.uhnames, self.mhnames = get_sumheader() 
 
         self.info     = OrderedDict() 
-        self.unm_cats = OrderedDict() # unmatched categories
-        self.mat_cats = OrderedDict() # matched categories
+        self.catnames = get_catnames()
+        self.counts   = array.array('l', [0]*len(self.catnames))
 
         for infoname in self.infonames:
             self.info[infoname] = None
 
-        for uhname in self.uhnames:
-            for prefix in ('A_','B_'):
-                self.unm_cats[prefix + uhname] = 0
+    def key(self):
+        return tuple(self.info.values())
+
+    def get(self, catname):
+        return self.counts[CAT_INDEX[catname]]
 
-        for mhname in self.mhnames:
-            self.mat_cats[mhname] = 0
+    def inc(self, catname, n=1):
+        self.counts[CAT_INDEX[catname]] += n
 
     def add(self, other):
         assert self.info['vartype'] == other.info['vartype']
 
-        # matched categories
-        for mhname in other.mat_cats.keys():
-            self.mat_cats[mhname] += other.mat_cats[mhname]
-
-        # unmatched categories
-        for uhname in other.unm_cats.keys():
-            self.unm_cats[uhname] += other.unm_cats[uhname]
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
 
     def output(self):
         out = []
@@ -320,16 +387,285 @@ class Summary:
         for infoname, info in self.info.iteritems():
             out.append(' '.join((infoname, info)))
 
-        # unmatched categories
-        for catname, count in self.unm_cats.iteritems():
-            out.append(' '.join((catname, str(count))))
-
-        # matched categories
-        for catname, count in self.mat_cats.iteritems():
+        # unmatched categories, then matched categories
+        for catname, count in itertools.izip(self.catnames, self.counts):
             out.append(' '.join((catname, str(count))))
 
         return "\n".join(out)
 
+    def to_dict(self):
+        return {'info': self.info.items(), 'counts': self.counts.tolist()}
+
+    @staticmethod
+    def from_dict(d):
+        s = Summary()
+        for infoname, info in d['info']:
+            s.info[str(infoname)] = str(info)
+        assert len(d['counts']) == len(s.counts)
+        s.counts = array.array('l', d['counts'])
+        return s
+
+    def to_tsv(self):
+        return '\t'.join(map(str, self.info.values() + self.counts.tolist()))
+
+    @staticmethod
+    def from_tsv(header, line):
+        s = Summary()
+        c = line.rstrip('\n').split('\t')
+        ninfo = len(header) - len(s.counts)
+        for infoname, info in zip(header[:ninfo], c[:ninfo]):
+            s.info[infoname] = info
+        assert header[ninfo:] == s.catnames, "summary categories do not match this version"
+        s.counts = array.array('l', map(int, c[ninfo:]))
+        return s
+
+    def to_binary(self):
+        info = json.dumps(self.info.items())
+        return struct.pack('<H', len(info)) + info + struct.pack('<%dq' % len(self.counts), *self.counts)
+
+    @staticmethod
+    def from_binary(buf, offset=0):
+        ''' returns (Summary, offset after it) '''
+        s = Summary()
+        ninfo = struct.unpack_from('<H', buf, offset)[0]
+        offset += 2
+        for infoname, info in json.loads(buf[offset:offset+ninfo]):
+            s.info[str(infoname)] = str(info)
+        offset += ninfo
+        fmt = '<%dq' % len(s.counts)
+        s.counts = array.array('l', struct.unpack_from(fmt, buf, offset))
+        return s, offset + struct.calcsize(fmt)
+
+class Strata:
+    ''' named sets of BED regions (e.g. exome, segdup, high confidence) for stratified summaries
+        each set is merged into sorted interval lists per chromosome and queried with bisect,
+        mask() returns a bitmask with bit i set if an interval overlaps stratum i '''
+    def __init__(self, specs):
+        self.names = []
+        self.index = [] # per stratum: chrom --> (starts, ends) of merged intervals
+
+        for spec in specs:
+            name, bedfile = map(str, spec.split(':', 1)) # may come from json (unicode)
+            assert name not in self.names, "duplicate stratum name: " + name
+            self.names.append(name)
+            self.index.append(self.load_bed(bedfile))
+
+    def load_bed(self, bedfile):
+        opener = gzip.open if bedfile.endswith('.gz') else open
+        intervals = {}
+        with opener(bedfile, 'rb') as bed:
+            for line in bed:
+                if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                    continue
+                c = line.split()
+                intervals.setdefault(c[0], []).append((int(c[1]), int(c[2])))
+
+        index = {}
+        for chrom, ivs in intervals.iteritems():
+            ivs.sort()
+            starts, ends = [], []
+            for start, end in ivs:
+                if starts and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            index[chrom] = (starts, ends)
+        return index
+
+    def mask(self, chrom, start, end):
+        ''' bitmask of strata overlapping [start, end) (0-based, half open like BED) '''
+        end = max(end, start+1)
+        bits = 0
+        for i, index in enumerate(self.index):
+            if chrom not in index:
+                continue
+            starts, ends = index[chrom]
+            j = bisect_right(starts, end-1) - 1 # last interval starting before end
+            if j >= 0 and ends[j] > start:
+                bits |= 1 << i
+        return bits
+
+class HandlePool:
+    ''' open VCF readers and tabix files kept for the life of a worker, reused across segments,
+        directions (A --> B, B --> A) and batch requests. A reused pyvcf reader is reset by its next
+        fetch(), and a fetch() replaces the reader's iterator, so VCF readers are kept per role
+        (A, B, truth) as well as per file: the same file in two roles gets two readers and an inner
+        fetch can't clobber the outer iteration. opened/reused count how many opens (header parses,
+        index loads) happened and how many were avoided. '''
+    def __init__(self):
+        self.handles = {} # (kind, role, filename) --> handle
+        self.opened  = 0
+        self.reused  = 0
+
+    def get(self, kind, filename, opener, role=None):
+        key = (kind, role, filename)
+        if key in self.handles:
+            self.reused += 1
+        else:
+            self.handles[key] = opener(filename)
+            self.opened += 1
+        return self.handles[key]
+
+    def vcf(self, filename, role):
+        import vcf
+        return self.get('vcf', filename, lambda fn: vcf.Reader(filename=fn, compressed=True), role=role)
+
+    def tabix(self, filename):
+        import pysam
+        return self.get('tabix', filename, pysam.Tabixfile)
+
+    def stats(self):
+        return "handle pool: " + str(len(self.handles)) + " handles, " + str(self.opened) + " opened, " + str(self.reused) + " reopens avoided"
+
+class BloomFilter:
+    ''' Bloom filter over hash() values, sized for len(hashes) items at fp_rate false positives.
+        positions come from double hashing of the two halves of the (64 bit) hash '''
+    def __init__(self, hashes, fp_rate=0.01):
+        self.n = max(1, len(hashes))
+        self.m = max(64, int(-self.n * math.log(fp_rate) / math.log(2)**2))
+        self.k = max(1, int(round(float(self.m) / self.n * math.log(2))))
+        self.bits = bytearray((self.m + 7) // 8)
+        for h in hashes:
+            self.add(h)
+
+    def positions(self, h):
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return [(h1 + i*h2) % self.m for i in xrange(self.k)]
+
+    def add(self, h):
+        for i in self.positions(h):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, h):
+        for i in self.positions(h):
+            if not self.bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def fp_rate(self):
+        ''' expected false positive rate at the number of items added '''
+        return (1.0 - math.exp(-float(self.k) * self.n / self.m)) ** self.k
+
+INDEL_BIN = 1000 # prefilter keys indels by POS bin, they match anywhere in the fetch window
+
+class SitePrefilter:
+    ''' Bloom filter of the (CHROM, POS, REF, ALT) sites of a VCF (B or truth) in a region, built from the
+        raw lines. compareVCFs skips the fetch and vcfVariantMatch for SNVs and indels that cannot match:
+        SNVs need the exact site, indels the same REF/ALT somewhere in the window (looked up by POS bin).
+        Queries reaching outside the region that was read are never rejected. '''
+    def __init__(self, filename, chrom=None, start=0, end=int(1e9), margin=1000, fp_rate=0.01, handles=None):
+        t = time.time()
+        self.filename = filename
+        self.region   = (chrom, max(0, start - margin), end + margin)
+        if chrom is None:
+            self.region = (None, 0, 0) # whole file
+
+        hashes = array.array('l')
+        try:
+            for line in raw_records(filename, self.region, handles=handles):
+                c = line.split('\t', 5)
+                pos = int(c[1])
+                hashes.append(hash((c[0], pos, c[3], c[4])))
+                hashes.append(hash((c[0], pos // INDEL_BIN, c[3], c[4], INDEL_BIN)))
+        except ValueError: # contig not in the tabix index
+            pass
+
+        self.bloom    = BloomFilter(hashes, fp_rate=fp_rate)
+        self.sites    = len(hashes) // 2
+        self.seconds  = time.time() - t
+        self.queried  = 0
+        self.rejected = 0
+
+    def covers(self, chrom, start, end):
+        if self.region[0] is None:
+            return True
+        return chrom == self.region[0] and start >= self.region[1] and end <= self.region[2]
+
+    def may_match(self, vtype, rec, w_start, w_end):
+        ''' False if rec (SNV or INDEL) certainly has no match in the window '''
+        if vtype not in ('SNV', 'INDEL') or not self.covers(rec.CHROM, w_start - len(rec.REF), w_end + 1):
+            return True
+
+        self.queried += 1
+        alt = ','.join(map(str, rec.ALT))
+        if vtype == 'SNV':
+            found = hash((rec.CHROM, rec.POS, rec.REF, alt)) in self.bloom
+        else:
+            found = False
+            for b in xrange((w_start - len(rec.REF)) // INDEL_BIN, (w_end + 1) // INDEL_BIN + 1):
+                if hash((rec.CHROM, b, rec.REF, alt, INDEL_BIN)) in self.bloom:
+                    found = True
+                    break
+
+        if not found:
+            self.rejected += 1
+        return found
+
+    def stats(self):
+        return ("prefilter " + os.path.basename(self.filename) + ": " + str(self.sites) + " sites, built in " + "%.2f" % self.seconds + "s, "
+                + str(len(self.bloom.bits)) + " bytes, k=" + str(self.bloom.k) + ", expected fp rate " + "%.4f" % self.bloom.fp_rate())
+
+    def reject_stats(self):
+        return "prefilter " + os.path.basename(self.filename) + ": " + str(self.rejected) + " of " + str(self.queried) + " lookups rejected before fetch"
+
+class PrefetchReader:
+    ''' iterates over records produced by a background thread: batches of records are handed
+        over through a bounded queue so that tabix/BGZF decompression (zlib releases the GIL)
+        and file I/O overlap the comparison work in the main thread. Record order is unchanged.
+        close() stops the thread if the consumer stops early or raises, it is called when iteration
+        ends either way, compareVCFs also calls it. '''
+    def __init__(self, records, depth=4, batchsize=256):
+        self.queue = Queue.Queue(maxsize=depth)
+        self.stop  = threading.Event()
+        self.thread = threading.Thread(target=self._fill, args=(records, batchsize))
+        self.thread.daemon = True # don't hold up exit if the consumer stops early
+        self.thread.start()
+
+    def _put(self, item):
+        ''' blocking put that gives up once close() is called, returns False then '''
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _fill(self, records, batchsize):
+        batch = []
+        try:
+            for rec in records:
+                batch.append(rec)
+                if len(batch) >= batchsize:
+                    if not self._put(batch):
+                        return
+                    batch = []
+            if self._put(batch):
+                self._put(None)
+        except:
+            if self._put(batch):
+                self._put(sys.exc_info()) # re-raised in the consumer
+
+    def close(self):
+        ''' stop the producer thread and wait for it, it drops its record iterator on the way out '''
+        self.stop.set()
+        self.thread.join()
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, tuple):
+                    raise item[0], item[1], item[2]
+                for rec in item:
+                    yield rec
+        finally:
+            self.close()
+
 ## functions ##
 
 def get_conf_interval(rec, w_indel=0):
@@ -367,6 +703,14 @@ def get_conf_interval(rec, w_indel=0):
 
     return rec.POS-cipos_start, end
 
+def conf_interval(rec):
+    ''' get_conf_interval(rec), computed once and kept on the record '''
+    try:
+        return rec._conf_interval
+    except AttributeError:
+        rec._conf_interval = get_conf_interval(rec)
+        return rec._conf_interval
+
 def get_overlap_coords(iv_a, iv_b):
     ''' return start and end coordinates of overlap between iv_a and iv_b
         return 0,0 if no overlap
@@ -390,125 +734,462 @@ def vcfVariantMatch(recA, recB):
 
     # SVs have to be within w_sv of each other, pass vcfIntervalMatch
     if recA.is_sv and recB.is_sv and recA.INFO.get('SVTYPE') == recB.INFO.get('SVTYPE') == 'BND': 
-        orientA = orientSV(str(recA.ALT[0]))
-        orientB = orientSV(str(recB.ALT[0]))
-        if orientA == orientB and vcfIntervalMatch(recA, recB):
+        if sv_orient(recA) == sv_orient(recB) and vcfIntervalMatch(recA, recB):
             return True
     return False 
 
+INDEL_MATCH_MODES = ('exact', 'position', 'length', 'similar')
+INDEL_SIMILARITY  = 0.8 # 'similar' mode: minimum SequenceMatcher ratio of the inserted/deleted sequences
+
+def indel_allele(rec):
+    ''' (type, length, sequence) of the first ALT of an indel: INS/DEL/COMPLEX, bases inserted or deleted
+        (REF and ALT with the common prefix and suffix removed) '''
+    ref = rec.REF
+    alt = str(rec.ALT[0])
+    i = 0
+    while i < min(len(ref), len(alt)) and ref[i] == alt[i]:
+        i += 1
+    j = 0
+    while j < min(len(ref), len(alt)) - i and ref[-1-j] == alt[-1-j]:
+        j += 1
+    ref, alt = ref[i:len(ref)-j], alt[i:len(alt)-j]
+
+    if not ref:
+        return 'INS', len(alt), alt
+    if not alt:
+        return 'DEL', len(ref), ref
+    return 'COMPLEX', len(alt) - len(ref), ref + '>' + alt
+
+def indel_match_score(mode, k, recA, alleleA, recB, alleleB):
+    ''' 0 if recB is not a tolerant match for recA, else a score in (0, 1], 1 for identical alleles at the same POS
+        position: POS within k bp. length: also same type and length. similar: also same type and
+        inserted/deleted sequences at least INDEL_SIMILARITY alike. The score falls off with distance '''
+    d = abs(recA.POS - recB.POS)
+    if d > k:
+        return 0.0
+
+    sim = 1.0
+    if recA.REF != recB.REF or recA.ALT != recB.ALT:
+        if mode in ('length', 'similar') and alleleA[0] != alleleB[0]:
+            return 0.0
+        if mode == 'length' and alleleA[1] != alleleB[1]:
+            return 0.0
+        if mode == 'similar':
+            sim = SequenceMatcher(None, alleleA[2], alleleB[2]).ratio()
+            if sim < INDEL_SIMILARITY:
+                return 0.0
+
+    return sim * (1.0 - float(d)/(k+1))
+
+class IndelIndex:
+    ''' the indels of a VCF in a region, per chromosome sorted by POS, for tolerant indel matching:
+        candidates within k bp of a position are found with bisect instead of a tabix fetch each '''
+    def __init__(self, records):
+        self.pos     = {} # chrom --> sorted POS
+        self.entries = {} # chrom --> (rec, indel_allele(rec)) in the same order
+        for rec in records:
+            if rec.is_indel:
+                self.pos.setdefault(rec.CHROM, []).append(rec.POS)
+                self.entries.setdefault(rec.CHROM, []).append((rec, indel_allele(rec)))
+
+        for chrom in self.pos.keys(): # tabix output is sorted, whole-file input may not be
+            if self.pos[chrom] != sorted(self.pos[chrom]):
+                order = sorted(range(len(self.pos[chrom])), key=self.pos[chrom].__getitem__)
+                self.pos[chrom] = [self.pos[chrom][i] for i in order]
+                self.entries[chrom] = [self.entries[chrom][i] for i in order]
+
+    def candidates(self, chrom, pos, k):
+        ''' (index, rec, allele) of the indels with POS within k bp of pos '''
+        if chrom not in self.pos:
+            return []
+        p = self.pos[chrom]
+        return [(i, self.entries[chrom][i][0], self.entries[chrom][i][1]) for i in xrange(bisect_left(p, pos - k), bisect_right(p, pos + k))]
+
+ASSIGN_MODES  = ('first', 'optimal')
+HUNGARIAN_MAX = 12 # clusters with at most this many records on each side are solved exactly, larger ones greedily
+
+def hungarian(score):
+    ''' maximum total score assignment for a (rows x cols) score matrix (Kuhn-Munkres, O(n^3))
+        returns (row, col) pairs with score > 0 '''
+    n = max(len(score), len(score[0]))
+    cost = [[-score[i][j] if i < len(score) and j < len(score[0]) else 0.0 for j in range(n)] for i in range(n)]
+
+    inf = float('inf')
+    u = [0.0] * (n+1)
+    v = [0.0] * (n+1)
+    p = [0] * (n+1) # p[j]: row (1-based) assigned to column j
+    way = [0] * (n+1)
+    for i in range(1, n+1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (n+1)
+        used = [False] * (n+1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = inf
+            j1 = 0
+            for j in range(1, n+1):
+                if not used[j]:
+                    cur = cost[i0-1][j-1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(n+1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+
+    return [(p[j]-1, j-1) for j in range(1, n+1) if p[j] and p[j]-1 < len(score) and j-1 < len(score[0]) and score[p[j]-1][j-1] > 0]
+
+class ClusterStats:
+    ''' sizes (A + B records) of the connected clusters of the match candidate graph, and where the largest is '''
+    def __init__(self):
+        self.sizes   = {} # size --> number of clusters
+        self.largest = (0, None, None) # (size, CHROM, POS)
+
+    def add(self, size, chrom, pos):
+        self.sizes[size] = self.sizes.get(size, 0) + 1
+        if size > self.largest[0]:
+            self.largest = (size, chrom, pos)
+
+    def report(self):
+        hist = ' '.join([str(size) + ':' + str(self.sizes[size]) for size in sorted(self.sizes.keys())])
+        out = "match clusters: " + str(sum(self.sizes.values())) + " (size:count " + hist + ")"
+        if self.largest[1] is not None:
+            out += ", largest " + str(self.largest[0]) + " at " + str(self.largest[1]) + ":" + str(self.largest[2])
+        return out
+
+def assign_pairs(pairs, method='greedy', stats=None):
+    ''' resolve candidate pairs (score, a, b, recB) into one-to-one matches within each connected cluster
+        of the candidate graph: by score (greedy) or, with method 'optimal', maximum total score
+        (hungarian) for clusters up to HUNGARIAN_MAX on each side.
+        returns (a, recB, won) for every pair, winners first within each cluster '''
+    parent = {}
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for score, a, b, recB in pairs:
+        parent[find(('A', a))] = find(('B', b))
+
+    clusters = OrderedDict()
+    for pair in sorted(pairs, key=lambda pair: (-pair[0], pair[1], pair[2])):
+        clusters.setdefault(find(('A', pair[1])), []).append(pair)
+
+    out = []
+    for cluster in clusters.values():
+        rows = sorted(set([a for score, a, b, recB in cluster]))
+        cols = sorted(set([b for score, a, b, recB in cluster]))
+        if stats is not None:
+            stats.add(len(rows) + len(cols), cluster[0][3].CHROM, cluster[0][3].POS)
+
+        won = set()
+        if method == 'optimal' and len(cluster) > 1 and max(len(rows), len(cols)) <= HUNGARIAN_MAX:
+            row_index = dict([(a, i) for i, a in enumerate(rows)])
+            col_index = dict([(b, j) for j, b in enumerate(cols)])
+            score = [[0.0] * len(cols) for a in rows]
+            for sc, a, b, recB in cluster:
+                score[row_index[a]][col_index[b]] = max(sc, score[row_index[a]][col_index[b]])
+            won = set([(rows[i], cols[j]) for i, j in hungarian(score)])
+        else:
+            used_a = set()
+            used_b = set()
+            for sc, a, b, recB in cluster:
+                if a not in used_a and b not in used_b:
+                    won.add((a, b))
+                    used_a.add(a)
+                    used_b.add(b)
+
+        out.extend([(a, recB, True) for sc, a, b, recB in cluster if (a, b) in won])
+        out.extend([(a, recB, False) for sc, a, b, recB in cluster if (a, b) not in won])
+
+    return out
+
 def vcfIntervalMatch(recA, recB):
     ''' match SV/CNV intervals using POS/END/CIPOS/CIEND '''
     assert recA.INFO.get('SVTYPE') == recB.INFO.get('SVTYPE')
 
-    iv_A = get_conf_interval(recA)
-    iv_B = get_conf_interval(recB)
+    iv_A = conf_interval(recA)
+    iv_B = conf_interval(recB)
 
     if sum(get_overlap_coords(iv_A, iv_B)) > 0.0:
         return True
     return False
 
+W_SV = 1000 # breakend match window in bp
+
 # copy of file handle for snv iteration and interval fetch
-def compareVCFs(h_vcfA, h_interval_vcfB, verbose=False, w_indel=0, w_sv=1000, mask=None, truth=None, chrom=None, fetch_start=0, fetch_end=int(1e9)): 
+def compareVCFs(h_vcfA, h_interval_vcfB, verbose=False, w_indel=0, w_sv=W_SV, mask=None, truth=None, chrom=None, fetch_start=0, fetch_end=int(1e9), prefetch=0, threads=0, strata=None, score_fields=None, prefilter=None, prefilter_truth=None, indel_match='exact', assign='first'): 
     ''' does most of the work - unidirectional comparison vcfA --> vcfB
-        h_vcfA and h_vcfB are pyvcf handles (vcf.Reader) '''
-
-    h_snv_vcfB = vcf.Reader(filename=h_interval_vcfB.filename, compressed=h_interval_vcfB.filename.endswith('.gz'))
-
-    cmp = Comparison()
-
-    # keep match symmetric by adding B records already seen to altmatch (intervals only)
+        h_vcfA and h_vcfB are pyvcf handles (vcf.Reader)
+        score_fields (e.g. ['QUAL', 'INFO/TLOD']) are recorded on each variant for pr_curves()
+        strata (a Strata object) tags each variant with the stratification regions it overlaps
+        prefetch > 0 reads vcfA in a background thread, queueing up to that many batches
+        threads > 0 inflates vcfA blocks in parallel on whole-file runs (chrom is None)
+        prefilter/prefilter_truth (SitePrefilter of vcfB/truth) skip fetches for SNVs/indels that can't match
+        indel_match other than 'exact': indels match within w_indel bp by indel_match_score, candidates come
+        from an IndelIndex of vcfB and each B indel is assigned to at most one A indel, best scores first
+        assign 'optimal': indel and SV matches are collected and assigned one-to-one per cluster of candidates
+        (see assign_pairs) instead of keeping the first match in fetch order, tolerant indels get the same '''
+
+    import vcf
+
+    cmp = Comparison(region=(chrom, fetch_start, fetch_end))
+
+    # keep match symmetric by adding B records already seen to altmatch (intervals only), keyed by sv_uid
     used_B_interval = {}
+    cache_B = RecordCache(max(w_indel, w_sv))
+    cache_T = RecordCache(max(w_indel, w_sv))
 
     recnum = 0
     nskip = 0
 
     # "int(1e9)" is just a value larger than any hg19 chromosome, fetch(chrom,start) not supported
-    for recA in h_vcfA.fetch(chrom,fetch_start,fetch_end):
-        recnum += 1
-        if mask:
-            # skip variants on chromosomes not in mask
-            if recA.CHROM not in mask.contigs:
-                nskip += 1
-                continue
+    if chrom is None and threads > 0 and bgzf.is_bgzf(h_vcfA.filename):
+        records = vcf.Reader(fsock=bgzf.MmapBgzfReader(h_vcfA.filename, threads=threads), compressed=False)
+    else:
+        records = h_vcfA.fetch(chrom,fetch_start,fetch_end)
 
-            if len(list(mask.fetch(recA.CHROM, recA.POS, recA.POS+1))) > 0:
-                nskip += 1
-                continue
+    if prefetch > 0:
+        records = PrefetchReader(records, depth=prefetch)
 
-        if verbose:
-            if recnum % 10000 == 0:
-                localtime = time.asctime(time.localtime(time.time()))
-                sys.stderr.write(str(localtime) + ": " + os.path.basename(h_vcfA.filename) + " vs " 
-                                 + os.path.basename(h_interval_vcfB.filename) + ": " + str(recnum) 
-                                 + " records compared, pos: " + str(recA.CHROM) + ":"
-                                 + str(recA.POS) + " masked: " + str(nskip) + "\n")
-
-        match = False
-        vtype = None
-        variant = None
-        w = 0
-
-        if recA.is_snp:
-            vtype = 'SNV'
-            variant = SNV(recA, None)
-
-        elif recA.is_indel:
-            vtype = 'INDEL'
-            variant = INDEL(recA, None)
-            w = w_indel
-
-        elif recA.is_sv and recA.INFO.get('SVTYPE') == 'BND':
-            vtype = 'SV'
-            variant = SV(recA, None)
-            w = w_sv
-
-        elif recA.ALT == 'CNV':
-            vtype = 'CNV'
-            variant = CNV(recA, None)
-
-        if vtype in ('SNV', 'SV', 'INDEL'): # only compare intervals for known variant types
-            w_start = recA.start-w
-            w_end = recA.end+w
-            if w_start < 1:
-                w_start = 1
-
-            # try to find a match in the other VCF
-            try:
-                for recB in h_interval_vcfB.fetch(recA.CHROM, w_start, w_end):
-                    if vcfVariantMatch(recA, recB):
-                        if match: # handle one-to-many matches
-                            variant.altmatch.append(recB)
-                        else:
-                            assert variant.recB is None
-
-                            # special case for intervals
-                            if vtype in ('INDEL','SV','CNV') and sv_uid(recB) in used_B_interval:
-                                variant.altmatch.append(recB)
-
-                            elif variant.set_left(recB):
-                                used_B_interval[sv_uid(recB)] = recA
-                                match = True
-            except:
-                sys.stderr.write(' '.join(("warning: couldn't fetch from region:", str(recA.CHROM), str(w_start), str(w_end), "\n")))
-
-            # compare to truth if present
-            if truth is not None:
-                n_missing_regions = 0
+    # tolerant indel matching: index B (and truth) indels once, A indels near a region edge may
+    # reach further out than the margin, those are compared with what was read
+    index_B = index_T = None
+    if indel_match != 'exact':
+        def indel_source(h):
+            if chrom is None:
+                return vcf.Reader(filename=h.filename, compressed=True)
+            return h.fetch(chrom, max(0, fetch_start - w_indel - 1000), fetch_end + w_indel + 1000)
+
+        index_B = IndelIndex(indel_source(h_interval_vcfB))
+        if truth is not None:
+            index_T = IndelIndex(indel_source(truth))
+
+    pending_variants = [] # A variants waiting for assignment (tolerant indels, --assign optimal)
+    pending_pairs    = [] # (score, index in pending_variants, B key, recB)
+
+    try:
+        for recA in records:
+            recnum += 1
+            if mask:
+                # skip variants on chromosomes not in mask
+                if recA.CHROM not in mask.contigs:
+                    nskip += 1
+                    continue
+
+                if len(list(mask.fetch(recA.CHROM, recA.POS, recA.POS+1))) > 0:
+                    nskip += 1
+                    continue
+
+            if verbose:
+                if recnum % 10000 == 0:
+                    localtime = time.asctime(time.localtime(time.time()))
+                    sys.stderr.write(str(localtime) + ": " + os.path.basename(h_vcfA.filename) + " vs " 
+                                     + os.path.basename(h_interval_vcfB.filename) + ": " + str(recnum) 
+                                     + " records compared, pos: " + str(recA.CHROM) + ":"
+                                     + str(recA.POS) + " masked: " + str(nskip) + "\n")
+
+            match = False
+            vtype = None
+            variant = None
+            w = 0
+
+            if recA.is_snp:
+                vtype = 'SNV'
+                variant = SNV(recA, None, ordinal=recnum-1)
+
+            elif recA.is_indel:
+                vtype = 'INDEL'
+                variant = INDEL(recA, None, ordinal=recnum-1)
+                w = w_indel
+
+            elif recA.is_sv and recA.INFO.get('SVTYPE') == 'BND':
+                vtype = 'SV'
+                variant = SV(recA, None, ordinal=recnum-1)
+                w = w_sv
+
+            elif recA.ALT == 'CNV':
+                vtype = 'CNV'
+                variant = CNV(recA, None, ordinal=recnum-1)
+
+            if vtype in ('SNV', 'SV', 'INDEL'): # only compare intervals for known variant types
+                if strata is not None:
+                    variant.strata = strata.mask(recA.CHROM, recA.start, recA.end)
+
+                if score_fields:
+                    variant.scores = tuple([score_value(recA, field) for field in score_fields])
+
+                if vtype == 'INDEL' and index_B is not None:
+                    alleleA = indel_allele(recA)
+                    for i, recB, alleleB in index_B.candidates(recA.CHROM, recA.POS, w_indel):
+                        score = indel_match_score(indel_match, w_indel, recA, alleleA, recB, alleleB)
+                        if score > 0:
+                            pending_pairs.append((score, len(pending_variants), (recB.CHROM, i), recB))
+                    pending_variants.append(variant)
+
+                    if index_T is not None:
+                        for i, recT, alleleT in index_T.candidates(recA.CHROM, recA.POS, w_indel):
+                            if indel_match_score(indel_match, w_indel, recA, alleleA, recT, alleleT) > 0:
+                                variant.set_truth(recT)
+                                break
+
+                    cmp.vartype[vtype].append(variant)
+                    continue
+
+                w_start = recA.start-w
+                w_end = recA.end+w
+                if w_start < 1:
+                    w_start = 1
+
+                # with --assign optimal indel/SV candidates are collected here and assigned after the scan
+                deferred = assign == 'optimal' and vtype in ('INDEL', 'SV')
+
+                # try to find a match in the other VCF, unless the prefilter rules it out
                 try:
-                    for recT in truth.fetch(recA.CHROM, w_start, w_end):
-                        if vcfVariantMatch(recA, recT):
-                            variant.recT = recT
+                    candidates = ()
+                    if prefilter is None or prefilter.may_match(vtype, recA, w_start, w_end):
+                        candidates = cache_B.fetched(h_interval_vcfB.fetch(recA.CHROM, w_start, w_end), w_start)
+                    for recB in candidates:
+                        if vcfVariantMatch(recA, recB):
+                            if deferred:
+                                if vtype == 'SV':
+                                    score = interval_overlap_score(conf_interval(recA), conf_interval(recB))
+                                else:
+                                    score = 1.0/(1 + abs(recA.POS - recB.POS))
+                                pending_pairs.append((score, len(pending_variants), sv_uid(recB), recB))
+
+                            elif match: # handle one-to-many matches
+                                variant.add_altmatch(recB)
+                            else:
+                                assert not variant.matched()
+
+                                # special case for intervals
+                                if vtype in ('INDEL','SV','CNV') and sv_uid(recB) in used_B_interval:
+                                    variant.add_altmatch(recB)
+
+                                elif variant.set_left(recB):
+                                    used_B_interval[sv_uid(recB)] = variant.ordinal
+                                    match = True
                 except:
-                    n_missing_regions += 1
-
-            cmp.vartype[vtype].append(variant)
+                    sys.stderr.write(' '.join(("warning: couldn't fetch from region:", str(recA.CHROM), str(w_start), str(w_end), "\n")))
+
+                if deferred:
+                    pending_variants.append(variant)
+
+                # compare to truth if present
+                if truth is not None:
+                    n_missing_regions = 0
+                    try:
+                        candidates = ()
+                        if prefilter_truth is None or prefilter_truth.may_match(vtype, recA, w_start, w_end):
+                            candidates = cache_T.fetched(truth.fetch(recA.CHROM, w_start, w_end), w_start)
+                        for recT in candidates:
+                            if vcfVariantMatch(recA, recT):
+                                variant.set_truth(recT)
+                    except:
+                        n_missing_regions += 1
+
+                cmp.vartype[vtype].append(variant)
+    finally:
+        if prefetch > 0:
+            records.close() # the reader thread would otherwise block on a full queue for good
+
+    # one-to-one assignment of the collected matches, candidates that lose go to altmatch,
+    # as for one-to-many matches found in fetch order
+    if pending_pairs:
+        cmp.clusters = ClusterStats()
+        for a, recB, won in assign_pairs(pending_pairs, method=('optimal' if assign == 'optimal' else 'greedy'), stats=cmp.clusters):
+            if won:
+                pending_variants[a].set_left(recB)
+            else:
+                pending_variants[a].add_altmatch(recB)
 
     return cmp
 
 def sv_uid(rec):
-    ''' makes a (hopefully) unique id for an SV record '''
-    fields = (rec.CHROM,rec.POS,rec.ID,rec.REF,rec.ALT,rec.QUAL,rec.FILTER,rec.INFO)
-    return ','.join(map(str,fields))
+    ''' makes a (hopefully) unique id for an SV record, computed once and kept on the record
+        (RecordCache carries it over to the same record fetched again) '''
+    try:
+        return rec._sv_uid
+    except AttributeError:
+        fields = (rec.CHROM,rec.POS,rec.ID,rec.REF,rec.ALT,rec.QUAL,rec.FILTER,rec.INFO)
+        rec._sv_uid = ','.join(map(str,fields))
+        return rec._sv_uid
+
+class RecordCache:
+    ''' sv_uid, sv_orient and conf_interval of fetched records, kept across fetches: pyvcf makes new
+        record objects on every fetch, so the values cached on a B record would otherwise be lost
+        before the next A record. Records are keyed by (CHROM, POS, ordinal), ordinal counting the
+        records at that position in file order. A fetch returns every record starting inside the
+        window, so the ordinal is only trusted for those; records reaching in from before the
+        window are left alone. reach is the widest match window, A records come in order so
+        entries more than that behind a fetch are dropped. '''
+    ATTRS = ('_sv_uid', '_sv_orient', '_conf_interval')
+
+    def __init__(self, reach, maxsize=100000):
+        self.reach   = reach
+        self.maxsize = maxsize
+        self.cache   = {} # (CHROM, POS, ordinal) --> {attribute: value}
+
+    def fetched(self, records, fetch_start):
+        ''' records of a fetch from fetch_start (0-based), with cached values put back on them
+            and newly computed ones saved once the caller moves on to the next record '''
+        if len(self.cache) > self.maxsize:
+            self.prune(fetch_start)
+
+        pos, ordinal = None, 0
+        for rec in records:
+            if (rec.CHROM, rec.POS) == pos:
+                ordinal += 1
+            else:
+                pos, ordinal = (rec.CHROM, rec.POS), 0
+
+            key = None
+            if rec.start >= fetch_start:
+                key = (rec.CHROM, rec.POS, ordinal)
+                for attr, value in self.cache.get(key, {}).iteritems():
+                    setattr(rec, attr, value)
+
+            yield rec
+
+            if key is not None:
+                values = dict([(attr, rec.__dict__[attr]) for attr in self.ATTRS if attr in rec.__dict__])
+                if values:
+                    self.cache[key] = values
+
+    def prune(self, fetch_start):
+        self.cache = dict([(key, values) for key, values in self.cache.iteritems() if key[1] - 1 >= fetch_start - self.reach])
+
+def sv_orient(rec):
+    ''' orientSV of the first ALT, computed once and kept on the record '''
+    try:
+        return rec._sv_orient
+    except AttributeError:
+        rec._sv_orient = orientSV(str(rec.ALT[0]))
+        return rec._sv_orient
+
+ORIENT_PATTERNS = ((re.compile('^[A-Z]\['), 'right_of_p_after_t'),
+                   (re.compile('^[A-Z]\]'), 'left_of_p_after_t'),
+                   (re.compile('^\]'),      'left_of_p_before_t'),
+                   (re.compile('^\['),      'right_of_p_before_t'))
 
 def orientSV(alt):
     '''
@@ -518,21 +1199,11 @@ def orientSV(alt):
     s     ]p]t   piece extending to the left of p is joined before t
     s     [p[t   reverse comp piece extending right of p is joined before t
     '''
-    orient = alt # return info line by default
-
-    if re.search('^[A-Z]\[',alt):
-        orient = 'right_of_p_after_t'
+    for pattern, orient in ORIENT_PATTERNS:
+        if pattern.search(alt):
+            return orient
 
-    elif re.search('^[A-Z]\]',alt):
-        orient = 'left_of_p_after_t'
-
-    elif re.search('^\]',alt):
-        orient = 'left_of_p_before_t'
-
-    elif re.search('^\[',alt):
-        orient = 'right_of_p_before_t'
-
-    return orient
+    return alt # return info line by default
 
 def get_sumheader(return_bool = False):
     ''' build category names for comparisons '''
@@ -587,49 +1258,315 @@ def get_sumheader(return_bool = False):
 
     return infonames, uhnames, mhnames
 
-def summary(compAB_list, compBA_list):
-    ''' summarize A --> B comparison and B --> A comparison '''
-    s = {}
-    n_shared_AB = 0
-    n_shared_BA = 0
+def get_catnames():
+    ''' all category names in Summary.counts order: unmatched A_, unmatched B_, matched '''
+    infonames, uhnames, mhnames = get_sumheader()
+    catnames = []
+    for uhname in uhnames:
+        for prefix in ('A_','B_'):
+            catnames.append(prefix + uhname)
+    return catnames + mhnames
+
+CAT_INDEX = dict([(name, i) for i, name in enumerate(get_catnames())])
+
+SUMMARY_MAGIC   = 'VCSM'
+SUMMARY_VERSION = 1
+SUMMARY_FORMATS = ('text', 'tsv', 'json', 'binary')
+
+def dumps_summaries(summaries, fmt='text'):
+    ''' serialize a list of Summary objects, any format can be read back by loads_summaries '''
+    assert fmt in SUMMARY_FORMATS
+
+    if fmt == 'text':
+        return ''.join([s.output() + "\n" for s in summaries])
+
+    if fmt == 'tsv':
+        header = Summary().infonames + get_catnames()
+        if summaries:
+            header = summaries[0].info.keys() + get_catnames()
+        return '\t'.join(header) + "\n" + ''.join([s.to_tsv() + "\n" for s in summaries])
+
+    if fmt == 'json':
+        return json.dumps({'categories': get_catnames(), 'summaries': [s.to_dict() for s in summaries]}) + "\n"
+
+    out = [struct.pack('<4sHHI', SUMMARY_MAGIC, SUMMARY_VERSION, len(CAT_INDEX), len(summaries))]
+    for s in summaries:
+        out.append(s.to_binary())
+    return ''.join(out)
+
+def loads_summaries(buf):
+    ''' parse output of dumps_summaries (format is detected), returns list of Summary objects '''
+    summaries = []
+
+    if buf.startswith(SUMMARY_MAGIC):
+        magic, version, ncats, n = struct.unpack_from('<4sHHI', buf, 0)
+        assert version == SUMMARY_VERSION and ncats == len(CAT_INDEX), "summary categories do not match this version"
+        offset = struct.calcsize('<4sHHI')
+        for i in range(n):
+            s, offset = Summary.from_binary(buf, offset)
+            summaries.append(s)
+
+    elif buf.startswith('{'):
+        d = json.loads(buf)
+        assert d['categories'] == get_catnames(), "summary categories do not match this version"
+        summaries = [Summary.from_dict(sd) for sd in d['summaries']]
+
+    elif buf.split("\n", 1)[0].find('\t') >= 0:
+        lines = buf.splitlines()
+        header = lines[0].split('\t')
+        summaries = [Summary.from_tsv(header, line) for line in lines[1:] if line.strip()]
+
+    else: # text, "name count" lines, a new summary starts at each info block
+        s = None
+        infonames = Summary().infonames
+        for line in buf.splitlines():
+            if not line.strip():
+                continue
+            name, value = line.strip().split(' ', 1)
+            if name in CAT_INDEX:
+                s.counts[CAT_INDEX[name]] = int(value)
+            else:
+                if s is None or s.info.get(name) is not None:
+                    s = Summary()
+                    summaries.append(s)
+                s.info[name] = value
+
+    return summaries
+
+def read_summaries(filename):
+    with open(filename, 'rb') as f:
+        return loads_summaries(f.read())
+
+def write_summaries(summaries, filename, fmt='text'):
+    with open(filename, 'wb') as f:
+        f.write(dumps_summaries(summaries, fmt=fmt))
+
+def merge_summaries(summaries, merged=None):
+    ''' add up any number of Summary objects (associative, order does not matter)
+        merged is a dict of key --> Summary, summaries with the same info (e.g. vartype) are added together '''
+    if merged is None:
+        merged = OrderedDict()
+
+    for s in summaries:
+        if s.key() not in merged:
+            merged[s.key()] = Summary.from_dict(s.to_dict()) # copy
+        else:
+            merged[s.key()].add(s)
+
+    return merged
+
+def summary(compAB_list, compBA_list, strata=None):
+    ''' summarize A --> B comparison and B --> A comparison, one pass over the variants
+        with strata (a Strata object) there is also one Summary per vtype and stratum, keyed by
+        (vtype, stratum), and every summary gets a 'stratum' info field ('all' for the overall one) '''
+    s = OrderedDict()
+    n_shared_AB = dict([(vtype, 0) for vtype in compAB_list[0].vartype.keys()])
+    n_shared_BA = dict([(vtype, 0) for vtype in compAB_list[0].vartype.keys()])
 
     for vtype in compAB_list[0].vartype.keys():
         assert compBA_list[0].vartype.has_key(vtype)
         s[vtype] = Summary()
         s[vtype].info['vartype'] = vtype
 
-        bool_cmplist = get_sumheader(return_bool=True)
-        name_cmplist = get_sumheader()
+        # per stratum summaries, index i <--> bit i of Variant.strata
+        by_stratum = []
+        if strata is not None:
+            s[vtype].info['stratum'] = 'all'
+            for name in strata.names:
+                ss = Summary()
+                ss.info['vartype'] = vtype
+                ss.info['stratum'] = name
+                s[(vtype, name)] = ss
+                by_stratum.append(ss)
+
+        def inc(var, cats):
+            targets = [s[vtype]]
+            for i, ss in enumerate(by_stratum):
+                if var.strata >> i & 1:
+                    targets.append(ss)
+            for t in targets:
+                for cat in cats:
+                    t.inc(cat)
 
         for compAB, compBA in itertools.izip(compAB_list, compBA_list):
-            unmatched_cat_names = name_cmplist[1]
-            matched_cat_names   = name_cmplist[2]
-
-            # unmatched stats
-            for cat, bools in itertools.izip(unmatched_cat_names, bool_cmplist[1]):
-                # parameters for build_comparator
-                p_matched, p_passA, p_somA, p_truth = bools
-                for prefix in ('A_', 'B_'):
-                    if prefix == 'A_':
-                        s[vtype].unm_cats[prefix+cat] += compAB.build_comparator(vtype, matched=p_matched, passA=p_passA, somA=p_somA, truth=p_truth)(vtype)
-                    if prefix == 'B_': # note passA, somA are the correct parameters as tis comparison (compBA) means A <==> B
-                        s[vtype].unm_cats[prefix+cat] += compBA.build_comparator(vtype, matched=p_matched, passA=p_passA, somA=p_somA, truth=p_truth)(vtype)
+            # unmatched stats, note passA, somA are the correct parameters for compBA as it means A <==> B
+            for prefix, comp in (('A_', compAB), ('B_', compBA)):
+                for var in comp.vartype[vtype]:
+                    if not var.matched():
+                        inc(var, [prefix + cat for cat in unmatched_categories(var)])
 
             # matched stats
-            for cat, bools in itertools.izip(matched_cat_names, bool_cmplist[2]):
-                p_matched, p_passA, p_passB, p_somA, p_somB, p_truth = bools
-                s[vtype].mat_cats[cat] += compAB.build_comparator(vtype, matched=p_matched, passA=p_passA, passB=p_passB, somA=p_somA, somB=p_somB, truth=p_truth)(vtype)
+            for var in compAB.vartype[vtype]:
+                if var.matched():
+                    inc(var, matched_categories(var))
+                    n_shared_AB[vtype] += 1
+
+            for var in compBA.vartype[vtype]:
+                if var.matched():
+                    n_shared_BA[vtype] += 1
 
-    for vtype in s.keys():
-        if n_shared_AB != n_shared_BA: # FIXME
+    for vtype in compAB_list[0].vartype.keys():
+        if n_shared_AB[vtype] != n_shared_BA[vtype]: # one-to-many matches, --assign optimal avoids them
             sys.stderr.write("warning: overlap was not symmetric for " + vtype)
-            sys.stderr.write(" (A-->B: " + str(n_shared_AB) + "),") 
-            sys.stderr.write(" (B-->A: " + str(n_shared_BA) + ") using A-->B\n")
+            sys.stderr.write(" (A-->B: " + str(n_shared_AB[vtype]) + "),") 
+            sys.stderr.write(" (B-->A: " + str(n_shared_BA[vtype]) + ") using A-->B\n")
     return s
 
-def outputVCF(comparison_list, inVCFhandle, outdir, outbasename=None):
-    ''' write VCF files for matched and unmatched records, for matched variants, output the record from sample A '''
-    ''' if outbasename is not None, output goes into tempfile.vcf, otherwise filename is derived from inVCFhandle '''
+def first_number(a):
+    ''' first int/float in a (INFO/FORMAT values may be lists), None if there is none '''
+    if isinstance(a, (list, tuple)):
+        for val in a:
+            if isinstance(val, (int, long, float)):
+                return val
+        return None
+
+    if isinstance(a, (int, long, float)):
+        return a
+
+    return None
+
+def score_value(rec, field):
+    ''' numeric value of QUAL, INFO/<key> (or just <key>) or FORMAT/<key> (first sample that has one) '''
+    if field == 'QUAL':
+        return first_number(rec.QUAL)
+
+    if field.startswith('FORMAT/'):
+        key = field[len('FORMAT/'):]
+        for sample in rec.samples:
+            if key in sample.data._fields:
+                val = first_number(getattr(sample.data, key))
+                if val is not None:
+                    return val
+        return None
+
+    if field.startswith('INFO/'):
+        field = field[len('INFO/'):]
+    return first_number(rec.INFO.get(field))
+
+def pr_curves(compAB_list, compBA_list, score_fields, use_truth=False):
+    ''' precision/recall/F1 at every distinct threshold of each score field, for each vtype
+        positives are calls in the truth set if use_truth, otherwise calls matched in B
+        recall is over the positives found by either callset: A's positives plus the B calls that are
+        positive and unmatched in A. Variants without a score count as +inf, so they pass every
+        threshold (the one row for them alone, threshold inf, is left out unless there is nothing else).
+        returns a list of rows (field, vtype, threshold, tp, fp, fn, precision, recall, f1) '''
+    import numpy as np # only needed here
+
+    rows = []
+    for vtype in compAB_list[0].vartype.keys():
+        variants = [v for comp in compAB_list for v in comp.vartype[vtype]]
+        if use_truth:
+            labels = np.array([v.is_true() for v in variants], dtype=bool)
+            missed = sum([1 for comp in compBA_list for v in comp.vartype[vtype] if v.is_true() and not v.matched()])
+        else:
+            labels = np.array([v.matched() for v in variants], dtype=bool)
+            missed = sum([1 for comp in compBA_list for v in comp.vartype[vtype] if not v.matched()])
+
+        n_pos = labels.sum() + missed
+
+        for i, field in enumerate(score_fields):
+            scores = np.array([v.scores[i] if v.scores[i] is not None else np.inf for v in variants], dtype=float)
+            if len(scores) == 0:
+                continue
+
+            # descending scores, cumulative TP/FP; keep the last entry of each run of equal scores
+            order  = np.argsort(-scores, kind='mergesort')
+            scores = scores[order]
+            tp = np.cumsum(labels[order])
+            fp = np.cumsum(~labels[order])
+            last = np.append(scores[1:] != scores[:-1], True)
+
+            scored = scores != np.inf
+            if scored.any():
+                last &= scored
+            thresholds, tp, fp = scores[last], tp[last], fp[last]
+            precision = tp / (tp + fp).astype(float)
+            recall = tp / float(n_pos) if n_pos > 0 else np.zeros(len(tp))
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-300), 0.0)
+
+            for j in range(len(thresholds)):
+                rows.append((field, vtype, thresholds[j], int(tp[j]), int(fp[j]), int(n_pos - tp[j]), precision[j], recall[j], f1[j]))
+
+    return rows
+
+def write_pr_curves(rows, filename):
+    with open(filename, 'w') as out:
+        out.write('\t'.join(('field', 'vtype', 'threshold', 'TP', 'FP', 'FN', 'precision', 'recall', 'F1')) + '\n')
+        for row in rows:
+            out.write('\t'.join(map(str, row[:2]) + ['%g' % row[2]] + map(str, row[3:6]) + ['%.6f' % x for x in row[6:]]) + '\n')
+
+def unmatched_categories(var):
+    ''' category names (without A_/B_ prefix) an unmatched variant is counted in, see get_sumheader '''
+    name = ['unmatched']
+    name.append('pass' if var.recA_pass() else 'fail')
+    name.append('somatic' if var.recA_somatic() else 'germline')
+
+    cats = ['_'.join(name + ['overall'])]
+    if var.is_true():
+        cats.append('_'.join(name + ['truth']))
+    return cats
+
+def matched_categories(var):
+    ''' category names a matched variant is counted in, see get_sumheader '''
+    name = ['matched']
+    name.append('pass' if var.recA_pass() else 'fail')
+    name.append('pass' if var.recB_pass() else 'fail')
+    name.append('somatic' if var.recA_somatic() else 'germline')
+    name.append('somatic' if var.recB_somatic() else 'germline')
+
+    cats = ['_'.join(name + ['overall'])]
+    if var.is_true():
+        cats.append('_'.join(name + ['truth']))
+    return cats
+
+def raw_header(filename):
+    ''' header lines of a VCF, as they are in the file '''
+    reader = bgzf.open_reader(filename)
+    if reader is None: # not BGZF, plain gzip
+        header = []
+        for line in gzip.open(filename, 'rb'):
+            if not line.startswith('#'):
+                break
+            header.append(line)
+        return header
+
+    header = bgzf.header_lines(reader)
+    reader.close()
+    return header
+
+def raw_records(filename, region, handles=None):
+    ''' record lines of filename in region (chrom, start, end), same records in the same order as
+        the pyvcf reader used for the comparison, so Variant.ordinal indexes them. chrom None is the whole file '''
+    chrom, start, end = region
+    if chrom is None:
+        reader = bgzf.open_reader(filename)
+        if reader is None:
+            reader = gzip.open(filename, 'rb')
+        for line in reader:
+            if line.strip() and not line.startswith('#'): # blank lines aren't records to pyvcf either
+                yield line
+        reader.close()
+        return
+
+    if handles is not None:
+        tabix = handles.tabix(filename)
+    else:
+        import pysam
+        tabix = pysam.Tabixfile(filename)
+
+    for line in tabix.fetch(chrom, start, end):
+        yield line + '\n'
+
+def record_status(comparison):
+    ''' dict ordinal --> True (matched) / False (unmatched) for the records in comparison '''
+    status = {}
+    for vtype in comparison.vartype.keys():
+        for var in comparison.vartype[vtype]:
+            status[var.ordinal] = var.matched()
+    return status
+
+def output_names(inVCFhandle, outdir, outbasename, suffixes):
+    ''' output filenames for inVCFhandle, one per suffix (creates outdir) '''
     ifname = os.path.basename(inVCFhandle.filename)
     assert ifname.endswith('.vcf.gz')
 
@@ -642,57 +1579,372 @@ def outputVCF(comparison_list, inVCFhandle, outdir, outbasename=None):
         if outbasename is not None:
             outbasename = outdir + '/' + outbasename
 
-    ofname_match = re.sub('vcf.gz$', 'matched.vcf', ifname)
-    ofname_unmatch = re.sub('vcf.gz$', 'unmatched.vcf', ifname)
-
     if outbasename is not None:
-        ofname_match   = outbasename + ".matched.vcf"
-        ofname_unmatch = outbasename + ".unmatched.vcf"
+        return [outbasename + "." + suffix for suffix in suffixes]
+    return [re.sub('vcf.gz$', suffix, ifname) for suffix in suffixes]
+
+def outputVCF(comparison_list, inVCFhandle, outdir, outbasename=None, handles=None):
+    ''' write VCF files for matched and unmatched records, for matched variants, output the record from sample A '''
+    ''' if outbasename is not None, output goes into tempfile.vcf, otherwise filename is derived from inVCFhandle '''
+    ''' records are not re-serialized: the header and record lines are copied from the input as they are '''
+    ofname_match, ofname_unmatch = output_names(inVCFhandle, outdir, outbasename, ('matched.vcf', 'unmatched.vcf'))
 
-    vcfout_unmatch = vcf.Writer(file(ofname_unmatch, 'w'), inVCFhandle)
-    vcfout_match   = vcf.Writer(file(ofname_match, 'w'), inVCFhandle)
+    header = ''.join(raw_header(inVCFhandle.filename))
 
-    match = 0
-    unmatch = 0
+    vcfout_unmatch = open(ofname_unmatch, 'w', 1 << 20)
+    vcfout_match   = open(ofname_match, 'w', 1 << 20)
+    vcfout_unmatch.write(header)
+    vcfout_match.write(header)
 
     for comparison in comparison_list:
-        for vtype in comparison.vartype.keys():
-            for var in comparison.vartype[vtype]:
-                if var.matched():
-                    vcfout_match.write_record(var.recA)
-                    match += 1
+        # variants don't keep their records, fetch the same region again and pick lines by ordinal
+        status = record_status(comparison)
+        if not status:
+            continue
+
+        last = max(status.keys())
+        for ordinal, line in enumerate(raw_records(inVCFhandle.filename, comparison.region, handles=handles)):
+            if ordinal in status:
+                if status[ordinal]:
+                    vcfout_match.write(line)
                 else:
-                    vcfout_unmatch.write_record(var.recA)
-                    unmatch +=1
+                    vcfout_unmatch.write(line)
+            if ordinal == last:
+                break
 
     vcfout_match.close()
     vcfout_unmatch.close()
 
     return ofname_match, ofname_unmatch
 
-def openVCFs(vcf_list):
-    ''' return list of vcf file handles '''
+STATUS_MAGIC   = 'VCST'
+STATUS_VERSION = 1
+
+def pack_bits(ordinals, n):
+    ''' bitset of n bits with the bits in ordinals set '''
+    bits = array.array('B', [0]) * ((n + 7) // 8)
+    for i in ordinals:
+        bits[i >> 3] |= 1 << (i & 7)
+    return bits.tostring()
+
+def unpack_bits(buf, n):
+    ''' ordinals of the bits set in a bitset of n bits '''
+    bits = array.array('B', buf)
+    return [i for i in xrange(n) if bits[i >> 3] & (1 << (i & 7))]
+
+def outputStatus(comparison_list, inVCFhandle, outdir, outbasename=None):
+    ''' write match status as a sidecar instead of matched/unmatched VCFs: for each fetched region,
+        two bitsets by record ordinal (compared, matched). read back with read_status() '''
+    ofname = output_names(inVCFhandle, outdir, outbasename, ('status',))[0]
+
+    out = [struct.pack('<4sHI', STATUS_MAGIC, STATUS_VERSION, len(comparison_list))]
+    for comparison in comparison_list:
+        status = record_status(comparison)
+        chrom, start, end = comparison.region
+        chrom = chrom or ''
+        n = max(status.keys()) + 1 if status else 0
+        out.append(struct.pack('<H', len(chrom)) + chrom + struct.pack('<qqI', start, end, n))
+        out.append(pack_bits(status.keys(), n))
+        out.append(pack_bits([i for i in status if status[i]], n))
+
+    with open(ofname, 'wb') as f:
+        f.write(''.join(out))
+
+    return ofname
+
+def read_status(filename):
+    ''' parse an outputStatus() sidecar, returns list of ((chrom, start, end), matched ordinals, unmatched ordinals)
+        chrom is None for a whole-file comparison '''
+    with open(filename, 'rb') as f:
+        buf = f.read()
+
+    magic, version, nregions = struct.unpack_from('<4sHI', buf, 0)
+    assert magic == STATUS_MAGIC and version == STATUS_VERSION, filename + " is not a status file of this version"
+    offset = struct.calcsize('<4sHI')
+
+    regions = []
+    for r in range(nregions):
+        nchrom = struct.unpack_from('<H', buf, offset)[0]
+        offset += 2
+        chrom = buf[offset:offset+nchrom] or None
+        offset += nchrom
+        start, end, n = struct.unpack_from('<qqI', buf, offset)
+        offset += struct.calcsize('<qqI')
+        nbytes = (n + 7) // 8
+        compared = unpack_bits(buf[offset:offset+nbytes], n)
+        matched  = set(unpack_bits(buf[offset+nbytes:offset+2*nbytes], n))
+        offset += 2*nbytes
+        regions.append(((chrom, start, end), sorted(matched), [i for i in compared if i not in matched]))
+
+    return regions
+
+ANNOTATION_HEADER = ['##INFO=<ID=VC_SRC,Number=1,Type=String,Description="VCFcomparator: input the record comes from (A or B)">\n',
+                     '##INFO=<ID=VC_MATCH,Number=0,Type=Flag,Description="VCFcomparator: record matched a record in the other input">\n',
+                     '##INFO=<ID=VC_PARTNER,Number=.,Type=String,Description="VCFcomparator: CHROM:POS:ALT of the matched record(s) in the other input, first match first">\n',
+                     '##INFO=<ID=VC_TRUTH,Number=0,Type=Flag,Description="VCFcomparator: record matched a record in the truth VCF">\n',
+                     '##INFO=<ID=VC_ISCORE,Number=1,Type=Float,Description="VCFcomparator: interval overlap score with the matched record (SV)">\n']
+
+def merge_headers(headerA, headerB):
+    ''' header for records of both inputs: A's header, the INFO/FILTER/FORMAT/contig lines of B that A lacks
+        and the VC_ tags. Returns (header lines, number of columns to keep): sample columns are only kept
+        if both inputs have the same samples '''
+    seen = set()
+    for line in headerA:
+        if line.startswith('##') and '<ID=' in line:
+            seen.add(line.split(',', 1)[0])
+
+    extra = [line for line in headerB if line.startswith(('##INFO=', '##FILTER=', '##FORMAT=', '##contig=')) and line.split(',', 1)[0] not in seen]
+
+    colsA = headerA[-1].rstrip('\n').split('\t')
+    colsB = headerB[-1].rstrip('\n').split('\t')
+    ncols = len(colsA) if colsA == colsB else 8
+
+    return headerA[:-1] + extra + ANNOTATION_HEADER + ['\t'.join(colsA[:ncols]) + '\n'], ncols
+
+def annotation_tags(var, src):
+    ''' VC_ INFO tags for a Variant from input src ('A' or 'B') '''
+    tags = ['VC_SRC=' + src]
+    if var.matched():
+        tags.append('VC_MATCH')
+        tags.append('VC_PARTNER=' + ','.join(['%s:%d:%s' % p for p in [var.partner] + var.altmatch]))
+        if isinstance(var, IntervalVariant):
+            tags.append('VC_ISCORE=%.4f' % var.interval_score())
+    if var.is_true():
+        tags.append('VC_TRUTH')
+    return ';'.join(tags)
+
+def annotate_line(line, tags, ncols):
+    ''' add tags to the INFO column of a VCF line, drop columns beyond ncols '''
+    c = line.rstrip('\n').split('\t', ncols)[:ncols]
+    if c[7] == '.':
+        c[7] = tags
+    else:
+        c[7] += ';' + tags
+    return '\t'.join(c) + '\n'
+
+def annotated_records(comparison, filename, src, rank, ncols, handles=None):
+    ''' yields (chrom rank, POS, src, annotated line) for the records in comparison
+        rank is a dict CHROM --> sort rank, contigs missing from it are added in order of appearance '''
+    variants = {}
+    for vtype in comparison.vartype.keys():
+        for var in comparison.vartype[vtype]:
+            variants[var.ordinal] = var
+
+    if not variants:
+        return
+
+    last = max(variants.keys())
+    for ordinal, line in enumerate(raw_records(filename, comparison.region, handles=handles)):
+        if ordinal in variants:
+            chrom, pos = line.split('\t', 2)[:2]
+            if chrom not in rank:
+                rank[chrom] = len(rank)
+            yield rank[chrom], int(pos), src, annotate_line(line, annotation_tags(variants[ordinal], src), ncols)
+        if ordinal == last:
+            break
+
+def outputAnnotated(compAB_list, compBA_list, vcf_handles, outdir, outbasename=None, handles=None):
+    ''' write the records of both inputs into one sorted, BGZF-compressed and tabix-indexed VCF,
+        each tagged with VC_SRC, VC_MATCH, VC_PARTNER, VC_TRUTH and VC_ISCORE (see ANNOTATION_HEADER)
+        compAB_list[i] and compBA_list[i] must cover the same region, regions in genome order '''
+    import pysam
+
+    ofname = output_names(vcf_handles[0], outdir, outbasename, ('annotated.vcf.gz',))[0]
+
+    header, ncols = merge_headers(raw_header(vcf_handles[0].filename), raw_header(vcf_handles[1].filename))
+
+    # records sort by contig in header order, then position, A before B
+    rank = {}
+    for line in header:
+        if line.startswith('##contig=<ID='):
+            chrom = line[len('##contig=<ID='):].split(',', 1)[0].rstrip('>\n')
+            rank.setdefault(chrom, len(rank))
+
+    out = bgzf.BgzfWriter(ofname)
+    out.write(''.join(header))
+
+    for compAB, compBA in zip(compAB_list, compBA_list):
+        recordsA = annotated_records(compAB, vcf_handles[0].filename, 'A', rank, ncols, handles=handles)
+        recordsB = annotated_records(compBA, vcf_handles[1].filename, 'B', rank, ncols, handles=handles)
+        for r, pos, src, line in heapq.merge(recordsA, recordsB):
+            out.write(line)
+
+    out.close()
+    pysam.tabix_index(ofname, preset='vcf', force=True)
+
+    return ofname
+
+TABLE_FORMATS = ('npz', 'parquet')
+
+def info_value(info, key):
+    ''' value of key in a raw INFO column, '1' for a flag, '' if absent '''
+    for field in info.split(';'):
+        k, eq, v = field.partition('=')
+        if k == key:
+            return v if eq else '1'
+    return ''
+
+def table_columns(comparison, filename, src, info_fields=None, score_fields=None, handles=None, columns=None):
+    ''' append one row per compared record to columns (OrderedDict name --> list), returns columns
+        CHROM/POS/REF/ALT and info_fields come from the raw input lines, the rest from the Variants.
+        pass/somatic describe the record itself, partner_* the record it matched in the other input '''
+    info_fields = info_fields or []
+    score_fields = score_fields or []
+
+    if columns is None:
+        columns = OrderedDict()
+        for name in (['src', 'chrom', 'pos', 'ref', 'alt', 'vtype', 'pass', 'somatic', 'matched', 'partner_pass', 'partner_somatic', 'truth', 'score', 'strata']
+                     + ['score_' + field for field in score_fields] + ['info_' + key for key in info_fields]):
+            columns[name] = []
+
+    variants = {}
+    for vtype in comparison.vartype.keys():
+        for var in comparison.vartype[vtype]:
+            variants[var.ordinal] = (vtype, var)
+
+    if not variants:
+        return columns
+
+    last = max(variants.keys())
+    for ordinal, line in enumerate(raw_records(filename, comparison.region, handles=handles)):
+        if ordinal in variants:
+            vtype, var = variants[ordinal]
+            c = line.rstrip('\n').split('\t', 8)
+            row = [src, c[0], int(c[1]), c[3], c[4], vtype, var.recA_pass(), var.recA_somatic(), var.matched(),
+                   var.recB_pass(), var.recB_somatic(), var.is_true(), var.score(), var.strata]
+            row += [x if x is not None else float('nan') for x in (var.scores or [None] * len(score_fields))]
+            row += [info_value(c[7], key) for key in info_fields]
+            for values, x in zip(columns.values(), row):
+                values.append(x)
+        if ordinal == last:
+            break
+
+    return columns
+
+def write_table(columns, filename, fmt='npz'):
+    ''' write columns (from table_columns) as one part: a NumPy .npz archive or a Parquet file (needs pyarrow)
+        returns the number of rows '''
+    import numpy as np # only needed here
+
+    arrays = OrderedDict()
+    for name, values in columns.items():
+        if name in ('pos', 'strata'):
+            arrays[name] = np.array(values, dtype=np.int64)
+        elif name in ('pass', 'somatic', 'matched', 'partner_pass', 'partner_somatic', 'truth'):
+            arrays[name] = np.array(values, dtype=bool)
+        elif name == 'score' or name.startswith('score_'):
+            arrays[name] = np.array(values, dtype=np.float64)
+        else:
+            arrays[name] = np.array(values, dtype=str)
+
+    if fmt == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.Table.from_arrays([pyarrow.array(a) for a in arrays.values()], names=arrays.keys())
+        pyarrow.parquet.write_table(table, filename)
+    else:
+        with open(filename, 'wb') as f: # np.savez would append .npz to a filename
+            np.savez(f, **arrays)
+
+    return len(columns['src'])
+
+def to_segment(d):
+    ''' Segment from a dict (segment or checkpoint json of parallel_cmp.py/shard_cmp.py) '''
+    seg = Segment()
+    seg.chrom  = str(d['chrom']) # json gives unicode
+    seg.start  = d['start']
+    seg.end    = d['end']
+    seg.length = seg.end - seg.start
+    return seg
+
+def read_json(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def write_json_atomic(obj, filename):
+    ''' write to a temp file in the same directory and rename, readers never see a partial file
+        (the temp name is unique per host and process, the directory may be shared between nodes) '''
+    tmp = filename + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+def write_table_manifest(parts, filename, fmt='npz'):
+    ''' parts: list of (part filename, rows) in genome order, the parts are listed, not rewritten '''
+    base = os.path.dirname(os.path.abspath(filename))
+    with open(filename, 'w') as out:
+        json.dump({'format': fmt, 'rows': sum([rows for part, rows in parts]),
+                   'parts': [{'file': os.path.relpath(os.path.abspath(part), base), 'rows': rows} for part, rows in parts]}, out, indent=1)
+
+def read_table(manifest):
+    ''' concatenate the parts listed in a table manifest: dict column --> numpy array for npz
+        (pandas.DataFrame(read_table(...)) gives a data frame), a pyarrow Table for parquet '''
+    with open(manifest, 'r') as f:
+        m = json.load(f)
+    base = os.path.dirname(os.path.abspath(manifest))
+    files = [os.path.join(base, part['file']) for part in m['parts']]
+
+    if m['format'] == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow.concat_tables([pyarrow.parquet.read_table(fn) for fn in files])
+
+    import numpy as np
+    parts = [np.load(fn) for fn in files]
+    if not parts:
+        return OrderedDict()
+    return OrderedDict([(name, np.concatenate([part[name] for part in parts])) for name in parts[0].files])
+
+def outputTable(compAB_list, compBA_list, vcf_handles, outdir, outbasename=None, fmt='npz', info_fields=None, score_fields=None, handles=None):
+    ''' write the compared records of both inputs (src A and B) as one table part, returns (filename, rows) '''
+    ofname = output_names(vcf_handles[0], outdir, outbasename, ('table.' + fmt,))[0]
+
+    columns = None
+    for comparison_list, h, src in ((compAB_list, vcf_handles[0], 'A'), (compBA_list, vcf_handles[1], 'B')):
+        for comparison in comparison_list:
+            columns = table_columns(comparison, h.filename, src, info_fields=info_fields, score_fields=score_fields, handles=handles, columns=columns)
+
+    return ofname, write_table(columns, ofname, fmt=fmt)
+
+def openVCFs(vcf_list, handles=None, roles=('A', 'B')):
+    ''' return list of vcf file handles, taken from handles (a HandlePool) if given, one reader
+        per role (see HandlePool) '''
+    import vcf
+
     vcf_handles = []
 
-    for vcf_file in vcf_list:
+    assert len(roles) >= len(vcf_list)
+    for vcf_file, role in zip(vcf_list, roles):
         try:
-            vcf_handles.append(vcf.Reader(filename=vcf_file,compressed=True))
+            if handles is not None:
+                vcf_handles.append(handles.vcf(vcf_file, role))
+            else:
+                vcf_handles.append(vcf.Reader(filename=vcf_file,compressed=True))
         except IOError as e:
             sys.stderr.write(str(e) + ' -- is this an indexed tabix file?\n')
             sys.exit()
 
     return vcf_handles
 
-def parseVCFs(vcf_list, maskfile=None, truthvcf=None, chrom=None, start=None, end=None, verbose=False):
-    ''' handle the list of vcf files and handle errors '''
+def parseVCFs(vcf_list, maskfile=None, truthvcf=None, chrom=None, start=None, end=None, verbose=False, prefetch=0, threads=0, strata=None, score_fields=None, handles=None, prefilter=None, w_indel=0, indel_match='exact', assign='first'):
+    ''' handle the list of vcf files and handle errors
+        handles: a HandlePool, keeps readers and indexes open between calls
+        prefilter: false positive rate of SitePrefilters built for B, A and truth (None: no prefilter)
+        w_indel, indel_match, assign: indel match window and mode, one-to-one assignment, see compareVCFs '''
     assert len(vcf_list) == 2
-    vcf_handles = openVCFs(vcf_list) 
+    vcf_handles = openVCFs(vcf_list, handles=handles) 
     assert len(vcf_handles) == 2
 
     tabix_mask = None
     if maskfile is not None:
+        import pysam
         try:
-            tabix_mask = pysam.Tabixfile(maskfile)
+            if handles is not None:
+                tabix_mask = handles.tabix(maskfile)
+            else:
+                tabix_mask = pysam.Tabixfile(maskfile)
         except:
             sys.stderr.write("could not read mask: " + maskfile + "  is it a tabix-indexed bgzipped BED?\n")
             sys.exit()
@@ -700,10 +1952,17 @@ def parseVCFs(vcf_list, maskfile=None, truthvcf=None, chrom=None, start=None, en
     tabix_truth = None
     if truthvcf is not None:
         try:
-            tabix_truth = openVCFs([truthvcf])[0]
+            tabix_truth = openVCFs([truthvcf], handles=handles, roles=('truth',))[0]
         except:
             sys.stderr.write("could not read mask: " + truthvcf + "  is it a tabix-indexed bgzipped VCF?\n")
             sys.exit()
+
+    prefilters = [None, None, None] # A, B, truth
+    if prefilter is not None:
+        for i, fn in enumerate(vcf_list + [truthvcf]):
+            if fn is not None:
+                prefilters[i] = SitePrefilter(fn, chrom=chrom, start=start or 0, end=end or int(1e9), fp_rate=float(prefilter), handles=handles)
+                sys.stderr.write(prefilters[i].stats() + "\n")
             
     # compare VCFs
     try:
@@ -712,17 +1971,29 @@ def parseVCFs(vcf_list, maskfile=None, truthvcf=None, chrom=None, start=None, en
         else:
             sys.stderr.write(chrom + ":" + str(start) + "-" + str(end) + ": " + vcf_list[0] + " --> " + vcf_list[1] + "\n")
 
-        resultAB = compareVCFs(vcf_handles[0], vcf_handles[1], verbose=verbose, mask=tabix_mask, truth=tabix_truth, chrom=chrom, fetch_start=start, fetch_end=end)
+        resultAB = compareVCFs(vcf_handles[0], vcf_handles[1], verbose=verbose, mask=tabix_mask, truth=tabix_truth, chrom=chrom, fetch_start=start, fetch_end=end, prefetch=prefetch, threads=threads, strata=strata, score_fields=score_fields,
+                               prefilter=prefilters[1], prefilter_truth=prefilters[2], w_indel=w_indel, indel_match=indel_match, assign=assign)
 
-        # reload vcfs to reset iteration
-        vcf_handles = openVCFs(vcf_list) 
+        # reload vcfs to reset iteration (pooled handles are reset by fetch)
+        vcf_handles = openVCFs(vcf_list, handles=handles) 
 
         if chrom is None:
             sys.stderr.write(vcf_list[1] + " --> " + vcf_list[0] + "\n")
         else:
             sys.stderr.write(chrom + ":" + str(start) + "-" + str(end) + ": " + vcf_list[1] + " --> " + vcf_list[0] + "\n")
 
-        resultBA = compareVCFs(vcf_handles[1], vcf_handles[0], verbose=verbose, mask=tabix_mask, truth=tabix_truth, chrom=chrom, fetch_start=start, fetch_end=end)
+        resultBA = compareVCFs(vcf_handles[1], vcf_handles[0], verbose=verbose, mask=tabix_mask, truth=tabix_truth, chrom=chrom, fetch_start=start, fetch_end=end, prefetch=prefetch, threads=threads, strata=strata, score_fields=score_fields,
+                               prefilter=prefilters[0], prefilter_truth=prefilters[2], w_indel=w_indel, indel_match=indel_match, assign=assign)
+
+        for result, direction in ((resultAB, vcf_list[0] + " --> " + vcf_list[1]), (resultBA, vcf_list[1] + " --> " + vcf_list[0])):
+            if result.clusters is not None:
+                sys.stderr.write(direction + ": " + result.clusters.report() + "\n")
+
+        if verbose:
+            for pf in prefilters:
+                if pf is not None:
+                    sys.stderr.write(pf.reject_stats() + "\n")
+
         return resultAB, resultBA, vcf_handles
 
     except ValueError as e:
@@ -768,56 +2039,164 @@ def split_genome(chroms, n, minlen=1e6, verbose=False):
 
     return jobs
 
+def get_strata(args):
+    ''' Strata from --strat name:bed options, None if there are none '''
+    if getattr(args, 'strat', None):
+        return Strata(args.strat)
+    return None
+
 def runList(result_queue, vcfA_queue, vcfB_queue, args, seg_list, vcftag, mp=False):
     ''' used by external script to parallelize jobs, vcftag will be appended to VCF output basename '''    
     resultsAB = []
     resultsBA = []
+    summaries = OrderedDict()
     vcf_handles = None
     vcftag = str(vcftag)
+    strata = get_strata(args) # loaded once for all segments
+    handles = HandlePool()    # readers and indexes opened once for all segments
 
     for seg in seg_list: # Segment
-        resultAB, resultBA, vcf_handles = parseVCFs(args.vcf, maskfile=args.maskfile, truthvcf=args.truth, chrom=seg.chrom, start=seg.start, end=seg.end, verbose=args.verbose)
+        resultAB, resultBA, vcf_handles = parseVCFs(args.vcf, maskfile=args.maskfile, truthvcf=args.truth, chrom=seg.chrom, start=seg.start, end=seg.end, verbose=args.verbose, prefetch=int(getattr(args, 'prefetch', 0)), strata=strata, handles=handles, prefilter=getattr(args, 'prefilter', None),
+                                                    w_indel=int(getattr(args, 'w_indel', 0)), indel_match=getattr(args, 'indel_match', 'exact'),
+                                                    assign=getattr(args, 'assign', 'first'))
         resultsAB.append(resultAB)
         resultsBA.append(resultBA)
+
+        # summarize each segment once, segment summaries add up to the summary for the list
+        s = summary([resultAB], [resultBA], strata=strata)
         if args.verbose:
-            summary([resultAB], [resultBA])
+            sys.stderr.write(dumps_summaries(s.values()))
+        merge_summaries(s.values(), merged=summaries)
+
+    if args.verbose:
+        sys.stderr.write("job " + vcftag + ": " + handles.stats() + "\n")
 
     basenameA = os.path.basename(vcf_handles[0].filename) + "." + vcftag
     basenameB = os.path.basename(vcf_handles[1].filename) + "." + vcftag
 
-    vcfA_names = outputVCF(resultsAB, vcf_handles[0], args.outdir, outbasename=basenameA)
-    vcfB_names = outputVCF(resultsBA, vcf_handles[1], args.outdir, outbasename=basenameB)
-    s = summary(resultsAB, resultsBA)
-
-    if args.summary_outfile is not None:
-        sum_out = open(args.summary_outfile, 'w')
-        for vartype in s.keys():
-            sum_out.write(s[vartype].output() + "\n")
-        sum_out.close()
+    vcfA_names = outputVCF(resultsAB, vcf_handles[0], args.outdir, outbasename=basenameA, handles=handles)
+    vcfB_names = outputVCF(resultsBA, vcf_handles[1], args.outdir, outbasename=basenameB, handles=handles)
 
     if mp:
-        result_queue.put(s)
+        # serialized summaries are much smaller to pickle through the queue than Summary objects
+        result_queue.put(dumps_summaries(summaries.values(), fmt='binary'))
         vcfA_queue.put(vcfA_names)
         vcfB_queue.put(vcfB_names)
 
+    return summaries
+
+def runSegment(args, seg, outdir, basenameA, basenameB, strata=None, handles=None):
+    ''' compare one Segment, write its matched/unmatched VCFs to outdir (used by shard_cmp.py)
+        strata: a Strata object, pass one in to avoid reloading the BEDs for every segment
+        handles: a HandlePool, pass one in to keep files open from segment to segment
+        args.table (npz/parquet, optional): also write a table part for the segment, with a column
+        for each args.score field (optional)
+        returns summaries (dict vtype --> Summary), (A matched, A unmatched), (B matched, B unmatched),
+        (table part, rows) or None '''
+    if strata is None:
+        strata = get_strata(args)
+    score_fields = getattr(args, 'score', None)
+
+    resultAB, resultBA, vcf_handles = parseVCFs(args.vcf, maskfile=args.maskfile, truthvcf=args.truth, chrom=seg.chrom, start=seg.start, end=seg.end, verbose=args.verbose, prefetch=int(getattr(args, 'prefetch', 0)), strata=strata, score_fields=score_fields, handles=handles, prefilter=getattr(args, 'prefilter', None),
+                                                    w_indel=int(getattr(args, 'w_indel', 0)), indel_match=getattr(args, 'indel_match', 'exact'),
+                                                    assign=getattr(args, 'assign', 'first'))
+
+    vcfA_names = outputVCF([resultAB], vcf_handles[0], outdir, outbasename=basenameA, handles=handles)
+    vcfB_names = outputVCF([resultBA], vcf_handles[1], outdir, outbasename=basenameB, handles=handles)
+
+    table = None
+    if getattr(args, 'table', None) is not None:
+        table = outputTable([resultAB], [resultBA], vcf_handles, outdir, outbasename=basenameA, fmt=args.table, info_fields=getattr(args, 'table_info', None), score_fields=score_fields, handles=handles)
+
+    return summary([resultAB], [resultBA], strata=strata), vcfA_names, vcfB_names, table
+
 def main(args):
-    resultAB, resultBA, vcf_handles = parseVCFs(args.vcf, maskfile=args.maskfile, truthvcf=args.truth, chrom=args.chrom, start=int(args.start), end=int(args.end), verbose=args.verbose)
-    outputVCF([resultAB], vcf_handles[0], args.outdir)
-    outputVCF([resultBA], vcf_handles[1], args.outdir)
+    strata = get_strata(args)
+
+    if args.prcurve is not None and not args.score:
+        sys.exit("--prcurve needs at least one --score field")
+
+    resultAB, resultBA, vcf_handles = parseVCFs(args.vcf, maskfile=args.maskfile, truthvcf=args.truth, chrom=args.chrom, start=int(args.start), end=int(args.end), verbose=args.verbose, prefetch=int(args.prefetch), threads=int(args.threads), strata=strata, score_fields=args.score, prefilter=args.prefilter,
+                                                w_indel=int(args.w_indel), indel_match=args.indel_match, assign=args.assign)
+    if args.annotated:
+        outputAnnotated([resultAB], [resultBA], vcf_handles, args.outdir)
+    elif args.status:
+        outputStatus([resultAB], vcf_handles[0], args.outdir)
+        outputStatus([resultBA], vcf_handles[1], args.outdir)
+    else:
+        outputVCF([resultAB], vcf_handles[0], args.outdir)
+        outputVCF([resultBA], vcf_handles[1], args.outdir)
+
+    if args.table is not None:
+        part = outputTable([resultAB], [resultBA], vcf_handles, args.outdir, fmt=args.table, info_fields=args.table_info, score_fields=args.score)
+        write_table_manifest([part], re.sub('\.' + args.table + '$', '.json', part[0]), fmt=args.table)
 
-    s = summary([resultAB], [resultBA])
+    s = summary([resultAB], [resultBA], strata=strata)
     if args.summary_outfile is None:
-        for vartype in s.keys():
-            print s[vartype].output()
+        sys.stdout.write(dumps_summaries(s.values(), fmt=args.summary_format))
     else:
-        sum_out = open(args.summary_outfile, 'w')
-        for vartype in s.keys():
-            sum_out.write(s[vartype].output() + "\n")
-        sum_out.close()
+        write_summaries(s.values(), args.summary_outfile, fmt=args.summary_format)
+
+    if args.prcurve is not None:
+        write_pr_curves(pr_curves([resultAB], [resultBA], args.score, use_truth=args.truth is not None), args.prcurve)
+
+def parse_region(region):
+    ''' chrom[:start-end] --> (chrom, start, end) '''
+    if ':' in region:
+        chrom, coords = region.rsplit(':', 1)
+        if '-' in coords:
+            start, end = coords.replace(',', '').split('-', 1)
+            return chrom, int(start), int(end)
+    return region, 0, int(1e9)
+
+def batch(args, infile=sys.stdin, out=sys.stdout):
+    ''' --batch: read comparison requests, one per line "<vcfA> <vcfB> [chrom[:start-end]]", until EOF
+        the process, its imports and open handles stay up between requests. Each response is
+        "#request <n> <request>", the summary (--summary_format) and "#done <n>", or
+        "#error <n> <message>" in place of the summary '''
+    handles = HandlePool()
+    strata  = get_strata(args)
+    n = 0
+
+    for line in iter(infile.readline, ''): # readline: don't wait for a full read-ahead buffer on a pipe
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        c = line.split()
+        out.write('#request ' + str(n) + ' ' + line + '\n')
+        try:
+            chrom, start, end = None, 0, int(1e9)
+            if len(c) > 2:
+                chrom, start, end = parse_region(c[2])
+
+            resultAB, resultBA, vcf_handles = parseVCFs(c[:2], maskfile=args.maskfile, truthvcf=args.truth, chrom=chrom, start=start, end=end, verbose=args.verbose, prefetch=int(args.prefetch), strata=strata, score_fields=args.score, handles=handles, prefilter=args.prefilter,
+                                                        w_indel=int(args.w_indel), indel_match=args.indel_match, assign=args.assign)
+
+            if args.outdir is not None and args.annotated:
+                outputAnnotated([resultAB], [resultBA], vcf_handles, args.outdir, outbasename=os.path.basename(vcf_handles[0].filename) + '.' + str(n), handles=handles)
+            elif args.outdir is not None:
+                for result, h in ((resultAB, vcf_handles[0]), (resultBA, vcf_handles[1])):
+                    if args.status:
+                        outputStatus([result], h, args.outdir, outbasename=os.path.basename(h.filename) + '.' + str(n))
+                    else:
+                        outputVCF([result], h, args.outdir, outbasename=os.path.basename(h.filename) + '.' + str(n), handles=handles)
+
+            out.write(dumps_summaries(summary([resultAB], [resultBA], strata=strata).values(), fmt=args.summary_format))
+
+        except (Exception, SystemExit) as e: # parseVCFs exits on unreadable input
+            out.write('#error ' + str(n) + ' ' + repr(e) + '\n')
+
+        out.write('#done ' + str(n) + '\n')
+        out.flush()
+        n += 1
+
+    if args.verbose:
+        sys.stderr.write(handles.stats() + "\n")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compares two sorted VCF files and (optionally) masks regions.')
-    parser.add_argument(metavar='<vcf_file>', dest='vcf', nargs=2, help='tabix-indexed files in VCF format')
+    parser.add_argument(metavar='<vcf_file>', dest='vcf', nargs='*', help='two tabix-indexed files in VCF format (none with --batch)')
     parser.add_argument('-m', '--mask', dest='maskfile', default=None, help='tabix-indexed BED file of masked intervals') 
     parser.add_argument('-o', '--outdir', dest='outdir', default=None, help='directory for output')
     parser.add_argument('-t', '--truth', dest='truth', default=None, help='also compare results to a "truth" VCF (should be sorted and tabix-indexed)')
@@ -825,8 +2204,31 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--start', dest='start', default=0, help='start position')
     parser.add_argument('-e', '--end', dest='end', default=int(1e9), help='end position') 
     parser.add_argument('-u', '--summary', dest='summary_outfile', default=None, help='outfile for summary (default stdout)')
+    parser.add_argument('--summary_format', dest='summary_format', default='text', choices=SUMMARY_FORMATS, help='summary format, all formats can be merged with mergesummaries.py (default text)')
+    parser.add_argument('--strat', dest='strat', action='append', default=None, help='<name>:<BED file>, also summarize variants overlapping these regions (may be repeated)')
+    parser.add_argument('--score', dest='score', action='append', default=None, help='QUAL, INFO/<key> or FORMAT/<key> to record for each variant (may be repeated)')
+    parser.add_argument('--prcurve', dest='prcurve', default=None, help='write precision/recall/F1 at every --score threshold to this file (TSV, needs numpy), calls without a score pass every threshold')
+    parser.add_argument('--prefetch', dest='prefetch', default=0, help='read ahead this many batches of records in a background thread (default 0, off)')
+    parser.add_argument('--indel_match', dest='indel_match', default='exact', choices=INDEL_MATCH_MODES, help='exact: same REF/ALT (default). position: POS within --w_indel bp. length: also same type and length. similar: also similar inserted/deleted sequence. Tolerant modes match one-to-one, best first')
+    parser.add_argument('--assign', dest='assign', default='first', choices=ASSIGN_MODES, help='first: indel/SV matches go to the first candidate in fetch order (default). optimal: one-to-one assignment with maximum total score within each cluster of candidates')
+    parser.add_argument('--w_indel', dest='w_indel', default=0, help='indel match window in bp (default 0)')
+    parser.add_argument('--prefilter', dest='prefilter', nargs='?', const=0.01, default=None, help='skip fetches for SNVs/indels whose site is not in a Bloom filter of the other VCF (and truth), optional value: false positive rate (default 0.01)')
+    parser.add_argument('--inflate_threads', dest='threads', default=0, help='whole-file runs (no -c): decompress BGZF blocks with this many threads (default 0, off)')
+    parser.add_argument('--status', action='store_true', default=False, help='write match status as <vcf>.status bitsets (see read_status) instead of matched/unmatched VCFs')
+    parser.add_argument('--annotated', action='store_true', default=False, help='write one sorted, indexed <vcfA>.annotated.vcf.gz with the records of both VCFs tagged VC_SRC/VC_MATCH/VC_PARTNER/VC_TRUTH/VC_ISCORE instead of matched/unmatched VCFs')
+    parser.add_argument('--table', dest='table', default=None, choices=TABLE_FORMATS, help='also write one row per compared record of both VCFs to <vcfA>.table.<format>, listed in <vcfA>.table.json (read_table() loads it)')
+    parser.add_argument('--table_info', dest='table_info', action='append', default=None, help='INFO field to add as a --table column (may be repeated)')
+    parser.add_argument('--batch', action='store_true', default=False, help='read "<vcfA> <vcfB> [chrom[:start-end]]" requests from stdin, keeping handles open between them')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose mode for debugging')
     args = parser.parse_args()
-    main(args)
+
+    if args.batch:
+        if args.summary_format == 'binary':
+            parser.error('--batch responses are line based, use a text --summary_format')
+        batch(args)
+    elif len(args.vcf) != 2:
+        parser.error('two VCF files are required')
+    else:
+        main(args)
 
 